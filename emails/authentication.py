@@ -0,0 +1,68 @@
+"""
+JWT authentication that remembers who a token belongs to.
+
+A token's signature and expiry are checked on every request, which needs no
+database. Only the user lookup is cached, per process, for
+JWT_USER_CACHE_TTL seconds. Saving or deleting a user, as a password change
+or deactivation does, drops their entry in this process at once; other
+processes notice when their entry expires.
+"""
+import copy
+import threading
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework_jwt.authentication import JSONWebTokenAuthentication
+from rest_framework_jwt.settings import api_settings
+
+from emails.cache import LRUCache
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_user_cache() -> LRUCache:
+    global _cache
+
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = LRUCache(settings.JWT_USER_CACHE_SIZE)
+
+    return _cache
+
+
+class CachedJSONWebTokenAuthentication(JSONWebTokenAuthentication):
+    """
+    JSONWebTokenAuthentication that looks the user up once per
+    JWT_USER_CACHE_TTL rather than on every request
+    """
+
+    def authenticate_credentials(self, payload):
+        user_id = api_settings.JWT_PAYLOAD_GET_USER_ID_HANDLER(payload)
+        username = api_settings.JWT_PAYLOAD_GET_USERNAME_HANDLER(payload)
+        cache = get_user_cache()
+
+        user = cache.get(user_id) if user_id else None
+
+        # A renamed user's old tokens stop working, as they do uncached
+        if user is None or user.get_username() != username:
+            user = super().authenticate_credentials(payload)
+            cache.set(user.pk, user, ttl=settings.JWT_USER_CACHE_TTL)
+
+        # Each request gets its own copy to change as it likes
+        return copy.copy(user)
+
+
+@receiver(post_save, sender=User, dispatch_uid='emails.authentication.forget_user')
+@receiver(post_delete, sender=User, dispatch_uid='emails.authentication.forget_deleted_user')
+def forget_user(sender, instance: User, **kwargs) -> None:
+    cache = get_user_cache()
+    cache.delete(instance.pk)
+
+    # A request that read the user before this transaction commits could
+    # cache the old row again, so forget it once more after the commit
+    transaction.on_commit(lambda: cache.delete(instance.pk))
@@ -0,0 +1,139 @@
+"""
+Content addressed attachment storage.
+
+Every distinct file is kept once as a Blob, found by its sha256. Attachments
+point at a blob and hold a reference on it. A blob whose last reference is
+released is deleted by `collect_garbage` after a grace period. The grace
+period keeps an upload that has just matched the blob from losing it.
+"""
+import logging
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Count, F
+from django.utils import timezone
+
+from emails.models import Attachment, Blob
+from emails.storage import StorageError, get_storage
+
+logger = logging.getLogger(__name__)
+
+
+def blob_object_name(sha256: str) -> str:
+    """
+    Storage name for content with this hash. It carries no file name, since
+    every attachment with the content shares the object.
+    """
+
+    return 'blobs/' + sha256
+
+
+def find_stored_blob(sha256: str):
+    """
+    Return the live, stored blob with this content, if there is one
+    """
+
+    return Blob.objects.filter(sha256=sha256, state=Blob.STORED, refcount__gt=0).first()
+
+
+def claim_blob(sha256: str, object_name: str, size: int, state: str, upload_started_at=None):
+    """
+    Take a reference on the blob for `sha256`, creating it if needed.
+    Returns (blob, created).
+    """
+
+    blob, created = Blob.objects.get_or_create(
+        sha256=sha256,
+        defaults={'object_name': object_name, 'size': size, 'state': state, 'upload_started_at': upload_started_at},
+    )
+    Blob.objects.filter(id=blob.id).update(refcount=F('refcount') + 1, updated_at=timezone.now())
+
+    return blob, created
+
+
+def adopt_object(blob: Blob, object_name: str) -> bool:
+    """
+    Point a blob whose upload failed or never finished, and every attachment
+    of it, at `object_name`, which is stored in full. Returns False, with
+    `blob` refreshed, if another upload stored the blob first.
+    """
+
+    adopted = Blob.objects\
+        .filter(id=blob.id)\
+        .exclude(state=Blob.STORED)\
+        .update(object_name=object_name, state=Blob.STORED, updated_at=timezone.now())
+
+    if not adopted:
+        blob.refresh_from_db()
+        return False
+
+    Attachment.objects.filter(blob_id=blob.id).update(object_name=object_name, state=Blob.STORED)
+
+    # Whatever the lost upload left behind is of no use now. An upload that
+    # is still running deletes its own object when it finds the blob moved.
+    previous = blob.object_name
+    transaction.on_commit(lambda: delete_objects([previous]))
+
+    blob.object_name = object_name
+    blob.state = Blob.STORED
+
+    return True
+
+
+def release_attachments(email_ids: list) -> None:
+    """
+    Delete the attachments of `email_ids` and drop their blob references.
+    Attachments from before deduplication own their object and lose it now.
+    """
+
+    attachments = Attachment.objects.filter(email_id__in=email_ids)
+
+    legacy = list(attachments.filter(blob__isnull=True).values_list('object_name', flat=True))
+    counts = attachments.filter(blob__isnull=False).values('blob_id').annotate(n=Count('id'))
+
+    # One UPDATE per distinct reference count, which is nearly always one
+    by_count = {}
+    for row in counts:
+        by_count.setdefault(row['n'], []).append(row['blob_id'])
+
+    now = timezone.now()
+    for n, blob_ids in by_count.items():
+        Blob.objects.filter(id__in=blob_ids).update(refcount=F('refcount') - n, updated_at=now)
+
+    attachments.delete()
+
+    if legacy:
+        transaction.on_commit(lambda: delete_objects(legacy))
+
+
+def delete_objects(object_names: list) -> None:
+    storage = get_storage()
+
+    for object_name in object_names:
+        try:
+            storage.delete(object_name)
+        except StorageError as e:
+            logger.warning("Could not delete %s: %s", object_name, e)
+
+
+def collect_garbage(grace_period: timedelta) -> int:
+    """
+    Delete blobs that have had no references for longer than `grace_period`.
+    Returns the number of blobs deleted.
+    """
+
+    cutoff = timezone.now() - grace_period
+
+    with transaction.atomic():
+        dead = Blob.objects\
+            .select_for_update(skip_locked=True)\
+            .filter(refcount=0, updated_at__lt=cutoff)
+        object_names = list(dead.values_list('object_name', flat=True))
+        dead.delete()
+
+    # Objects are named after their content, which may have been uploaded
+    # again as a new blob since
+    reused = set(Blob.objects.filter(object_name__in=object_names).values_list('object_name', flat=True))
+    delete_objects([object_name for object_name in object_names if object_name not in reused])
+
+    return len(object_names)
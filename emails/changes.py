@@ -0,0 +1,123 @@
+"""
+Per user change log behind incremental sync.
+
+Writers report every change to Mailbox rows through `mailbox_changed`, which
+keeps the folder counters and mailbox version up to date and appends one
+MailboxChange per row. Change ids only grow, so a client keeps the id of the
+last change it saw and asks for what came after.
+
+Changes to one user are ordered: bumping the mailbox version locks the
+user's MailboxState row until commit, and the changes are inserted after
+that. A later writer for the same user waits for the lock, so its changes get
+higher ids and commit later, and a client never skips one.
+
+`prune_changes` deletes old changes from the front of the log. A cursor from
+before the oldest remaining change may have missed some, so the client is
+told to resync in full instead.
+"""
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from emails.counters import counter_changes, update_counters
+from emails.listing import LIST_VALUES, list_rows
+from emails.models import Mailbox, MailboxChange, MailboxState
+
+
+def mailbox_changed(kind: str, before: list, after: list) -> None:
+    """
+    Account for mailbox rows going from `before` to `after`. Rows are dicts
+    with email_id, user_id, folder, starred and read. A purge has no after.
+    """
+
+    update_counters(counter_changes(before, -1) + counter_changes(after, 1))
+
+    if kind == MailboxChange.PURGE:
+        after = [dict(row, folder=None) for row in before]
+
+    MailboxChange.objects.bulk_create([
+        MailboxChange(
+            user_id=row['user_id'],
+            email_id=row['email_id'],
+            kind=kind,
+            folder=row['folder'],
+            starred=row['starred'],
+            read=row['read'],
+        )
+        for row in after
+    ])
+
+
+def latest_change_id() -> int:
+    return MailboxChange.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+
+def changes_since(user: User, since: int, limit: int) -> dict:
+    """
+    Return the user's changes after change id `since`, one entry per email
+    with its latest state, plus the listing rows of new mail. Asks for a full
+    resync when there is no cursor or the log was pruned past it.
+    """
+
+    oldest = MailboxChange.objects.order_by('id').values_list('id', flat=True).first()
+
+    if since is None or (oldest is not None and since < oldest - 1):
+        with transaction.atomic():
+            # Wait out a writer for this user that is yet to commit, or its
+            # changes could end up below the cursor yet missing from the
+            # client's fresh listing
+            MailboxState.objects.select_for_update().filter(user=user).first()
+            return {'resync': True, 'cursor': latest_change_id()}
+
+    changes = list(
+        MailboxChange.objects
+        .filter(user=user, id__gt=since)
+        .order_by('id')
+        .values_list('id', 'email_id', 'kind', 'folder', 'starred', 'read')[:limit + 1]
+    )
+    more = len(changes) > limit
+    changes = changes[:limit]
+
+    # Later changes to an email replace earlier ones
+    latest = {}
+    new_ids = set()
+    for change_id, email_id, kind, folder, starred, read in changes:
+        latest.pop(email_id, None)
+        latest[email_id] = [email_id, kind, folder, starred, read]
+
+        if kind == MailboxChange.NEW:
+            new_ids.add(email_id)
+
+    emails = Mailbox.objects\
+        .filter(user=user, email_id__in=new_ids)\
+        .order_by('-created_at', '-id')\
+        .values_list(*LIST_VALUES) if new_ids else []
+
+    return {
+        'changes': list(latest.values()),
+        'emails': list_rows(list(emails)),
+        'cursor': changes[-1][0] if changes else since,
+        'more': more,
+    }
+
+
+def prune_changes(max_age: timedelta) -> int:
+    """
+    Delete changes older than `max_age`. The newest change is always kept so
+    the log still shows how far it was pruned. Returns the number deleted.
+    """
+
+    cutoff = MailboxChange.objects\
+        .filter(created_at__lt=timezone.now() - max_age)\
+        .aggregate(cutoff=Max('id'))['cutoff']
+
+    if cutoff is None:
+        return 0
+
+    cutoff = min(cutoff, latest_change_id() - 1)
+    deleted, _ = MailboxChange.objects.filter(id__lte=cutoff).delete()
+
+    return deleted
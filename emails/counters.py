@@ -0,0 +1,141 @@
+"""
+Per user folder counters for "Inbox (42 unread)" style badges.
+
+Every change to Mailbox rows goes through here in the same transaction (by
+way of emails.changes.mailbox_changed), as a list of (user_id, folder, total,
+unread) changes worked out from the rows before and after. Starred counts
+the starred rows across all folders. `rebuild_counters` recounts from
+Mailbox to repair any drift.
+"""
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Count, F, Q
+
+from emails.models import FolderCounter, Mailbox
+from emails.versions import bump_versions
+
+FOLDERS = [folder for folder, _ in FolderCounter.FOLDER_CHOICES]
+
+
+def counter_changes(rows, sign: int) -> list:
+    """
+    What adding (sign 1) or removing (sign -1) mailbox `rows` does to the
+    counters. Rows are dicts with user_id, folder, starred and read.
+    """
+
+    changes = []
+
+    for row in rows:
+        unread = 0 if row['read'] else sign
+        changes.append((row['user_id'], row['folder'], sign, unread))
+
+        if row['starred']:
+            changes.append((row['user_id'], FolderCounter.STARRED, sign, unread))
+
+    return changes
+
+
+def update_counters(changes: list) -> None:
+    """
+    Apply counter changes and bump the mailbox version of every user they
+    name, even when their counts come out unchanged. Users that share the
+    same change, like every recipient of an email, are updated together, so
+    the number of queries does not grow with the number of users.
+    """
+
+    bump_versions(user_id for user_id, _, _, _ in changes)
+
+    totals = {}
+    for user_id, folder, total, unread in changes:
+        current = totals.get((user_id, folder), (0, 0))
+        totals[(user_id, folder)] = (current[0] + total, current[1] + unread)
+
+    groups = {}
+    for (user_id, folder), delta in totals.items():
+        if delta != (0, 0):
+            groups.setdefault((folder, delta), []).append(user_id)
+
+    if not groups:
+        return
+
+    FolderCounter.objects.bulk_create([
+        FolderCounter(user_id=user_id, folder=folder)
+        for (folder, _), user_ids in groups.items()
+        for user_id in user_ids
+    ], ignore_conflicts=True)
+
+    for (folder, (total, unread)), user_ids in groups.items():
+        FolderCounter.objects\
+            .filter(user_id__in=user_ids, folder=folder)\
+            .update(total=F('total') + total, unread=F('unread') + unread)
+
+
+def get_counters(user: User) -> dict:
+    """
+    Map every folder to its total and unread counts for `user`
+    """
+
+    counters = {folder: {'total': 0, 'unread': 0} for folder in FOLDERS}
+
+    for counter in FolderCounter.objects.filter(user=user).values('folder', 'total', 'unread'):
+        counters[counter['folder']] = {'total': counter['total'], 'unread': counter['unread']}
+
+    return counters
+
+
+def count_mailboxes(user_ids: list) -> dict:
+    """
+    Count the given users' folders from Mailbox. Returns a dict of
+    (user_id, folder) -> (total, unread) with only non-empty folders.
+    """
+
+    unread = Count('id', filter=Q(read=False))
+    rows = Mailbox.objects.filter(user_id__in=user_ids)
+    counts = {}
+
+    for row in rows.values('user_id', 'folder').annotate(total=Count('id'), unread=unread).order_by():
+        counts[(row['user_id'], row['folder'])] = (row['total'], row['unread'])
+
+    for row in rows.filter(starred=True).values('user_id').annotate(total=Count('id'), unread=unread).order_by():
+        counts[(row['user_id'], FolderCounter.STARRED)] = (row['total'], row['unread'])
+
+    return counts
+
+
+def rebuild_counters(user_ids: list = None, fix: bool = True, chunk_size: int = 500) -> list:
+    """
+    Recount the folders of `user_ids`, or of every user, and compare with
+    the stored counters.
+    Returns the drift as (user_id, folder, (total, unread) stored,
+    (total, unread) counted) and, when `fix` is set, corrects it.
+    """
+
+    drift = []
+    if user_ids is None:
+        user_ids = list(User.objects.order_by('id').values_list('id', flat=True))
+
+    for start in range(0, len(user_ids), chunk_size):
+        chunk = user_ids[start:start + chunk_size]
+
+        with transaction.atomic():
+            # Writers update counters before they commit, so holding the
+            # counters keeps their mailbox changes out of the recount
+            stored = {
+                (counter.user_id, counter.folder): (counter.total, counter.unread)
+                for counter in FolderCounter.objects.select_for_update().filter(user_id__in=chunk)
+            }
+            counted = count_mailboxes(chunk)
+            changes = []
+
+            for user_id, folder in set(stored) | set(counted):
+                have = stored.get((user_id, folder), (0, 0))
+                want = counted.get((user_id, folder), (0, 0))
+
+                if have != want:
+                    drift.append((user_id, folder, have, want))
+                    changes.append((user_id, folder, want[0] - have[0], want[1] - have[1]))
+
+            if fix:
+                update_counters(changes)
+
+    return drift
@@ -0,0 +1,177 @@
+"""
+Sending and delivering email.
+
+`send_email` saves an email with its recipients and the sender's copy, then
+queues a DeliveryJob for it. The `deliver_worker` command claims due jobs in
+batches with SELECT ... FOR UPDATE SKIP LOCKED, so any number of workers can
+share the queue, and puts each batch in its recipients' inboxes at once.
+A batch that fails is retried one job at a time; jobs that keep failing wait
+longer between attempts and are marked failed after DELIVERY_MAX_ATTEMPTS.
+
+With DELIVERY_QUEUE off, emails are delivered inside `send_email` instead.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Count, Min, Q
+from django.utils import timezone
+
+from emails.changes import mailbox_changed
+from emails.models import DeliveryJob, Email, Mailbox, MailboxChange, Recipient
+from emails.pubsub import publish
+
+logger = logging.getLogger(__name__)
+
+
+def send_email(sender: User, subject: str, message: str, recipients: list) -> Email:
+    """
+    Create an email and queue its delivery to every recipient's inbox.
+    A sender who is also a recipient keeps a single copy, in their inbox.
+    The email's receiver is its first To recipient, or None if it has none,
+    so Cc and Bcc recipients are never shown as the receiver.
+
+    `recipients` is a list of (user, kind) pairs with one entry per user. The
+    number of queries is fixed no matter how many recipients there are.
+    """
+
+    with transaction.atomic():
+        primary = next((user for user, kind in recipients if kind == Recipient.TO), None)
+
+        email = Email.objects.create(
+            subject=subject,
+            message=message,
+            sender=sender,
+            receiver=primary,
+        )
+
+        Recipient.objects.bulk_create([
+            Recipient(email=email, user=user, kind=kind) for user, kind in recipients
+        ])
+
+        if all(user != sender for user, kind in recipients):
+            row = Mailbox.objects.create(user=sender, email=email, folder=Mailbox.SENT, read=True)
+            mailbox_changed(MailboxChange.NEW, [], [
+                {'email_id': email.id, 'user_id': row.user_id, 'folder': row.folder, 'starred': False, 'read': True}
+            ])
+
+        if settings.DELIVERY_QUEUE:
+            DeliveryJob.objects.create(email=email)
+        else:
+            deliver_emails([email.id])
+
+    return email
+
+
+def deliver_emails(email_ids: list) -> None:
+    """
+    Put the emails in their recipients' inboxes. Recipients with an event
+    stream open are told once the delivery commits.
+    """
+
+    recipients = list(Recipient.objects.filter(email_id__in=email_ids).values_list('email_id', 'user_id'))
+
+    Mailbox.objects.bulk_create([
+        Mailbox(user_id=user_id, email_id=email_id, folder=Mailbox.INBOX) for email_id, user_id in recipients
+    ])
+    mailbox_changed(MailboxChange.NEW, [], [
+        {'email_id': email_id, 'user_id': user_id, 'folder': Mailbox.INBOX, 'starred': False, 'read': False}
+        for email_id, user_id in recipients
+    ])
+
+    by_email = {}
+    for email_id, user_id in recipients:
+        by_email.setdefault(email_id, []).append(user_id)
+
+    def notify():
+        for email_id, user_ids in by_email.items():
+            publish(user_ids, {'event': 'mail', 'email': email_id})
+
+    transaction.on_commit(notify)
+
+
+def retry_delay(attempts: int) -> timedelta:
+    """
+    How long a job that has failed `attempts` times waits before the next try
+    """
+
+    seconds = settings.DELIVERY_RETRY_DELAY * 2 ** (attempts - 1)
+    return timedelta(seconds=min(seconds, settings.DELIVERY_MAX_RETRY_DELAY))
+
+
+def process_delivery_jobs(batch_size: int) -> tuple:
+    """
+    Claim up to `batch_size` due jobs and deliver them. Jobs locked by another
+    worker are skipped. Returns the number delivered and the number that failed.
+    """
+
+    with transaction.atomic():
+        jobs = list(
+            DeliveryJob.objects
+            .select_for_update(skip_locked=True)
+            .filter(state=DeliveryJob.PENDING, run_after__lte=timezone.now())
+            .order_by('run_after')[:batch_size]
+        )
+
+        if not jobs:
+            return 0, 0
+
+        email_ids = [job.email_id for job in jobs]
+
+        try:
+            with transaction.atomic():
+                deliver_emails(email_ids)
+        except Exception:
+            logger.exception("Delivery of a batch of %d emails failed; retrying them one by one", len(jobs))
+        else:
+            DeliveryJob.objects.filter(email_id__in=email_ids).delete()
+            return len(jobs), 0
+
+        delivered = failed = 0
+
+        for job in jobs:
+            try:
+                with transaction.atomic():
+                    deliver_emails([job.email_id])
+            except Exception as e:
+                logger.exception("Delivery of email %d failed", job.email_id)
+                fail_job(job, e)
+                failed += 1
+            else:
+                job.delete()
+                delivered += 1
+
+        return delivered, failed
+
+
+def fail_job(job: DeliveryJob, error: Exception) -> None:
+    job.attempts += 1
+    job.last_error = '{}: {}'.format(type(error).__name__, error)
+
+    if job.attempts >= settings.DELIVERY_MAX_ATTEMPTS:
+        job.state = DeliveryJob.FAILED
+    else:
+        job.run_after = timezone.now() + retry_delay(job.attempts)
+
+    job.save(update_fields=['attempts', 'last_error', 'state', 'run_after'])
+
+
+def queue_stats() -> dict:
+    """
+    Depth of the delivery queue, and how far behind the workers are: how long
+    the longest waiting due job has been due
+    """
+
+    now = timezone.now()
+    stats = DeliveryJob.objects.aggregate(
+        pending=Count('email_id', filter=Q(state=DeliveryJob.PENDING)),
+        due=Count('email_id', filter=Q(state=DeliveryJob.PENDING, run_after__lte=now)),
+        failed=Count('email_id', filter=Q(state=DeliveryJob.FAILED)),
+        oldest_due=Min('run_after', filter=Q(state=DeliveryJob.PENDING, run_after__lte=now)),
+    )
+    oldest_due = stats.pop('oldest_due')
+    stats['lag_seconds'] = (now - oldest_due).total_seconds() if oldest_due else 0.0
+
+    return stats
@@ -0,0 +1,152 @@
+"""
+Server-Sent Events stream telling users about new mail.
+
+This is a plain ASGI application rather than a Django view: Django 2.2 can
+only serve a streaming response by holding a worker thread for as long as the
+client stays connected, while here an idle connection costs one coroutine and
+one queue. reply/asgi.py serves it next to the rest of the API.
+
+Events only say that something arrived. Clients then call /emails/sync/ to
+fetch it, and sync again after reconnecting to catch anything missed.
+"""
+import asyncio
+import json
+from urllib.parse import parse_qs
+
+import jwt
+from django.conf import settings
+from django.db import close_old_connections
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_jwt.settings import api_settings
+
+from emails.authentication import CachedJSONWebTokenAuthentication
+from emails.handlers import run_sync
+from emails.pubsub import get_broker
+
+EVENTS_PATH = '/emails/events/'
+
+
+def get_token(scope: dict):
+    """
+    Read the JWT from the Authorization header, or from the `token` query
+    parameter since browsers' EventSource cannot set headers
+    """
+
+    prefix = api_settings.JWT_AUTH_HEADER_PREFIX.lower()
+
+    for name, value in scope['headers']:
+        if name == b'authorization':
+            parts = value.decode('latin-1').split()
+            if len(parts) == 2 and parts[0].lower() == prefix:
+                return parts[1]
+
+    token = parse_qs(scope.get('query_string', b'').decode()).get('token')
+    return token[0] if token else None
+
+
+def authenticate(token: str):
+    """
+    Return the user the token belongs to, or None
+    """
+
+    try:
+        payload = api_settings.JWT_DECODE_HANDLER(token)
+        return CachedJSONWebTokenAuthentication().authenticate_credentials(payload)
+    except (jwt.InvalidTokenError, AuthenticationFailed):
+        return None
+    finally:
+        close_old_connections()
+
+
+async def respond(send, status: int, body: bytes) -> None:
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'text/plain; charset=utf-8')],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def format_event(event: dict) -> bytes:
+    data = json.dumps(event, separators=(',', ':'))
+    return 'event: {}\ndata: {}\n\n'.format(event.get('event', 'message'), data).encode()
+
+
+async def stream(user, receive, send) -> None:
+    broker = get_broker()
+    await broker.start()
+    queue = broker.subscribe(user.id)
+
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                # Stop proxies such as nginx from buffering the stream
+                (b'x-accel-buffering', b'no'),
+            ],
+        })
+        await send({
+            'type': 'http.response.body',
+            'body': 'retry: {}\n\n'.format(settings.MAILBOX_EVENTS_RETRY * 1000).encode(),
+            'more_body': True,
+        })
+
+        disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+
+        try:
+            while not disconnected.done():
+                next_event = asyncio.ensure_future(queue.get())
+                done, _ = await asyncio.wait(
+                    [next_event, disconnected],
+                    timeout=settings.MAILBOX_EVENTS_HEARTBEAT,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+
+                if next_event in done:
+                    body = format_event(next_event.result())
+                else:
+                    next_event.cancel()
+                    if disconnected in done:
+                        break
+                    # Keeps idle connections from being closed along the way
+                    body = b': ping\n\n'
+
+                await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+        finally:
+            disconnected.cancel()
+    finally:
+        broker.unsubscribe(user.id, queue)
+
+
+async def wait_for_disconnect(receive) -> None:
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def application(scope, receive, send) -> None:
+    if scope['type'] != 'http':
+        return
+
+    if scope['path'] != EVENTS_PATH:
+        await respond(send, 404, b'Not found')
+        return
+
+    if scope['method'] != 'GET':
+        await respond(send, 405, b'Method not allowed')
+        return
+
+    token = get_token(scope)
+    user = None
+    if token:
+        user = await run_sync(authenticate, token)
+
+    if user is None:
+        await respond(send, 401, b'Authentication credentials were not provided or are invalid')
+        return
+
+    await stream(user, receive, send)
@@ -0,0 +1,166 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import BooleanField, Case, Q, QuerySet, Value, When
+
+from rest_framework.exceptions import ValidationError
+from rest_framework.request import Request
+
+from emails.blobs import release_attachments
+from emails.changes import mailbox_changed
+from emails.models import DeliveryJob, Email, FolderCounter, Mailbox, MailboxChange
+from emails.pagination import KeysetPagination
+
+STARRED = FolderCounter.STARRED
+
+
+def parse_email_ids(request: Request) -> list:
+    """
+    Parse the comma separated `email_id` query parameter into a list of ints
+    """
+
+    raw = request.query_params.get('email_id', '')
+
+    try:
+        email_ids = [int(email_id) for email_id in raw.split(',') if email_id.strip()]
+    except ValueError:
+        raise ValidationError({'email_id': 'Must be a comma separated list of ids.'})
+
+    if not email_ids:
+        raise ValidationError({'email_id': 'This field is required.'})
+
+    # Keep the request order but drop duplicates
+    return list(dict.fromkeys(email_ids))
+
+
+def participant_q(user: User, prefix: str = '') -> Q:
+    """
+    Filter for emails `user` sent or received. `prefix` points the lookups
+    at a related email, e.g. 'email__'. Filtering on recipients can repeat
+    rows, so callers need distinct().
+    """
+
+    return Q(**{prefix + 'sender': user})\
+        | Q(**{prefix + 'receiver': user})\
+        | Q(**{prefix + 'recipients__user': user})
+
+
+def folder_rows(user: User, folder: str) -> QuerySet:
+    """
+    The user's mailbox rows in `folder`. Starred is a view across every
+    folder rather than a folder of its own.
+    """
+
+    if folder == STARRED:
+        return Mailbox.objects.filter(user=user, starred=True)
+
+    if folder not in dict(Mailbox.FOLDER_CHOICES):
+        raise ValidationError({'folder': 'Must be one of inbox, sent, trash or starred.'})
+
+    return Mailbox.objects.filter(user=user, folder=folder)
+
+
+def lock_rows(rows: QuerySet) -> list:
+    """
+    Lock mailbox `rows` and return the fields the counters and change log
+    are kept from
+    """
+
+    return list(rows.select_for_update().values('email_id', 'user_id', 'folder', 'starred', 'read'))
+
+
+def mark_read(user: User, read: bool, email_ids: list = None, folder: str = Mailbox.INBOX, before: str = None) -> int:
+    """
+    Set the user's read flag on the given emails, or on every row of
+    `folder` from listing cursor `before` onwards. The rows change in a
+    single UPDATE. Returns the number of rows changed.
+    """
+
+    if email_ids is not None:
+        rows = Mailbox.objects.filter(user=user, email_id__in=email_ids)
+    elif before:
+        rows = folder_rows(user, folder).filter(KeysetPagination().cursor_q(before))
+    else:
+        raise ValidationError({'email_id': 'Pass email_id or before.'})
+
+    rows = rows.exclude(read=read)
+
+    with transaction.atomic():
+        found = lock_rows(rows)
+        rows.update(read=read)
+        mailbox_changed(MailboxChange.READ, found, [dict(row, read=read) for row in found])
+
+    return len(found)
+
+
+def move_emails(user: User, email_ids: list, source: str, target: str) -> list:
+    """
+    Move emails from one of the user's folders to another.
+    Returns the ids that were not found in the source folder.
+    """
+
+    with transaction.atomic():
+        rows = Mailbox.objects.filter(user=user, folder=source, email_id__in=email_ids)
+        found = lock_rows(rows)
+        rows.update(folder=target)
+        mailbox_changed(MailboxChange.MOVE, found, [dict(row, folder=target) for row in found])
+
+    found = {row['email_id'] for row in found}
+    return [email_id for email_id in email_ids if email_id not in found]
+
+
+def purge_emails(user: User, email_ids: list, folder: str) -> list:
+    """
+    Remove emails from one of the user's folders for good.
+    Returns the ids that were not found in the folder.
+    """
+
+    with transaction.atomic():
+        rows = Mailbox.objects.filter(user=user, folder=folder, email_id__in=email_ids)
+        found = lock_rows(rows)
+        rows.delete()
+        mailbox_changed(MailboxChange.PURGE, found, [])
+
+        found = {row['email_id'] for row in found}
+        delete_orphaned_emails(found)
+
+    return [email_id for email_id in email_ids if email_id not in found]
+
+
+def toggle_starred(user: User, email_ids: list) -> list:
+    """
+    Star the given emails that are not starred yet and unstar the rest.
+    Returns the ids that are not in any of the user's folders.
+    """
+
+    with transaction.atomic():
+        rows = Mailbox.objects.filter(user=user, email_id__in=email_ids)
+        found = lock_rows(rows)
+        rows.update(starred=Case(
+            When(starred=True, then=Value(False)),
+            default=Value(True),
+            output_field=BooleanField(),
+        ))
+        mailbox_changed(MailboxChange.STAR, found, [dict(row, starred=not row['starred']) for row in found])
+
+    found = {row['email_id'] for row in found}
+    return [email_id for email_id in email_ids if email_id not in found]
+
+
+def delete_orphaned_emails(email_ids) -> None:
+    """
+    Delete the emails in `email_ids` that no longer sit in anyone's folders,
+    releasing their attachments
+    """
+
+    # An email still waiting for delivery has mailboxes to come. One whose
+    # delivery failed for good never gets any.
+    orphans = list(
+        Email.objects
+        .filter(id__in=email_ids, mailboxes__isnull=True)
+        .exclude(delivery__state=DeliveryJob.PENDING)
+        .values_list('id', flat=True)
+    )
+
+    if orphans:
+        release_attachments(orphans)
+        Email.objects.filter(id__in=orphans).delete()
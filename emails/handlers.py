@@ -0,0 +1,366 @@
+"""
+Serve the Django API from an ASGI server.
+
+Django 2.2 has no async views, so each request still runs Django's ordinary
+WSGI handler on a thread. What changes is when a thread is taken: up to
+FILE_UPLOAD_MAX_MEMORY_SIZE of the request body is received on the event loop
+first, so a slow client sending an ordinary request holds no thread while its
+bytes trickle in, and the response is written back on the event loop, so a
+slow reader holds none either. Threads come from one pool of ASGI_THREADS,
+which also bounds how many requests can wait on the database or storage at
+the same time.
+
+A larger body with a Content-Length is not buffered. The view's thread pulls
+the rest of it from the event loop as it reads, so attachments stream to
+storage through StreamingUploadHandler just as they do under WSGI. Chunked
+bodies of unknown length are spooled to a temporary file first.
+"""
+import asyncio
+import io
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIHandler
+
+
+@lru_cache(maxsize=None)
+def get_executor() -> ThreadPoolExecutor:
+    """
+    Return the process wide pool that runs Django code for async callers
+    """
+
+    return ThreadPoolExecutor(max_workers=settings.ASGI_THREADS, thread_name_prefix='asgi')
+
+
+@lru_cache(maxsize=None)
+def get_handler() -> WSGIHandler:
+    return WSGIHandler()
+
+
+async def run_sync(func, *args):
+    """
+    Run blocking Django code, such as anything that touches the database,
+    on the shared pool
+    """
+
+    return await asyncio.get_event_loop().run_in_executor(get_executor(), func, *args)
+
+
+def build_environ(scope: dict, body) -> dict:
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        # WSGI carries paths as latin-1 decoded bytes
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+
+        if name in environ:
+            value = environ[name] + ',' + value
+
+        environ[name] = value
+
+    # A body received in full has its own length, whether or not it was sent
+    # chunked. A streamed body keeps the Content-Length it was sent with.
+    if not isinstance(body, StreamedBody):
+        body.seek(0, 2)
+        environ['CONTENT_LENGTH'] = str(body.tell())
+        body.seek(0)
+
+    return environ
+
+
+class RequestTooLarge(Exception):
+    pass
+
+
+class ClientDisconnected(IOError):
+    """
+    The client went away, or stopped sending, before the body was complete.
+    Django turns it into UnreadablePostError.
+    """
+
+
+class StreamedBody(io.RawIOBase):
+    """
+    wsgi.input for a view running on a pool thread: the part of the body
+    received already, followed by the rest pulled from the event loop as the
+    view reads it
+    """
+
+    def __init__(self, head: bytes, receive, loop):
+        super().__init__()
+        self.buffer = bytearray(head)
+        self.more_body = True
+        self.disconnected = False
+        self.receive = receive
+        self.loop = loop
+
+    def readable(self) -> bool:
+        return True
+
+    def fill(self) -> bool:
+        """
+        Wait for the next chunk. Returns False once the body is complete.
+        """
+
+        if not self.more_body:
+            return False
+
+        future = asyncio.run_coroutine_threadsafe(self.receive(), self.loop)
+
+        try:
+            message = future.result(settings.ASGI_BODY_TIMEOUT)
+        except FutureTimeoutError:
+            future.cancel()
+            self.more_body = False
+            raise ClientDisconnected("No request body received for {}s".format(settings.ASGI_BODY_TIMEOUT))
+
+        if message['type'] == 'http.disconnect':
+            self.more_body = False
+            self.disconnected = True
+            raise ClientDisconnected("Client disconnected")
+
+        self.buffer += message.get('body', b'')
+        self.more_body = message.get('more_body', False)
+
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        while (size is None or size < 0 or len(self.buffer) < size) and self.fill():
+            pass
+
+        return self.take(len(self.buffer) if size is None or size < 0 else size)
+
+    def readline(self, size: int = -1) -> bytes:
+        while b'\n' not in self.buffer and (size is None or size < 0 or len(self.buffer) < size) and self.fill():
+            pass
+
+        end = self.buffer.find(b'\n') + 1 or len(self.buffer)
+        if size is not None and size >= 0:
+            end = min(end, size)
+
+        return self.take(end)
+
+    def take(self, size: int) -> bytes:
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+
+        return data
+
+
+async def receive_head(receive, limit: int):
+    """
+    Receive the body until it ends or more than `limit` bytes have come.
+    Returns what came and whether there is more, or None if the client went
+    away first.
+    """
+
+    head = bytearray()
+    more_body = True
+
+    while more_body and len(head) <= limit:
+        message = await receive()
+
+        if message['type'] == 'http.disconnect':
+            return None
+
+        head += message.get('body', b'')
+        more_body = message.get('more_body', False)
+
+    return bytes(head), more_body
+
+
+async def receive_body(receive, head: bytes = b''):
+    """
+    Read the rest of the request body into a spooled file, after `head`, or
+    return None if the client went away first
+    """
+
+    body = tempfile.SpooledTemporaryFile(max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+    body.write(head)
+    size = len(head)
+    more_body = True
+
+    while more_body:
+        message = await receive()
+
+        if message['type'] == 'http.disconnect':
+            body.close()
+            return None
+
+        chunk = message.get('body', b'')
+        size += len(chunk)
+
+        if size > settings.ASGI_MAX_BODY_SIZE:
+            body.close()
+            raise RequestTooLarge()
+
+        body.write(chunk)
+        more_body = message.get('more_body', False)
+
+    return body
+
+
+def start_request(environ: dict):
+    """
+    Run the view. Returns the status, the headers and either the whole body or,
+    for streaming responses, the iterator producing it.
+    """
+
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+    response = get_handler()(environ, start_response)
+
+    if getattr(response, 'streaming', False):
+        return started['status'], started['headers'], response
+
+    try:
+        return started['status'], started['headers'], b''.join(response)
+    finally:
+        # Fires request_finished, which releases the database connection of
+        # the thread it runs on, so do it on the thread the view used
+        response.close()
+
+
+def next_chunk(chunks):
+    return next(chunks, None)
+
+
+async def lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+def content_length(scope: dict):
+    """
+    The Content-Length header as an int, or None if it is missing or invalid
+    """
+
+    for name, value in scope.get('headers', []):
+        if name.lower() == b'content-length':
+            try:
+                return int(value)
+            except ValueError:
+                return None
+
+    return None
+
+
+async def respond(send, status: int, body: bytes) -> None:
+    await send({'type': 'http.response.start', 'status': status, 'headers': [(b'content-type', b'text/plain')]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def open_body(scope: dict, receive):
+    """
+    wsgi.input for the request: the whole body if it is small or of unknown
+    length, otherwise a StreamedBody. None if the client went away.
+    """
+
+    length = content_length(scope)
+
+    if length is not None and length > settings.ASGI_MAX_BODY_SIZE:
+        raise RequestTooLarge()
+
+    received = await receive_head(receive, settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+
+    if received is None:
+        return None
+
+    head, more_body = received
+
+    if len(head) > settings.ASGI_MAX_BODY_SIZE:
+        raise RequestTooLarge()
+
+    if not more_body:
+        return io.BytesIO(head)
+
+    if length is None:
+        return await receive_body(receive, head)
+
+    return StreamedBody(head, receive, asyncio.get_event_loop())
+
+
+async def django_application(scope, receive, send) -> None:
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+
+    if scope['type'] != 'http':
+        return
+
+    try:
+        body = await open_body(scope, receive)
+    except RequestTooLarge:
+        await respond(send, 413, b'Request body too large')
+        return
+
+    if body is None:
+        return
+
+    try:
+        status, headers, content = await run_sync(start_request, build_environ(scope, body))
+    finally:
+        body.close()
+
+    if getattr(body, 'disconnected', False):
+        # Nobody is left to answer
+        if not isinstance(content, bytes):
+            await run_sync(content.close)
+        return
+
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+
+    if isinstance(content, bytes):
+        await send({'type': 'http.response.body', 'body': content})
+        return
+
+    chunks = iter(content)
+
+    try:
+        while True:
+            chunk = await run_sync(next_chunk, chunks)
+            if chunk is None:
+                break
+
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        await run_sync(content.close)
@@ -0,0 +1,84 @@
+"""
+Concurrent load for the benchmark commands.
+
+Each worker thread gets its own request function from a factory, so it can
+keep its own connection open, and calls it until the shared request budget
+is spent. Latencies are kept per request so percentiles are exact.
+"""
+import math
+import threading
+import time
+
+
+class LoadResult:
+    def __init__(self, latencies: list, errors: int, seconds: float):
+        self.latencies = sorted(latencies)
+        self.errors = errors
+        self.seconds = seconds
+
+    @property
+    def requests(self) -> int:
+        return len(self.latencies)
+
+    @property
+    def throughput(self) -> float:
+        return self.requests / self.seconds if self.seconds else 0.0
+
+    def percentile(self, p: float) -> float:
+        """
+        Latency in seconds that `p` percent of requests stayed within
+        """
+
+        if not self.latencies:
+            return 0.0
+
+        rank = max(math.ceil(p / 100 * len(self.latencies)), 1)
+        return self.latencies[rank - 1]
+
+
+def run_load(request_factory, concurrency: int, total: int) -> LoadResult:
+    """
+    Make `total` requests from `concurrency` threads. `request_factory()` is
+    called once per thread and returns a function that makes one request and
+    returns True if it succeeded.
+    """
+
+    remaining = [total]
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def worker():
+        make_request = request_factory()
+        mine = []
+        failed = 0
+
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+
+            start = time.perf_counter()
+            try:
+                ok = make_request()
+            except Exception:
+                ok = False
+            mine.append(time.perf_counter() - start)
+
+            if not ok:
+                failed += 1
+
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    start = time.perf_counter()
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return LoadResult(latencies, errors[0], time.perf_counter() - start)
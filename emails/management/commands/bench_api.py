@@ -0,0 +1,321 @@
+import io
+import json
+import random
+import shutil
+import tempfile
+import threading
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Max, Q
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework_jwt.settings import api_settings
+
+from emails.authentication import get_user_cache
+from emails.blobs import release_attachments
+from emails.loadgen import run_load
+from emails.models import Attachment, Blob, Email, Mailbox
+from emails.presign import get_url_cache, presigned_url
+from emails.seed import seed_mailboxes
+from emails.storage import get_storage
+from emails.versions import get_response_cache
+
+PREFIX = 'benchapi'
+
+# Admin only endpoints, called as the seeded staff user
+STAFF_ENDPOINTS = {'attachments cache-stats'}
+
+# Most queries a single request may make, and the p99 latency in ms it must
+# stay within. Query counts include the user lookup of a cold auth cache.
+BUDGETS = {
+    'registration': {'queries': 12, 'p99_ms': 1000},
+    'token-auth': {'queries': 4, 'p99_ms': 1000},
+    'api-token-verify': {'queries': 2, 'p99_ms': 250},
+    'current-user': {'queries': 2, 'p99_ms': 250},
+    'inbox list': {'queries': 3, 'p99_ms': 250},
+    'inbox send': {'queries': 24, 'p99_ms': 1000},
+    'inbox mark read': {'queries': 10, 'p99_ms': 250},
+    'inbox to trash': {'queries': 10, 'p99_ms': 250},
+    'sent list': {'queries': 3, 'p99_ms': 250},
+    'starred list': {'queries': 3, 'p99_ms': 250},
+    'starred toggle': {'queries': 10, 'p99_ms': 250},
+    'trash list': {'queries': 3, 'p99_ms': 250},
+    'trash restore': {'queries': 10, 'p99_ms': 250},
+    'message': {'queries': 3, 'p99_ms': 250},
+    'read': {'queries': 10, 'p99_ms': 250},
+    'counters': {'queries': 2, 'p99_ms': 250},
+    'search': {'queries': 3, 'p99_ms': 500},
+    'sync': {'queries': 5, 'p99_ms': 250},
+    'attachments': {'queries': 3, 'p99_ms': 250},
+    'attachments batch': {'queries': 3, 'p99_ms': 250},
+    'attachments cache-stats': {'queries': 1, 'p99_ms': 250},
+    'attachments download': {'queries': 0, 'p99_ms': 250},
+    'sent purge': {'queries': 12, 'p99_ms': 500},
+    'trash purge': {'queries': 12, 'p99_ms': 500},
+}
+
+_local = threading.local()
+
+
+def rng() -> random.Random:
+    # One generator per thread, so workers do not share state
+    if not hasattr(_local, 'rng'):
+        _local.rng = random.Random(threading.get_ident())
+
+    return _local.rng
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a dataset, drive every API endpoint under concurrent load and check query and latency budgets. "
+        "Seeded data is committed while the run lasts, so point this at a development database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20)
+        parser.add_argument('--emails', type=int, default=200, help="Emails sent per user")
+        parser.add_argument('--attachments', type=int, default=1, help="Attachments per email")
+        parser.add_argument(
+            '--concurrency', type=int,
+            help="Requests in flight at once; defaults to 8, or 1 on SQLite, which allows one writer",
+        )
+        parser.add_argument('--requests', type=int, default=200, help="Requests per endpoint")
+        parser.add_argument('--only', action='append', help="Run only this endpoint; repeat for several")
+        parser.add_argument('--budgets', help="JSON file of budgets overriding the built in ones, by endpoint name")
+        parser.add_argument('--json', help="Also write the results to this file")
+
+    def handle(self, *args, **options):
+        budgets = dict(BUDGETS)
+        if options['budgets']:
+            with open(options['budgets']) as f:
+                for name, budget in json.load(f).items():
+                    budgets[name] = dict(budgets.get(name, {}), **budget)
+
+        if options['concurrency'] is None:
+            options['concurrency'] = 1 if connection.vendor == 'sqlite' else 8
+        elif options['concurrency'] > 1 and connection.vendor == 'sqlite':
+            self.stderr.write("SQLite allows one writer; concurrent writes may fail with 'database is locked'")
+
+        if User.objects.filter(username__startswith=PREFIX).exists():
+            raise CommandError("Users named {}* already exist; remove them first".format(PREFIX))
+
+        location = tempfile.mkdtemp(prefix='bench-api-')
+        storage = {'BACKEND': 'emails.storage.LocalStorage', 'OPTIONS': {'location': location}}
+
+        try:
+            with override_settings(ATTACHMENT_STORAGE=storage, ATTACHMENT_UPLOAD_WORKERS=0, DELIVERY_QUEUE=True):
+                self.reset_caches()
+                results = self.run(options)
+        finally:
+            self.reset_caches()
+            shutil.rmtree(location, ignore_errors=True)
+
+        failures = self.report(results, budgets)
+
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+        if failures:
+            raise CommandError("{} budget(s) exceeded:\n{}".format(len(failures), '\n'.join(failures)))
+
+        self.stdout.write(self.style.SUCCESS("All endpoints are within budget"))
+
+    def reset_caches(self):
+        get_storage.cache_clear()
+        get_url_cache().clear()
+        get_response_cache().clear()
+        get_user_cache().clear()
+
+    def run(self, options) -> dict:
+        first_blob = Blob.objects.aggregate(last=Max('id'))['last'] or 0
+
+        try:
+            users = seed_mailboxes(options['users'], options['emails'], options['attachments'], prefix=PREFIX)
+            users[0].is_staff = True
+            users[0].save()
+            self.context = self.build_context(users)
+
+            results = {}
+            for name, method, request in self.endpoints():
+                if options['only'] and name not in options['only']:
+                    continue
+
+                self.stdout.write("{}...".format(name), ending='\r')
+                self.stdout.flush()
+                users = self.context['users'][:1] if name in STAFF_ENDPOINTS else self.context['users']
+                results[name] = self.drive(method, request, users, options['concurrency'], options['requests'])
+
+            return results
+        finally:
+            self.remove_dataset(first_blob)
+
+    def build_context(self, users: list) -> dict:
+        user_ids = [user.id for user in users]
+        rows = Mailbox.objects.filter(user_id__in=user_ids).values_list('user_id', 'email_id', 'folder')
+
+        context = {
+            'users': users,
+            'tokens': {user.id: api_settings.JWT_ENCODE_HANDLER(api_settings.JWT_PAYLOAD_HANDLER(user)) for user in users},
+            'emails': {user_id: {folder: [] for folder, _ in Mailbox.FOLDER_CHOICES} for user_id in user_ids},
+            'registrations': iter(range(10 ** 9)),
+            'lock': threading.Lock(),
+        }
+        for user_id, email_id, folder in rows:
+            context['emails'][user_id][folder].append(email_id)
+
+        # Seeded attachments share one blob, which has to exist to be downloaded
+        attachment = Attachment.objects.filter(email__sender=users[0]).first()
+        if attachment is not None:
+            get_storage().save(io.BytesIO(b''), attachment.object_name)
+            context['download'] = presigned_url(attachment.object_name, attachment.name, users[0].id)
+
+        return context
+
+    def endpoints(self) -> list:
+        """
+        (name, method, request) for every API endpoint but the admin site, with
+        the ones that delete data last. `request(user)` returns the path
+        and the request body.
+        """
+
+        context = self.context
+
+        def email_id(user, folder=Mailbox.INBOX):
+            return rng().choice(context['emails'][user.id][folder] or [0])
+
+        def new_username():
+            with context['lock']:
+                return '{}reg{}'.format(PREFIX, next(context['registrations']))
+
+        def register():
+            return {
+                'first_name': 'Bench',
+                'last_name': 'User',
+                'username': new_username(),
+                'password': 'benchmark',
+                'confirm': 'benchmark',
+            }
+
+        def login(user):
+            return {'username': user.username, 'password': 'benchmark'}
+
+        def send(user):
+            recipient = rng().choice(context['users'])
+            email = json.dumps({'subject': 'bench', 'message': 'load test', 'to': [recipient.username]})
+            attachment = io.BytesIO(b'attachment %d' % rng().randrange(10))
+            attachment.name = 'bench.txt'
+            return {'email': email, 'attachments': attachment}
+
+        return [
+            ('registration', 'post', lambda user: ('/emails/registration/', register())),
+            ('token-auth', 'post', lambda user: ('/emails/token-auth/', login(user))),
+            ('api-token-verify', 'post', lambda user: ('/emails/api-token-verify/', {'token': context['tokens'][user.id]})),
+            ('current-user', 'get', lambda user: ('/emails/current-user/', None)),
+            ('inbox list', 'get', lambda user: ('/emails/inbox/', None)),
+            ('inbox send', 'post', lambda user: ('/emails/inbox/', send(user))),
+            ('inbox mark read', 'put', lambda user: ('/emails/inbox/?email_id={}'.format(email_id(user)), {'read': True})),
+            ('sent list', 'get', lambda user: ('/emails/sent/', None)),
+            ('starred list', 'get', lambda user: ('/emails/starred/', None)),
+            ('starred toggle', 'post', lambda user: ('/emails/starred/?email_id={}'.format(email_id(user)), None)),
+            ('message', 'get', lambda user: ('/emails/message/?email_id={}'.format(email_id(user)), None)),
+            ('read', 'patch', lambda user: ('/emails/read/?email_id={}'.format(email_id(user)), {'read': False})),
+            ('counters', 'get', lambda user: ('/emails/counters/', None)),
+            ('search', 'get', lambda user: ('/emails/search/?q=budget+report', None)),
+            ('sync', 'get', lambda user: ('/emails/sync/', None)),
+            ('attachments', 'get', lambda user: ('/emails/attachments/?email_id={}'.format(email_id(user)), None)),
+            ('attachments batch', 'get', lambda user: ('/emails/attachments/batch/?email_id={}'.format(
+                ','.join(str(email_id(user)) for _ in range(10))), None)),
+            ('attachments cache-stats', 'get', lambda user: ('/emails/attachments/cache-stats/', None)),
+            ('attachments download', 'get', lambda user: (context.get('download', '/emails/attachments/download/x/'), None)),
+            ('inbox to trash', 'delete', lambda user: ('/emails/inbox/?email_id={}'.format(email_id(user)), None)),
+            ('trash list', 'get', lambda user: ('/emails/trash/', None)),
+            ('trash restore', 'patch', lambda user: ('/emails/trash/?email_id={}'.format(email_id(user)), None)),
+            ('sent purge', 'delete', lambda user: ('/emails/sent/?email_id={}'.format(email_id(user, Mailbox.SENT)), None)),
+            ('trash purge', 'delete', lambda user: ('/emails/trash/?email_id={}'.format(email_id(user)), None)),
+        ]
+
+    def drive(self, method: str, request, users: list, concurrency: int, total: int) -> dict:
+        queries = []
+        statuses = {}
+        lock = threading.Lock()
+
+        def request_factory():
+            client = Client()
+
+            def make_request() -> bool:
+                user = rng().choice(users)
+                path, data = request(user)
+                headers = {'HTTP_AUTHORIZATION': '{} {}'.format(api_settings.JWT_AUTH_HEADER_PREFIX, self.context['tokens'][user.id])}
+
+                if data is None:
+                    kwargs = {}
+                elif any(hasattr(value, 'read') for value in data.values()):
+                    kwargs = {'data': data}
+                else:
+                    kwargs = {'data': json.dumps(data), 'content_type': 'application/json'}
+
+                with CaptureQueriesContext(connection) as captured:
+                    response = getattr(client, method)(path, **kwargs, **headers)
+
+                with lock:
+                    queries.append(len(captured))
+                    statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+                # A missing or already moved email is a valid answer under load
+                return response.status_code < 400 or response.status_code == 404
+
+            return make_request
+
+        result = run_load(request_factory, concurrency, total)
+
+        return {
+            'requests': result.requests,
+            'errors': result.errors,
+            'throughput': round(result.throughput, 1),
+            'p50_ms': round(result.percentile(50) * 1000, 1),
+            'p90_ms': round(result.percentile(90) * 1000, 1),
+            'p99_ms': round(result.percentile(99) * 1000, 1),
+            'queries_max': max(queries, default=0),
+            'queries_mean': round(sum(queries) / len(queries), 1) if queries else 0,
+            'statuses': {str(code): count for code, count in sorted(statuses.items())},
+        }
+
+    def report(self, results: dict, budgets: dict) -> list:
+        failures = []
+
+        self.stdout.write("{:<24} {:>8} {:>8} {:>8} {:>8} {:>8} {:>9} {:>7}".format(
+            'endpoint', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'queries', 'max q', 'errors'
+        ))
+
+        for name, result in results.items():
+            self.stdout.write("{:<24} {:>8} {:>8} {:>8} {:>8} {:>8} {:>9} {:>7}".format(
+                name, result['throughput'], result['p50_ms'], result['p90_ms'], result['p99_ms'],
+                result['queries_mean'], result['queries_max'], result['errors'],
+            ))
+
+            budget = budgets.get(name, {})
+            if result['errors']:
+                failures.append("{}: {} failed request(s), statuses {}".format(name, result['errors'], result['statuses']))
+            if 'queries' in budget and result['queries_max'] > budget['queries']:
+                failures.append("{}: {} queries in one request, budget {}".format(name, result['queries_max'], budget['queries']))
+            if 'p99_ms' in budget and result['p99_ms'] > budget['p99_ms']:
+                failures.append("{}: p99 {} ms, budget {} ms".format(name, result['p99_ms'], budget['p99_ms']))
+
+        return failures
+
+    def remove_dataset(self, first_blob: int) -> None:
+        users = User.objects.filter(username__startswith=PREFIX)
+
+        with transaction.atomic():
+            email_ids = list(
+                Email.objects
+                .filter(Q(sender__in=users) | Q(receiver__in=users))
+                .values_list('id', flat=True)
+            )
+            release_attachments(email_ids)
+            Email.objects.filter(id__in=email_ids).delete()
+            users.delete()
+            Blob.objects.filter(id__gt=first_blob, refcount=0).delete()
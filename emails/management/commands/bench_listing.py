@@ -0,0 +1,98 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count
+
+from rest_framework.renderers import JSONRenderer
+
+from emails.counters import update_counters
+from emails.listing import LIST_VALUES, FastJSONRenderer, list_rows
+from emails.models import Email, Mailbox
+from emails.seed import Rollback, seed_mailboxes
+from emails.serializers import EmailListSerializer
+
+# Text the JSON encoders are most likely to disagree on
+AWKWARD_TEXT = (
+    'quotes " and \\ backslash',
+    'line\nbreak\ttab\x01control',
+    'unicode caf\u00e9 \u65e5\u672c \U0001f4e7 and separators \u2028 \u2029',
+)
+
+
+class Command(BaseCommand):
+    help = "Time folder listing serialization through DRF and through the fast path, and check the bytes match"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10)
+        parser.add_argument('--emails', type=int, default=1000, help="Emails sent per user")
+        parser.add_argument('--rows', type=int, default=1000, help="Rows on the benchmarked page")
+        parser.add_argument('--repeat', type=int, default=5, help="Runs per path; the best is reported")
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                seed_mailboxes(options['users'], options['emails'], prefix='benchlisting')
+                user_id = Mailbox.objects\
+                    .filter(user__username__startswith='benchlisting', folder=Mailbox.INBOX)\
+                    .values('user_id')\
+                    .annotate(rows=Count('id'))\
+                    .order_by('-rows')[0]['user_id']
+                self.add_awkward_rows(user_id)
+
+                rows = Mailbox.objects\
+                    .filter(user_id=user_id, folder=Mailbox.INBOX, email__isnull=False)\
+                    .order_by('-created_at', '-id')[:options['rows']]
+
+                results = {}
+                for name, run in (('serializer', self.serializer_path), ('fast path', self.fast_path)):
+                    results[name] = self.best_of(options['repeat'], run, rows)
+
+                raise Rollback()
+        except Rollback:
+            pass
+
+        (slow_body, slow_time), (fast_body, fast_time) = results['serializer'], results['fast path']
+
+        for name, (body, seconds) in results.items():
+            self.stdout.write("{:<10} {:8.2f} ms  {} bytes".format(name, seconds * 1000, len(body)))
+
+        if slow_body != fast_body:
+            raise CommandError("The fast path output differs from the serializer output")
+
+        self.stdout.write(self.style.SUCCESS(
+            "Output is identical; the fast path takes {:.0%} of the serializer's time".format(fast_time / slow_time)
+        ))
+
+    def add_awkward_rows(self, user_id: int) -> None:
+        emails = [Email.objects.create(subject=text, message=text, sender=None, receiver_id=user_id) for text in AWKWARD_TEXT]
+        Mailbox.objects.bulk_create([
+            Mailbox(user_id=user_id, email=email, folder=Mailbox.INBOX, starred=True) for email in emails
+        ])
+        update_counters([(user_id, Mailbox.INBOX, len(emails), len(emails))])
+
+    def best_of(self, repeat: int, run, rows):
+        best = None
+
+        for _ in range(repeat):
+            start = time.perf_counter()
+            body = run(rows)
+            elapsed = time.perf_counter() - start
+
+            if best is None or elapsed < best[1]:
+                best = (body, elapsed)
+
+        return best
+
+    def serializer_path(self, rows) -> bytes:
+        memberships = list(rows.select_related('email__sender', 'email__receiver').defer('email__message'))
+
+        for row in memberships:
+            row.email.read = row.read
+            row.email.starred = row.starred
+
+        serializer = EmailListSerializer([row.email for row in memberships], many=True)
+        return JSONRenderer().render({'inbox': serializer.data, 'next': None})
+
+    def fast_path(self, rows) -> bytes:
+        return FastJSONRenderer().render({'inbox': list_rows(list(rows.values_list(*LIST_VALUES))), 'next': None})
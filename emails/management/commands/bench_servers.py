@@ -0,0 +1,91 @@
+import http.client
+import json
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+
+from rest_framework_jwt.settings import api_settings
+
+from emails.loadgen import run_load
+
+
+class Command(BaseCommand):
+    help = "Compare requests/sec and latency of the WSGI and ASGI servers under the same concurrent load"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--wsgi', default='http://127.0.0.1:8000', help="Base url of the WSGI server (gunicorn)")
+        parser.add_argument('--asgi', default='http://127.0.0.1:8001', help="Base url of the ASGI server (uvicorn)")
+        parser.add_argument(
+            '--path', action='append', dest='paths',
+            help="Path to request; repeat for several. Defaults to the inbox and the attachment batch.",
+        )
+        parser.add_argument('--username', required=True)
+        parser.add_argument('--password', required=True)
+        parser.add_argument('--concurrency', type=int, default=50)
+        parser.add_argument('--requests', type=int, default=2000, help="Requests per path and server")
+
+    def handle(self, *args, **options):
+        paths = options['paths'] or ['/emails/inbox/', '/emails/attachments/batch/?email_id=1']
+
+        self.stdout.write("{:<6} {:<40} {:>9} {:>9} {:>9} {:>7}".format(
+            'server', 'path', 'req/s', 'p50 ms', 'p99 ms', 'errors'
+        ))
+
+        for name in ('wsgi', 'asgi'):
+            base = urlsplit(options[name])
+            token = self.get_token(base, options['username'], options['password'])
+
+            for path in paths:
+                result = run_load(
+                    lambda: self.request_function(base, path, token),
+                    options['concurrency'],
+                    options['requests'],
+                )
+                self.stdout.write("{:<6} {:<40} {:>9.1f} {:>9.1f} {:>9.1f} {:>7}".format(
+                    name, path, result.throughput,
+                    result.percentile(50) * 1000, result.percentile(99) * 1000, result.errors,
+                ))
+
+    def connect(self, base):
+        connection_class = http.client.HTTPSConnection if base.scheme == 'https' else http.client.HTTPConnection
+        return connection_class(base.hostname, base.port, timeout=30)
+
+    def get_token(self, base, username: str, password: str) -> str:
+        connection = self.connect(base)
+
+        try:
+            body = json.dumps({'username': username, 'password': password})
+            connection.request('POST', '/emails/token-auth/', body, {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            data = response.read()
+        except OSError as e:
+            raise CommandError("Could not reach {}: {}".format(base.geturl(), e))
+        finally:
+            connection.close()
+
+        if response.status != 200:
+            raise CommandError("Could not log in at {}: {} {}".format(base.geturl(), response.status, data[:200]))
+
+        return json.loads(data)['token']
+
+    def request_function(self, base, path: str, token: str):
+        """
+        Return a function making one request over a kept-alive connection
+        """
+
+        headers = {'Authorization': '{} {}'.format(api_settings.JWT_AUTH_HEADER_PREFIX, token)}
+        connection = [self.connect(base)]
+
+        def make_request() -> bool:
+            try:
+                connection[0].request('GET', path, headers=headers)
+                response = connection[0].getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException):
+                connection[0].close()
+                connection[0] = self.connect(base)
+                return False
+
+            return response.status < 400
+
+        return make_request
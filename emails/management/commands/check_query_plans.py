@@ -0,0 +1,92 @@
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from emails.models import Mailbox
+from emails.seed import Rollback, seed_mailboxes
+
+
+class Command(BaseCommand):
+    help = "Seed a throwaway dataset and check that folder listing and toggle queries use the folder indexes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--emails', type=int, default=50, help="Emails sent per user")
+
+    def handle(self, *args, **options):
+        failures = []
+
+        try:
+            with transaction.atomic():
+                users = seed_mailboxes(options['users'], options['emails'], prefix='plancheck')
+                self.analyze()
+                failures = self.check_plans(users[len(users) // 2])
+                raise Rollback()
+        except Rollback:
+            pass
+
+        if failures:
+            raise CommandError("{} quer(ies) did not use their index:\n{}".format(len(failures), '\n'.join(failures)))
+
+        self.stdout.write(self.style.SUCCESS("All folder queries use their indexes"))
+
+    def analyze(self):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute('ANALYZE {}'.format(Mailbox._meta.db_table))
+            elif connection.vendor == 'sqlite':
+                cursor.execute('ANALYZE')
+
+    def check_plans(self, user) -> list:
+        failures = []
+        table = Mailbox._meta.db_table
+        rows = Mailbox.objects.filter(user=user)
+        email_ids = list(rows.values_list('email_id', flat=True)[:20]) or [0]
+
+        folders = {folder: rows.filter(folder=folder) for folder, _ in Mailbox.FOLDER_CHOICES}
+        folders['starred'] = rows.filter(starred=True)
+
+        queries = {}
+        for folder, queryset in folders.items():
+            # Must walk the folder or starred index without sorting
+            queries['{} listing'.format(folder)] = (
+                queryset
+                .filter(email__isnull=False)
+                .select_related('email__sender', 'email__receiver')
+                .order_by('-created_at', '-id')[:51],
+                True,
+            )
+
+        # Must probe the (user, email) unique index
+        queries['toggle'] = (rows.filter(email_id__in=email_ids), False)
+
+        for name, (queryset, ordered) in queries.items():
+            plan = queryset.explain()
+            label = '{} {}'.format(table, name)
+            problems = self.plan_problems(plan, table, ordered)
+
+            if problems:
+                failures.append("{}: {}\n{}".format(label, ', '.join(problems), plan))
+            else:
+                self.stdout.write("{}: index scan".format(label))
+
+        return failures
+
+    def plan_problems(self, plan: str, table: str, ordered: bool) -> list:
+        if connection.vendor == 'postgresql':
+            full_scan = r'Seq Scan on {}\b'.format(table)
+            sort = r'\bSort\b'
+        else:
+            full_scan = r'\bSCAN (TABLE )?{}\b(?! USING)'.format(table)
+            sort = r'USE TEMP B-TREE FOR ORDER BY'
+
+        problems = []
+
+        if re.search(full_scan, plan):
+            problems.append("full scan of {}".format(table))
+
+        if ordered and re.search(sort, plan):
+            problems.append("sorts instead of reading in index order")
+
+        return problems
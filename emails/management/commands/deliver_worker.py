@@ -0,0 +1,58 @@
+import signal
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+
+from emails.delivery import process_delivery_jobs, queue_stats
+from emails.models import DeliveryJob
+
+
+class Command(BaseCommand):
+    help = "Deliver queued emails to their recipients' inboxes. Run as many workers as the queue needs."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.DELIVERY_BATCH_SIZE)
+        parser.add_argument(
+            '--poll-interval', type=float, default=settings.DELIVERY_POLL_INTERVAL,
+            help="Seconds to wait when no job is due",
+        )
+        parser.add_argument('--once', action='store_true', help="Exit once no job is due")
+        parser.add_argument('--stats', action='store_true', help="Print the queue depth and lag, and exit")
+        parser.add_argument('--retry-failed', action='store_true', help="Queue failed jobs again, and exit")
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            for key, value in queue_stats().items():
+                self.stdout.write("{:<12} {}".format(key, value))
+            return
+
+        if options['retry_failed']:
+            retried = DeliveryJob.objects\
+                .filter(state=DeliveryJob.FAILED)\
+                .update(state=DeliveryJob.PENDING, attempts=0, run_after=timezone.now())
+            self.stdout.write("Queued {} failed job(s) again".format(retried))
+            return
+
+        self.stopping = False
+        # Finish the batch in hand before exiting
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        while not self.stopping:
+            close_old_connections()
+            delivered, failed = process_delivery_jobs(options['batch_size'])
+
+            if delivered or failed:
+                self.stdout.write("Delivered {}, failed {}".format(delivered, failed))
+                continue
+
+            if options['once']:
+                break
+
+            time.sleep(options['poll_interval'])
+
+    def stop(self, signum, frame):
+        self.stopping = True
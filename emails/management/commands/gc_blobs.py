@@ -0,0 +1,19 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from emails.blobs import collect_garbage
+
+
+class Command(BaseCommand):
+    help = "Delete attachment blobs that no attachment refers to anymore"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--grace-period', type=int, default=3600,
+            help="Seconds a blob must have been unreferenced before it is deleted",
+        )
+
+    def handle(self, *args, **options):
+        deleted = collect_garbage(timedelta(seconds=options['grace_period']))
+        self.stdout.write("Deleted {} blob(s)".format(deleted))
@@ -0,0 +1,85 @@
+import os
+import shutil
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from emails.profiling import delete_profile, list_profiles, make_token, profile_path
+
+
+class Command(BaseCommand):
+    help = "List, show and fetch saved request profiles, or make a token that asks for one"
+
+    def add_arguments(self, parser):
+        subcommands = parser.add_subparsers(dest='action', required=True)
+
+        subcommands.add_parser('token', help="Print a value for the X-Profile-Token header")
+
+        list_parser = subcommands.add_parser('list', help="List saved profiles, newest first")
+        list_parser.add_argument('--limit', type=int, default=20)
+        list_parser.add_argument('--path', help="Only profiles of requests whose path contains this")
+
+        show = subcommands.add_parser('show', help="Print a profile's request, timings and slowest queries")
+        show.add_argument('profile_id')
+        show.add_argument('--queries', type=int, default=10, help="Slowest queries to print")
+
+        fetch = subcommands.add_parser('fetch', help="Copy a profile's files out of PROFILING_DIR")
+        fetch.add_argument('profile_id')
+        fetch.add_argument('--output', default='.', help="Directory to copy the files to")
+
+        delete = subcommands.add_parser('delete', help="Delete a saved profile")
+        delete.add_argument('profile_id')
+
+    def handle(self, *args, **options):
+        getattr(self, options['action'])(options)
+
+    def token(self, options):
+        self.stdout.write(make_token())
+        self.stderr.write("Valid for {} seconds. Send it as the X-Profile-Token header.".format(
+            settings.PROFILING_TOKEN_MAX_AGE
+        ))
+
+    def list(self, options):
+        profiles = list_profiles()
+
+        if options['path']:
+            profiles = [profile for profile in profiles if options['path'] in profile['path']]
+
+        self.stdout.write("{:<32} {:<7} {:>6} {:>10} {:>8}  {}".format('id', 'method', 'status', 'ms', 'queries', 'path'))
+
+        for profile in profiles[:options['limit']]:
+            self.stdout.write("{:<32} {:<7} {:>6} {:>10} {:>8}  {}".format(
+                profile['id'], profile['method'], profile['status'], profile['ms'], profile['queries'], profile['path'],
+            ))
+
+    def load(self, profile_id: str) -> dict:
+        for profile in list_profiles():
+            if profile['id'] == profile_id:
+                return profile
+
+        raise CommandError("No profile {} in {}".format(profile_id, settings.PROFILING_DIR))
+
+    def show(self, options):
+        profile = self.load(options['profile_id'])
+
+        for key in ('id', 'started_at', 'method', 'path', 'user_id', 'status', 'ms', 'samples', 'queries', 'query_ms'):
+            self.stdout.write("{:<11} {}".format(key, profile[key]))
+
+        self.stdout.write("\nSlowest queries:")
+        for query in sorted(profile['sql'], key=lambda query: query['ms'], reverse=True)[:options['queries']]:
+            self.stdout.write("{:>10.3f} ms  {}".format(query['ms'], query['sql']))
+
+        self.stdout.write("\nFlame graph: flamegraph.pl {}".format(profile_path(profile['id'], '.collapsed')))
+
+    def fetch(self, options):
+        profile = self.load(options['profile_id'])
+        os.makedirs(options['output'], exist_ok=True)
+
+        for extension in ('.collapsed', '.json'):
+            copied = shutil.copy(profile_path(profile['id'], extension), options['output'])
+            self.stdout.write(copied)
+
+    def delete(self, options):
+        self.load(options['profile_id'])
+        delete_profile(options['profile_id'])
+        self.stdout.write("Deleted {}".format(options['profile_id']))
@@ -0,0 +1,20 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from emails.changes import prune_changes
+
+
+class Command(BaseCommand):
+    help = "Delete mailbox changes older than the incremental sync retention period"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=settings.MAILBOX_CHANGE_RETENTION_DAYS,
+            help="Days of changes to keep",
+        )
+
+    def handle(self, *args, **options):
+        deleted = prune_changes(timedelta(days=options['days']))
+        self.stdout.write("Deleted {} change(s)".format(deleted))
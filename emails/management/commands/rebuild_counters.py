@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from emails.counters import rebuild_counters
+
+
+class Command(BaseCommand):
+    help = "Recount every user's folder counters from their mailbox and fix any drift"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check', action='store_true',
+            help="Only report drift, and exit with an error if there is any",
+        )
+
+    def handle(self, *args, **options):
+        drift = rebuild_counters(fix=not options['check'])
+
+        for user_id, folder, stored, counted in drift:
+            self.stdout.write("user {} {}: stored {}/{} total/unread, counted {}/{}".format(
+                user_id, folder, stored[0], stored[1], counted[0], counted[1],
+            ))
+
+        if drift and options['check']:
+            raise CommandError("{} counter(s) drifted".format(len(drift)))
+
+        verb = "Found" if options['check'] else "Fixed"
+        self.stdout.write("{} {} drifted counter(s)".format(verb, len(drift)))
@@ -0,0 +1,20 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from emails.uploads import retry_stale_uploads
+
+
+class Command(BaseCommand):
+    help = "Upload attachments again whose upload was lost with a crashed or restarted process"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--stale-after', type=int, default=settings.ATTACHMENT_UPLOAD_STALE_AFTER,
+            help="Seconds an upload must have been pending before it is taken for lost",
+        )
+
+    def handle(self, *args, **options):
+        retried, failed = retry_stale_uploads(timedelta(seconds=options['stale_after']))
+        self.stdout.write("Retried {} upload(s), marked {} failed".format(retried, failed))
@@ -0,0 +1,147 @@
+import asyncio
+import os
+import time
+from email.message import EmailMessage
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from emails.loadgen import LoadResult
+
+
+class SMTPError(Exception):
+    pass
+
+
+async def read_reply(reader) -> tuple:
+    """
+    Read one reply, which may span several lines, and return its code and text
+    """
+
+    lines = []
+
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise SMTPError("Connection closed")
+
+        lines.append(line[4:].strip().decode(errors='replace'))
+
+        if line[3:4] != b'-':
+            return int(line[:3]), ' '.join(lines)
+
+
+async def command(reader, writer, line: bytes, expected: int) -> None:
+    writer.write(line + b'\r\n')
+    code, text = await read_reply(reader)
+
+    if code != expected:
+        raise SMTPError("{} {}".format(code, text))
+
+
+class Command(BaseCommand):
+    help = "Send messages to the smtpd command over many concurrent connections and report messages/sec"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default=settings.SMTP_HOST)
+        parser.add_argument('--port', type=int, default=settings.SMTP_PORT)
+        parser.add_argument('--to', action='append', required=True, help="Recipient address; repeat for several")
+        parser.add_argument('--sender', default='load@example.com')
+        parser.add_argument('--connections', type=int, default=1000)
+        parser.add_argument('--messages', type=int, default=10000)
+        parser.add_argument('--size', type=int, default=2000, help="Bytes of text in each message body")
+        parser.add_argument('--attachment-size', type=int, default=0, help="Bytes of one attachment; 0 for none")
+
+    def handle(self, *args, **options):
+        content = self.build_message(options)
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        try:
+            result = loop.run_until_complete(self.run(content, options))
+        finally:
+            loop.close()
+
+        if not result.requests:
+            raise CommandError("No message was sent")
+
+        self.stdout.write("{} messages of {} bytes over {} connections in {:.2f}s".format(
+            result.requests, len(content), options['connections'], result.seconds,
+        ))
+        self.stdout.write("{:.1f} msgs/s, p50 {:.1f} ms, p99 {:.1f} ms, {} errors".format(
+            result.throughput, result.percentile(50) * 1000, result.percentile(99) * 1000, result.errors,
+        ))
+
+    def build_message(self, options) -> bytes:
+        """
+        The DATA payload, with CRLF line endings and leading dots doubled
+        """
+
+        message = EmailMessage()
+        message['From'] = options['sender']
+        message['To'] = ', '.join(options['to'])
+        message['Subject'] = "Load test"
+        message.set_content(('lorem ipsum ' * (options['size'] // 12 + 1))[:options['size']])
+
+        if options['attachment_size']:
+            message.add_attachment(
+                os.urandom(options['attachment_size']),
+                maintype='application', subtype='octet-stream', filename='load.bin',
+            )
+
+        lines = message.as_bytes().replace(b'\r\n', b'\n').split(b'\n')
+        return b''.join((b'.' + line if line.startswith(b'.') else line) + b'\r\n' for line in lines)
+
+    async def run(self, content: bytes, options) -> LoadResult:
+        remaining = [options['messages']]
+        latencies = []
+        errors = [0]
+
+        async def connect():
+            reader, writer = await asyncio.open_connection(options['host'], options['port'])
+            code, text = await read_reply(reader)
+            if code != 220:
+                raise SMTPError("{} {}".format(code, text))
+            await command(reader, writer, b'EHLO loadtest', 250)
+            return reader, writer
+
+        async def send(reader, writer) -> None:
+            # Declaring the size lets the server reserve only what it needs
+            await command(reader, writer, 'MAIL FROM:<{}> SIZE={}'.format(options['sender'], len(content)).encode(), 250)
+            for address in options['to']:
+                await command(reader, writer, 'RCPT TO:<{}>'.format(address).encode(), 250)
+            await command(reader, writer, b'DATA', 354)
+            writer.write(content)
+            await command(reader, writer, b'.', 250)
+
+        async def connection():
+            stream = None
+
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                start = time.perf_counter()
+
+                try:
+                    if stream is None:
+                        stream = await connect()
+                    await send(*stream)
+                except (OSError, SMTPError) as e:
+                    errors[0] += 1
+                    if errors[0] == 1:
+                        self.stderr.write("First error: {}".format(e))
+                    if stream is not None:
+                        stream[1].close()
+                        stream = None
+                    continue
+
+                latencies.append(time.perf_counter() - start)
+
+            if stream is not None:
+                stream[1].write(b'QUIT\r\n')
+                stream[1].close()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(connection() for _ in range(options['connections'])))
+
+        return LoadResult(latencies, errors[0], time.perf_counter() - start)
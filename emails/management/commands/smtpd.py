@@ -0,0 +1,101 @@
+import asyncio
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from emails.smtp import InboundHandler, MessageBatcher
+
+try:
+    from aiosmtpd.smtp import SMTP, syntax
+except ImportError:
+    # aiosmtpd is only needed by this command
+    SMTP = None
+
+if SMTP is not None:
+    class InboundSMTP(SMTP):
+        """
+        SMTP that reserves room with the handler before accepting a message,
+        and holds the message to the size it reserved
+        """
+
+        @syntax('DATA')
+        async def smtp_DATA(self, arg):
+            reserved = self.event_handler.reserve_data(self.envelope.mail_options)
+
+            if not reserved:
+                await self.push('451 4.3.2 Too busy, try again later')
+                return
+
+            limit, self.data_size_limit = self.data_size_limit, reserved
+
+            try:
+                await super().smtp_DATA(arg)
+            finally:
+                self.data_size_limit = limit
+                self.event_handler.release_data(reserved)
+
+
+class Command(BaseCommand):
+    help = "Receive mail for local users over SMTP"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default=settings.SMTP_HOST)
+        parser.add_argument('--port', type=int, default=settings.SMTP_PORT)
+        parser.add_argument('--hostname', help="Name given in the greeting; defaults to this machine's name")
+        parser.add_argument(
+            '--writers', type=int, default=settings.SMTP_BATCH_WRITERS,
+            help="Batches saved at once; use 1 with SQLite, which allows one writer",
+        )
+        parser.add_argument('--backlog', type=int, default=1024, help="Connections waiting to be accepted")
+
+    def handle(self, *args, **options):
+        if SMTP is None:
+            raise CommandError("smtpd needs aiosmtpd: pip install aiosmtpd")
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        batcher = MessageBatcher(settings.SMTP_BATCH_SIZE, settings.SMTP_BATCH_WINDOW, settings.SMTP_QUEUE_SIZE)
+        handler = InboundHandler(batcher, settings.SMTP_MAX_DATA_BYTES)
+
+        def protocol():
+            return InboundSMTP(
+                handler,
+                hostname=options['hostname'],
+                data_size_limit=settings.SMTP_MAX_MESSAGE_SIZE,
+                enable_SMTPUTF8=True,
+                timeout=settings.SMTP_TIMEOUT,
+                loop=loop,
+            )
+
+        try:
+            server = loop.run_until_complete(loop.create_server(
+                protocol, options['host'], options['port'], backlog=options['backlog'], reuse_address=True,
+            ))
+        except OSError as e:
+            loop.close()
+            raise CommandError("Could not listen on {}:{}: {}".format(options['host'], options['port'], e))
+
+        writers = [loop.create_task(batcher.run()) for _ in range(options['writers'])]
+
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, loop.stop)
+
+        self.stdout.write("Receiving mail for {} on {}:{}".format(
+            ', '.join(settings.SMTP_DOMAINS), options['host'], options['port'],
+        ))
+
+        try:
+            loop.run_forever()
+        finally:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+
+            # Save what has been received before exiting
+            loop.run_until_complete(batcher.join())
+
+            for writer in writers:
+                writer.cancel()
+            loop.run_until_complete(asyncio.gather(*writers, return_exceptions=True))
+            loop.close()
@@ -0,0 +1,231 @@
+"""
+Prometheus metrics for the API.
+
+MetricsMiddleware records, per route, how long requests take, how many
+queries they make and how long those take, and how large the responses are.
+Attachment storage calls on the upload and presign paths are timed with
+`observe_storage`, and the depth and lag of the delivery queue are read from
+the database at most once every METRICS_QUEUE_CACHE_TTL seconds. Everything
+is served in the Prometheus text format at /metrics, to clients whose address
+is in METRICS_ALLOWED_IPS or that send METRICS_TOKEN as a bearer token.
+
+Under gunicorn each worker keeps its own numbers. Set PROMETHEUS_MULTIPROC_DIR
+to an empty directory before starting it, and use gunicorn.conf.py, so the
+workers share them through files in that directory and /metrics reports the
+totals whichever worker answers.
+"""
+import hmac
+import ipaddress
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed, PermissionDenied
+from django.db import connection
+from django.http import Http404, HttpResponse
+
+from emails.delivery import queue_stats
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+    from prometheus_client.core import GaugeMetricFamily
+except ImportError:
+    # Metrics are off without prometheus_client
+    prometheus_client = None
+
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+if prometheus_client is not None:
+    REQUEST_SECONDS = prometheus_client.Histogram(
+        'http_request_duration_seconds', "Time spent handling a request",
+        ['method', 'route', 'status'],
+    )
+    REQUEST_QUERIES = prometheus_client.Histogram(
+        'http_request_db_queries', "Database queries made by one request",
+        ['method', 'route'], buckets=QUERY_BUCKETS,
+    )
+    REQUEST_DB_SECONDS = prometheus_client.Histogram(
+        'http_request_db_seconds', "Time one request spent in database queries",
+        ['method', 'route'],
+    )
+    RESPONSE_BYTES = prometheus_client.Histogram(
+        'http_response_size_bytes', "Size of response bodies",
+        ['method', 'route'], buckets=SIZE_BUCKETS,
+    )
+    STORAGE_SECONDS = prometheus_client.Histogram(
+        'attachment_storage_seconds', "Time spent in attachment storage calls",
+        ['operation'],
+    )
+
+
+@contextmanager
+def observe_storage(operation: str):
+    """
+    Time the attachment storage call made inside the block
+    """
+
+    if prometheus_client is None:
+        yield
+        return
+
+    with STORAGE_SECONDS.labels(operation).time():
+        yield
+
+
+class QueryTimer:
+    """
+    Database execute wrapper counting the queries of one request and the
+    time they take
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - start
+
+
+def route_of(request) -> str:
+    """
+    The URL pattern the request matched, so every email id shares one label
+    """
+
+    match = getattr(request, 'resolver_match', None)
+
+    if match is None:
+        return 'unmatched'
+
+    return '/' + (match.route or match.view_name)
+
+
+def response_size(response):
+    if response.has_header('Content-Length'):
+        return int(response['Content-Length'])
+
+    if getattr(response, 'streaming', False):
+        return None
+
+    return len(response.content)
+
+
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        if prometheus_client is None:
+            raise MiddlewareNotUsed("prometheus_client is not installed")
+
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timer = QueryTimer()
+        start = time.perf_counter()
+
+        with connection.execute_wrapper(timer):
+            response = self.get_response(request)
+
+        elapsed = time.perf_counter() - start
+        method = request.method
+        route = route_of(request)
+
+        REQUEST_SECONDS.labels(method, route, str(response.status_code)).observe(elapsed)
+        REQUEST_QUERIES.labels(method, route).observe(timer.count)
+        REQUEST_DB_SECONDS.labels(method, route).observe(timer.seconds)
+
+        size = response_size(response)
+        if size is not None:
+            RESPONSE_BYTES.labels(method, route).observe(size)
+
+        return response
+
+
+class DeliveryQueueCollector:
+    """
+    Delivery queue gauges, which are the same whichever process reads them.
+    The queue is counted at most once every `ttl` seconds.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._stats = None
+        self._expires = 0.0
+        self._lock = threading.Lock()
+
+    def describe(self):
+        return self.families()
+
+    def collect(self):
+        with self._lock:
+            if self._stats is None or time.monotonic() >= self._expires:
+                self._stats = queue_stats()
+                self._expires = time.monotonic() + self.ttl
+
+            stats = self._stats
+
+        return self.families(stats)
+
+    def families(self, stats=None) -> list:
+        jobs = GaugeMetricFamily('delivery_queue_jobs', "Delivery jobs by state", labels=['state'])
+        lag = GaugeMetricFamily('delivery_queue_lag_seconds', "How long the longest waiting due job has been due")
+
+        if stats is not None:
+            for state in ('pending', 'due', 'failed'):
+                jobs.add_metric([state], stats[state])
+            lag.add_metric([], stats['lag_seconds'])
+
+        return [jobs, lag]
+
+
+if prometheus_client is not None:
+    # Kept apart from the per process metrics, which may be merged from files
+    QUEUE_REGISTRY = prometheus_client.CollectorRegistry()
+    QUEUE_REGISTRY.register(DeliveryQueueCollector(settings.METRICS_QUEUE_CACHE_TTL))
+
+
+def scraper_allowed(request) -> bool:
+    """
+    Whether the request comes from an allowed address or carries the token
+    """
+
+    token = settings.METRICS_TOKEN
+    scheme, _, credentials = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+
+    if token and scheme.lower() == 'bearer' and hmac.compare_digest(credentials.encode(), token.encode()):
+        return True
+
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+
+    return any(address in ipaddress.ip_network(network) for network in settings.METRICS_ALLOWED_IPS)
+
+
+def metrics_view(request):
+    """
+    Serve every metric in the Prometheus text format
+    """
+
+    if prometheus_client is None:
+        raise Http404
+
+    if not scraper_allowed(request):
+        raise PermissionDenied
+
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ or 'prometheus_multiproc_dir' in os.environ:
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+
+    output = prometheus_client.generate_latest(registry) + prometheus_client.generate_latest(QUEUE_REGISTRY)
+    return HttpResponse(output, content_type=prometheus_client.CONTENT_TYPE_LATEST)
@@ -0,0 +1,25 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:31
+
+from django.db import migrations, models
+
+
+def mark_existing_stored(apps, schema_editor):
+    # Attachments made before this migration were uploaded inside the request
+    Attachment = apps.get_model('emails', 'Attachment')
+    Attachment.objects.update(state='stored')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0014_recipient'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attachment',
+            name='state',
+            field=models.CharField(choices=[('pending', 'Pending'), ('stored', 'Stored'), ('failed', 'Failed')], default='pending', max_length=7),
+        ),
+        migrations.RunPython(mark_existing_stored, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_blobs(apps, schema_editor):
+    # Attachments that already carry a content hash share one blob per hash.
+    # Older attachments have no hash and keep blob unset. Extra copies of the
+    # same content stay in storage untouched.
+    Attachment = apps.get_model('emails', 'Attachment')
+    Blob = apps.get_model('emails', 'Blob')
+
+    blobs = {}
+
+    for attachment in Attachment.objects.exclude(sha256='').filter(state='stored').order_by('id'):
+        blob = blobs.get(attachment.sha256)
+
+        if blob is None:
+            blob = blobs[attachment.sha256] = Blob.objects.create(
+                sha256=attachment.sha256,
+                object_name=attachment.object_name,
+                size=attachment.size or 0,
+                state='stored',
+            )
+
+        blob.refcount += 1
+        attachment.blob = blob
+        attachment.object_name = blob.object_name
+        attachment.save(update_fields=['blob', 'object_name'])
+
+    for blob in blobs.values():
+        blob.save(update_fields=['refcount'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0016_auto_20261018_0533'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('object_name', models.CharField(max_length=255)),
+                ('size', models.BigIntegerField()),
+                ('state', models.CharField(choices=[('pending', 'Pending'), ('stored', 'Stored'), ('failed', 'Failed')], default='pending', max_length=7)),
+                ('refcount', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='attachment',
+            name='blob',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='attachments', to='emails.Blob'),
+        ),
+        migrations.RunPython(create_blobs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations
+
+from emails.search import install_index, uninstall_index
+
+
+def install(apps, schema_editor):
+    install_index(schema_editor)
+
+
+def uninstall(apps, schema_editor):
+    uninstall_index(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0017_auto_20261018_0534'),
+    ]
+
+    operations = [
+        migrations.RunPython(install, uninstall),
+    ]
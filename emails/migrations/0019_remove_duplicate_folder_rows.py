@@ -0,0 +1,30 @@
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def remove_duplicates(apps, schema_editor):
+    # Keep the oldest row for every (user, email) pair so the unique
+    # constraints added next can be created
+    for model_name in ('Inbox', 'Starred', 'Sent', 'Trash'):
+        model = apps.get_model('emails', model_name)
+        duplicates = model.objects\
+            .values('user_id', 'email_id')\
+            .annotate(keep=Min('id'), rows=Count('id'))\
+            .filter(rows__gt=1)
+
+        for duplicate in duplicates:
+            model.objects\
+                .filter(user_id=duplicate['user_id'], email_id=duplicate['email_id'])\
+                .exclude(id=duplicate['keep'])\
+                .delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0018_search_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+    ]
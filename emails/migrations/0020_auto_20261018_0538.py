@@ -0,0 +1,67 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:38
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0019_remove_duplicate_folder_rows'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='inbox',
+            name='user',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='inbox', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='sent',
+            name='user',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='sent_email', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='starred',
+            name='user',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='starred', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='trash',
+            name='user',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='trash', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='inbox',
+            index=models.Index(fields=['user', '-created_at', '-id'], name='emails_inbox_user_created'),
+        ),
+        migrations.AddIndex(
+            model_name='sent',
+            index=models.Index(fields=['user', '-created_at', '-id'], name='emails_sent_user_created'),
+        ),
+        migrations.AddIndex(
+            model_name='starred',
+            index=models.Index(fields=['user', '-created_at', '-id'], name='emails_starred_user_created'),
+        ),
+        migrations.AddIndex(
+            model_name='trash',
+            index=models.Index(fields=['user', '-created_at', '-id'], name='emails_trash_user_created'),
+        ),
+        migrations.AddConstraint(
+            model_name='inbox',
+            constraint=models.UniqueConstraint(fields=('user', 'email'), name='emails_inbox_user_email'),
+        ),
+        migrations.AddConstraint(
+            model_name='sent',
+            constraint=models.UniqueConstraint(fields=('user', 'email'), name='emails_sent_user_email'),
+        ),
+        migrations.AddConstraint(
+            model_name='starred',
+            constraint=models.UniqueConstraint(fields=('user', 'email'), name='emails_starred_user_email'),
+        ),
+        migrations.AddConstraint(
+            model_name='trash',
+            constraint=models.UniqueConstraint(fields=('user', 'email'), name='emails_trash_user_email'),
+        ),
+    ]
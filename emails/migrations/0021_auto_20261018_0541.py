@@ -0,0 +1,43 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:41
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('emails', '0020_auto_20261018_0538'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Mailbox',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('folder', models.CharField(choices=[('inbox', 'Inbox'), ('sent', 'Sent'), ('trash', 'Trash')], default='inbox', max_length=5)),
+                ('starred', models.BooleanField(default=False)),
+                ('read', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('email', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mailboxes', to='emails.Email')),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='mailbox', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='mailbox',
+            index=models.Index(fields=['user', 'folder', '-created_at', '-id'], name='emails_mailbox_folder'),
+        ),
+        migrations.AddIndex(
+            model_name='mailbox',
+            index=models.Index(condition=models.Q(starred=True), fields=['user', '-created_at', '-id'], name='emails_mailbox_starred'),
+        ),
+        migrations.AddConstraint(
+            model_name='mailbox',
+            constraint=models.UniqueConstraint(fields=('user', 'email'), name='emails_mailbox_user_email'),
+        ),
+    ]
@@ -0,0 +1,70 @@
+from django.db import migrations
+
+# Folder tables in priority order: an email a user holds in more than one
+# folder keeps the first. Inbox and trash rows carry the email's read flag
+# over and sent mail is read by definition.
+FOLDERS = (
+    ('emails_inbox', 'inbox', True),
+    ('emails_trash', 'trash', True),
+    ('emails_sent', 'sent', False),
+)
+
+
+def copy_folders(apps, schema_editor):
+    read_column = schema_editor.quote_name('read')
+
+    for table, folder, keep_read in FOLDERS:
+        schema_editor.execute(
+            """
+            INSERT INTO emails_mailbox (user_id, email_id, folder, starred, {column}, created_at)
+            SELECT f.user_id, f.email_id, %s, %s, {read}, f.created_at
+            FROM {table} f JOIN emails_email e ON e.id = f.email_id
+            WHERE f.user_id IS NOT NULL AND NOT EXISTS (
+                SELECT 1 FROM emails_mailbox m WHERE m.user_id = f.user_id AND m.email_id = f.email_id
+            )
+            """.format(column=read_column, read='e.' + read_column if keep_read else '%s', table=table),
+            [folder, False] + ([] if keep_read else [True]),
+        )
+
+    # Starred rows with no folder behind them have nothing left to flag
+    schema_editor.execute(
+        """
+        UPDATE emails_mailbox SET starred = %s WHERE EXISTS (
+            SELECT 1 FROM emails_starred s
+            WHERE s.user_id = emails_mailbox.user_id AND s.email_id = emails_mailbox.email_id
+        )
+        """,
+        [True],
+    )
+
+
+def copy_mailbox(apps, schema_editor):
+    Mailbox = apps.get_model('emails', 'Mailbox')
+    for table, folder, keep_read in FOLDERS:
+        schema_editor.execute(
+            """
+            INSERT INTO {table} (user_id, email_id, created_at)
+            SELECT user_id, email_id, created_at FROM emails_mailbox WHERE folder = %s
+            """.format(table=table),
+            [folder],
+        )
+
+    schema_editor.execute(
+        """
+        INSERT INTO emails_starred (user_id, email_id, created_at)
+        SELECT user_id, email_id, created_at FROM emails_mailbox WHERE starred = %s
+        """,
+        [True],
+    )
+    Mailbox.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0021_auto_20261018_0541'),
+    ]
+
+    operations = [
+        migrations.RunPython(copy_folders, copy_mailbox),
+    ]
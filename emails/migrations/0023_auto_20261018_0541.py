@@ -0,0 +1,25 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:41
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0022_mailbox_from_folders'),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='Inbox',
+        ),
+        migrations.DeleteModel(
+            name='Sent',
+        ),
+        migrations.DeleteModel(
+            name='Starred',
+        ),
+        migrations.DeleteModel(
+            name='Trash',
+        ),
+    ]
@@ -0,0 +1,54 @@
+from django.db import migrations
+
+from emails.search import install_index
+
+
+def copy_read(apps, schema_editor):
+    # Email.read was the receiver's flag; recipients and the sender already
+    # have rows of their own
+    read_column = schema_editor.quote_name('read')
+    schema_editor.execute(
+        """
+        UPDATE emails_mailbox SET {column} = %s WHERE folder <> %s AND EXISTS (
+            SELECT 1 FROM emails_email e
+            WHERE e.id = emails_mailbox.email_id AND e.receiver_id = emails_mailbox.user_id AND e.{column} = %s
+        )
+        """.format(column=read_column),
+        [True, 'sent', True],
+    )
+
+
+def restore_read(apps, schema_editor):
+    read_column = schema_editor.quote_name('read')
+    schema_editor.execute(
+        """
+        UPDATE emails_email SET {column} = %s WHERE EXISTS (
+            SELECT 1 FROM emails_mailbox m
+            WHERE m.email_id = emails_email.id AND m.user_id = emails_email.receiver_id AND m.{column} = %s
+        )
+        """.format(column=read_column),
+        [True, True],
+    )
+
+
+def install(apps, schema_editor):
+    # SQLite rebuilds emails_email to drop or add the column, taking the
+    # search triggers with it
+    install_index(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0023_auto_20261018_0541'),
+    ]
+
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop, install),
+        migrations.RunPython(copy_read, restore_read),
+        migrations.RemoveField(
+            model_name='email',
+            name='read',
+        ),
+        migrations.RunPython(install, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:46
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def count_folders(apps, schema_editor):
+    read_column = schema_editor.quote_name('read')
+    unread = 'SUM(CASE WHEN {} THEN 0 ELSE 1 END)'.format(read_column)
+
+    schema_editor.execute(
+        """
+        INSERT INTO emails_foldercounter (user_id, folder, total, unread)
+        SELECT user_id, folder, COUNT(*), {unread} FROM emails_mailbox GROUP BY user_id, folder
+        """.format(unread=unread)
+    )
+    schema_editor.execute(
+        """
+        INSERT INTO emails_foldercounter (user_id, folder, total, unread)
+        SELECT user_id, %s, COUNT(*), {unread} FROM emails_mailbox WHERE starred = %s GROUP BY user_id
+        """.format(unread=unread),
+        ['starred', True],
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('emails', '0024_remove_email_read'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FolderCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('folder', models.CharField(choices=[('inbox', 'Inbox'), ('sent', 'Sent'), ('trash', 'Trash'), ('starred', 'Starred')], max_length=7)),
+                ('total', models.IntegerField(default=0)),
+                ('unread', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='folder_counters', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='foldercounter',
+            constraint=models.UniqueConstraint(fields=('user', 'folder'), name='emails_foldercounter_user_folder'),
+        ),
+        migrations.RunPython(count_folders, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+from django.db import migrations, models
+
+from emails.models import make_snippet
+from emails.search import install_index
+
+
+def fill_snippets(apps, schema_editor):
+    Email = apps.get_model('emails', 'Email')
+    batch = []
+
+    for email in Email.objects.only('id', 'message').iterator(chunk_size=500):
+        email.snippet = make_snippet(email.message)
+        batch.append(email)
+
+        if len(batch) == 500:
+            Email.objects.bulk_update(batch, ['snippet'])
+            batch = []
+
+    Email.objects.bulk_update(batch, ['snippet'])
+
+
+def install(apps, schema_editor):
+    # SQLite rebuilds emails_email to add or drop the column, taking the
+    # search triggers with it
+    install_index(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0025_auto_20261018_0546'),
+    ]
+
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop, install),
+        migrations.AddField(
+            model_name='email',
+            name='snippet',
+            field=models.CharField(blank=True, default='', max_length=120),
+        ),
+        migrations.RunPython(install, migrations.RunPython.noop),
+        migrations.RunPython(fill_snippets, migrations.RunPython.noop),
+    ]
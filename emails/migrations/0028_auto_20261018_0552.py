@@ -0,0 +1,33 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:52
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('emails', '0027_mailboxstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailboxChange',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('email_id', models.IntegerField()),
+                ('kind', models.CharField(choices=[('new', 'New'), ('move', 'Move'), ('star', 'Star'), ('read', 'Read'), ('purge', 'Purge')], max_length=5)),
+                ('folder', models.CharField(choices=[('inbox', 'Inbox'), ('sent', 'Sent'), ('trash', 'Trash')], max_length=5, null=True)),
+                ('starred', models.BooleanField(default=False)),
+                ('read', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='mailbox_changes', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='mailboxchange',
+            index=models.Index(fields=['user', 'id'], name='emails_change_user_id'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+from django.db import migrations
+from django.db.models import F
+
+
+def clear_hidden_receivers(apps, schema_editor):
+    # Emails without a To recipient showed a Cc or Bcc recipient as their
+    # receiver. Emails from before recipient lists have no Recipient rows
+    # and keep theirs.
+    Email = apps.get_model('emails', 'Email')
+    Recipient = apps.get_model('emails', 'Recipient')
+
+    hidden = Recipient.objects\
+        .exclude(kind='to')\
+        .filter(email__receiver_id=F('user_id'))\
+        .values('email_id')
+
+    Email.objects.filter(id__in=hidden).update(receiver=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0029_auto_20261018_0603'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_hidden_receivers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 13:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0030_receiver_to_only'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blob',
+            name='upload_started_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
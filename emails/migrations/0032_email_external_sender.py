@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-18 13:34
+
+from django.db import migrations, models
+
+from emails.search import install_index
+
+
+def install(apps, schema_editor):
+    # SQLite rebuilds emails_email to add or drop the column, taking the
+    # search triggers with it
+    install_index(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0031_blob_upload_started_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop, install),
+        migrations.AddField(
+            model_name='email',
+            name='external_sender',
+            field=models.CharField(blank=True, default='', max_length=254),
+        ),
+        migrations.RunPython(install, migrations.RunPython.noop),
+    ]
@@ -1,59 +1,230 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
+
+SNIPPET_LENGTH = 120
+
+
+def make_snippet(message: str) -> str:
+    """
+    One line preview of a message for folder listings
+    """
+
+    text = ' '.join(message.split())
+
+    if len(text) <= SNIPPET_LENGTH:
+        return text
+
+    return text[:SNIPPET_LENGTH - 1].rstrip() + '\u2026'
+
 
 class Email(models.Model):
     subject = models.CharField(max_length=255)
     message = models.TextField(max_length=4000)
-    read = models.BooleanField(default=False)
+    # Listings show the snippet and leave the message unread
+    snippet = models.CharField(max_length=SNIPPET_LENGTH, blank=True, default='')
     created_at = models.DateTimeField(auto_now_add=True)
     sender = models.ForeignKey(User, related_name="sent", on_delete=models.DO_NOTHING, null=True)
     receiver = models.ForeignKey(User, related_name='emails', on_delete=models.DO_NOTHING, null=True)
+    # From address of mail received over SMTP, which has no local sender
+    external_sender = models.CharField(max_length=254, blank=True, default='')
 
     class Meta:
         ordering = ['-created_at']
 
+    def save(self, *args, **kwargs):
+        self.snippet = make_snippet(self.message)
+        super().save(*args, **kwargs)
+
+
+class Recipient(models.Model):
+    TO = 'to'
+    CC = 'cc'
+    BCC = 'bcc'
+    KIND_CHOICES = (
+        (TO, 'To'),
+        (CC, 'Cc'),
+        (BCC, 'Bcc'),
+    )
+
+    email = models.ForeignKey(Email, related_name='recipients', on_delete=models.CASCADE)
+    user = models.ForeignKey(User, related_name='received', on_delete=models.CASCADE)
+    kind = models.CharField(max_length=3, choices=KIND_CHOICES, default=TO)
+
+
+class Blob(models.Model):
+    """
+    A stored file, shared by every attachment with the same content
+    """
+
+    PENDING = 'pending'
+    STORED = 'stored'
+    FAILED = 'failed'
+    STATE_CHOICES = (
+        (PENDING, 'Pending'),
+        (STORED, 'Stored'),
+        (FAILED, 'Failed'),
+    )
+
+    sha256 = models.CharField(max_length=64, unique=True)
+    object_name = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    state = models.CharField(max_length=7, choices=STATE_CHOICES, default=PENDING)
+    refcount = models.PositiveIntegerField(default=0)
+    # When the pending upload was queued; one that has been pending for long
+    # was lost with the process uploading it
+    upload_started_at = models.DateTimeField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
 
 class Attachment(models.Model):
+    PENDING = Blob.PENDING
+    STORED = Blob.STORED
+    FAILED = Blob.FAILED
+    STATE_CHOICES = Blob.STATE_CHOICES
+
     name = models.CharField(max_length=100)
     object_name = models.CharField(max_length=255)
+    state = models.CharField(max_length=7, choices=STATE_CHOICES, default=PENDING)
+    size = models.BigIntegerField(null=True)
+    sha256 = models.CharField(max_length=64, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     email = models.ForeignKey(Email, related_name='attachments', on_delete=models.DO_NOTHING, null=True)
-
-
-class Inbox(models.Model):
-    user = models.ForeignKey(User, related_name='inbox', on_delete=models.CASCADE, null=True)
-    email = models.ForeignKey(Email, on_delete=models.CASCADE, null=True)
+    blob = models.ForeignKey(Blob, related_name='attachments', on_delete=models.PROTECT, null=True)
+
+
+class Mailbox(models.Model):
+    """
+    One row per user per email they hold, saying which folder it sits in
+    and the user's own flags on it
+    """
+
+    INBOX = 'inbox'
+    SENT = 'sent'
+    TRASH = 'trash'
+    FOLDER_CHOICES = (
+        (INBOX, 'Inbox'),
+        (SENT, 'Sent'),
+        (TRASH, 'Trash'),
+    )
+
+    # The indexes and unique constraint below all lead with user
+    user = models.ForeignKey(User, related_name='mailbox', on_delete=models.CASCADE, db_index=False)
+    email = models.ForeignKey(Email, related_name='mailboxes', on_delete=models.CASCADE)
+    folder = models.CharField(max_length=5, choices=FOLDER_CHOICES, default=INBOX)
+    starred = models.BooleanField(default=False)
+    read = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         ordering = ['-created_at']
-
-
-class Starred(models.Model):
-    user = models.ForeignKey(User, related_name='starred', on_delete=models.CASCADE, null=True)
-    email = models.ForeignKey(Email, on_delete=models.CASCADE, null=True)
-    created_at = models.DateTimeField(auto_now_add=True)
+        indexes = [
+            models.Index(fields=['user', 'folder', '-created_at', '-id'], name='emails_mailbox_folder'),
+            models.Index(
+                fields=['user', '-created_at', '-id'],
+                name='emails_mailbox_starred',
+                condition=models.Q(starred=True),
+            ),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'email'], name='emails_mailbox_user_email'),
+        ]
+
+
+class FolderCounter(models.Model):
+    """
+    Running total and unread count of one of a user's folders, kept in step
+    with Mailbox by emails.counters
+    """
+
+    STARRED = 'starred'
+    FOLDER_CHOICES = Mailbox.FOLDER_CHOICES + ((STARRED, 'Starred'),)
+
+    # The unique constraint below leads with user
+    user = models.ForeignKey(User, related_name='folder_counters', on_delete=models.CASCADE, db_index=False)
+    folder = models.CharField(max_length=7, choices=FOLDER_CHOICES)
+    total = models.IntegerField(default=0)
+    unread = models.IntegerField(default=0)
 
     class Meta:
-        ordering = ['-created_at']
-
-
-class Sent(models.Model):
-    user = models.ForeignKey(User, related_name='sent_email', on_delete=models.CASCADE, null=True)
-    email = models.ForeignKey(Email, on_delete=models.CASCADE, null=True)
-    created_at = models.DateTimeField(auto_now_add=True)
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'folder'], name='emails_foldercounter_user_folder'),
+        ]
+
+
+class MailboxState(models.Model):
+    """
+    Version of a user's mailbox, bumped by every change to their Mailbox
+    rows. Folder listings use it as their ETag.
+    """
+
+    user = models.OneToOneField(User, related_name='mailbox_state', on_delete=models.CASCADE, primary_key=True)
+    version = models.BigIntegerField(default=0)
+    modified_at = models.DateTimeField(auto_now=True)
+
+
+class MailboxChange(models.Model):
+    """
+    Append only log of changes to a user's Mailbox rows, with the row's
+    state after the change, for incremental sync
+    """
+
+    NEW = 'new'
+    MOVE = 'move'
+    STAR = 'star'
+    READ = 'read'
+    PURGE = 'purge'
+    KIND_CHOICES = (
+        (NEW, 'New'),
+        (MOVE, 'Move'),
+        (STAR, 'Star'),
+        (READ, 'Read'),
+        (PURGE, 'Purge'),
+    )
+
+    id = models.BigAutoField(primary_key=True)
+    # The index below leads with user
+    user = models.ForeignKey(User, related_name='mailbox_changes', on_delete=models.CASCADE, db_index=False)
+    # Not a foreign key: a purge can delete the email the change is about
+    email_id = models.IntegerField()
+    kind = models.CharField(max_length=5, choices=KIND_CHOICES)
+    folder = models.CharField(max_length=5, choices=Mailbox.FOLDER_CHOICES, null=True)
+    starred = models.BooleanField(default=False)
+    read = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
 
     class Meta:
-        ordering = ['-created_at']
-
-
-class Trash(models.Model):
-    user = models.ForeignKey(User, related_name='trash', on_delete=models.CASCADE, null=True)
-    email = models.ForeignKey(Email, on_delete=models.CASCADE, null=True)
+        indexes = [
+            models.Index(fields=['user', 'id'], name='emails_change_user_id'),
+        ]
+
+
+class DeliveryJob(models.Model):
+    """
+    An email waiting to be put in its recipients' inboxes by the
+    `deliver_worker` command. Delivered jobs are deleted; jobs that fail
+    DELIVERY_MAX_ATTEMPTS times are kept as failed.
+    """
+
+    PENDING = 'pending'
+    FAILED = 'failed'
+    STATE_CHOICES = (
+        (PENDING, 'Pending'),
+        (FAILED, 'Failed'),
+    )
+
+    email = models.OneToOneField(Email, related_name='delivery', on_delete=models.CASCADE, primary_key=True)
+    state = models.CharField(max_length=7, choices=STATE_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
-        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['state', 'run_after'], name='emails_delivery_due'),
+        ]
 
 
 class SecurityAnswer(models.Model):
@@ -0,0 +1,102 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+
+from django.db.models import Q, QuerySet
+from django.utils.dateparse import parse_datetime
+
+from rest_framework.exceptions import ValidationError
+from rest_framework.request import Request
+
+
+class KeysetPagination:
+    """
+    Cursor pagination over (created_at, id), newest first.
+
+    The cursor is an opaque token holding the position of the last row of the
+    previous page, so fetching page N costs the same as fetching page 1.
+    """
+
+    page_size = 50
+    max_page_size = 200
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'limit'
+
+    def get_page_size(self, request: Request) -> int:
+        value = request.query_params.get(self.page_size_query_param)
+
+        if value is None:
+            return self.page_size
+
+        try:
+            page_size = int(value)
+        except ValueError:
+            raise ValidationError({self.page_size_query_param: 'Must be an integer.'})
+
+        return max(1, min(page_size, self.max_page_size))
+
+    def validate(self, request: Request) -> None:
+        """
+        Raise ValidationError if the page size or cursor of `request` is
+        malformed, without querying
+        """
+
+        self.get_page_size(request)
+        cursor = request.query_params.get(self.cursor_query_param)
+
+        if cursor:
+            self.decode_cursor(cursor)
+
+    def paginate_queryset(self, queryset: QuerySet, request: Request, position=None):
+        """
+        Return (rows, next_cursor) for the page requested by `request`.
+        `next_cursor` is None on the last page. `position` returns the
+        (created_at, id) of a row, for querysets that do not return models.
+        """
+
+        page_size = self.get_page_size(request)
+        cursor = request.query_params.get(self.cursor_query_param)
+
+        queryset = queryset.order_by('-created_at', '-id')
+
+        if cursor:
+            queryset = queryset.filter(self.cursor_q(cursor))
+
+        # Fetch one extra row to know whether another page exists
+        rows = list(queryset[:page_size + 1])
+        next_cursor = None
+
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            if position is None:
+                next_cursor = self.encode_cursor(rows[-1].created_at, rows[-1].id)
+            else:
+                next_cursor = self.encode_cursor(*position(rows[-1]))
+
+        return rows, next_cursor
+
+    def cursor_q(self, cursor: str) -> Q:
+        """
+        Filter for the rows that come after `cursor` in listing order
+        """
+
+        created_at, pk = self.decode_cursor(cursor)
+        return Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk)
+
+    @staticmethod
+    def encode_cursor(created_at: datetime, pk: int) -> str:
+        raw = '{}|{}'.format(created_at.isoformat(), pk)
+        return urlsafe_b64encode(raw.encode()).decode()
+
+    def decode_cursor(self, cursor: str):
+        try:
+            raw = urlsafe_b64decode(cursor.encode()).decode()
+            created_at, pk = raw.rsplit('|', 1)
+            created_at = parse_datetime(created_at)
+            pk = int(pk)
+        except (ValueError, TypeError):
+            raise ValidationError({self.cursor_query_param: 'Invalid cursor.'})
+
+        if created_at is None:
+            raise ValidationError({self.cursor_query_param: 'Invalid cursor.'})
+
+        return created_at, pk
@@ -0,0 +1,49 @@
+"""
+Cached download links for attachments.
+
+A presigned url is good until it expires, so the same url is handed out
+again for as long as it has at least ATTACHMENT_URL_MIN_LIFETIME seconds
+left. Entries leave the cache at that point, before the url itself expires.
+Links are cached per object, file name and user: attachments with the same
+content share an object but each downloads under its own name.
+"""
+import threading
+
+from django.conf import settings
+
+from emails.cache import LRUCache
+from emails.metrics import observe_storage
+from emails.storage import get_storage
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_url_cache() -> LRUCache:
+    global _cache
+
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = LRUCache(settings.ATTACHMENT_URL_CACHE_SIZE)
+
+    return _cache
+
+
+def presigned_url(object_name: str, filename: str, user_id: int) -> str:
+    """
+    Return a link downloading `object_name` as `filename`, reusing a cached
+    one when it still has enough lifetime left
+    """
+
+    cache = get_url_cache()
+    key = (object_name, filename, user_id)
+    url = cache.get(key)
+
+    if url is None:
+        expires = settings.ATTACHMENT_URL_EXPIRY
+        with observe_storage('presign'):
+            url = get_storage().url(object_name, expires=expires, filename=filename)
+        cache.set(key, url, ttl=expires - settings.ATTACHMENT_URL_MIN_LIFETIME)
+
+    return url
@@ -0,0 +1,247 @@
+"""
+On demand profiling of single requests.
+
+A request is profiled when it carries a valid X-Profile-Token header (see
+`manage.py profiles token`), or at random for a PROFILING_SAMPLE_RATE share
+of all requests. While it runs, a background thread samples the request
+thread's stack every PROFILING_INTERVAL seconds and every query is timed.
+
+Each profile is saved to PROFILING_DIR as two files sharing an id:
+`<id>.collapsed` holds the sampled stacks in the collapsed format that
+flamegraph.pl and speedscope read, and `<id>.json` holds the request, its
+timings and its SQL. Only the newest PROFILING_MAX_PROFILES are kept.
+"""
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.utils import timezone
+
+TOKEN_HEADER = 'HTTP_X_PROFILE_TOKEN'
+TOKEN_SALT = 'emails.profiling'
+
+
+def make_token() -> str:
+    """
+    Return a value for the X-Profile-Token header, valid for
+    PROFILING_TOKEN_MAX_AGE seconds
+    """
+
+    return signing.dumps({'profile': True}, salt=TOKEN_SALT)
+
+
+def token_is_valid(token: str) -> bool:
+    try:
+        signing.loads(token, salt=TOKEN_SALT, max_age=settings.PROFILING_TOKEN_MAX_AGE)
+    except signing.BadSignature:
+        return False
+
+    return True
+
+
+def frame_name(frame) -> str:
+    code = frame.f_code
+    filename = code.co_filename
+
+    if 'site-packages' + os.sep in filename:
+        filename = filename.split('site-packages' + os.sep, 1)[1]
+    elif filename.startswith(settings.BASE_DIR):
+        filename = os.path.relpath(filename, settings.BASE_DIR)
+
+    return '{} ({}:{})'.format(code.co_name, filename, code.co_firstlineno)
+
+
+class StackSampler:
+    """
+    Samples one thread's stack from a background thread and counts how often
+    each stack was seen
+    """
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def run(self) -> None:
+        while True:
+            self.sample()
+
+            if self._stop.wait(self.interval):
+                return
+
+    def sample(self) -> None:
+        frame = sys._current_frames().get(self.thread_id)
+        names = []
+
+        while frame is not None:
+            names.append(frame_name(frame))
+            frame = frame.f_back
+
+        if names:
+            self.stacks[';'.join(reversed(names))] += 1
+
+    def collapsed(self) -> str:
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in self.stacks.most_common())
+
+
+class QueryRecorder:
+    """
+    Database execute wrapper keeping each query of a request with its time
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.queries = []
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.count += 1
+            self.seconds += elapsed
+
+            if len(self.queries) < self.limit:
+                self.queries.append({'sql': sql, 'ms': round(elapsed * 1000, 3), 'many': many})
+
+
+class ProfilingMiddleware:
+    def __init__(self, get_response):
+        if not settings.PROFILING_DIR:
+            raise MiddlewareNotUsed("PROFILING_DIR is not set")
+
+        self.get_response = get_response
+
+    def should_profile(self, request) -> bool:
+        token = request.META.get(TOKEN_HEADER)
+
+        if token:
+            return token_is_valid(token)
+
+        rate = settings.PROFILING_SAMPLE_RATE
+        return rate > 0 and random.random() < rate
+
+    def __call__(self, request):
+        if not self.should_profile(request):
+            return self.get_response(request)
+
+        sampler = StackSampler(threading.get_ident(), settings.PROFILING_INTERVAL)
+        recorder = QueryRecorder(settings.PROFILING_MAX_QUERIES)
+        started_at = timezone.now()
+        start = time.perf_counter()
+
+        sampler.start()
+        try:
+            with connection.execute_wrapper(recorder):
+                response = self.get_response(request)
+        finally:
+            sampler.stop()
+
+        elapsed = time.perf_counter() - start
+        user = getattr(request, 'user', None)
+
+        save_profile(sampler.collapsed(), {
+            'started_at': started_at.isoformat(),
+            'method': request.method,
+            'path': request.get_full_path(),
+            'user_id': getattr(user, 'id', None),
+            'status': response.status_code,
+            'ms': round(elapsed * 1000, 3),
+            'samples': sum(sampler.stacks.values()),
+            'interval_ms': settings.PROFILING_INTERVAL * 1000,
+            'queries': recorder.count,
+            'query_ms': round(recorder.seconds * 1000, 3),
+            'sql': recorder.queries,
+        })
+
+        return response
+
+
+def save_profile(collapsed: str, meta: dict) -> str:
+    """
+    Write a profile to PROFILING_DIR, drop the oldest ones over the limit
+    and return the new profile's id
+    """
+
+    directory = settings.PROFILING_DIR
+    os.makedirs(directory, exist_ok=True)
+
+    profile_id = '{}-{}'.format(timezone.now().strftime('%Y%m%dT%H%M%S%f'), uuid.uuid4().hex[:8])
+    meta = dict(meta, id=profile_id)
+
+    with open(os.path.join(directory, profile_id + '.collapsed'), 'w') as f:
+        f.write(collapsed)
+
+    # Written last, so a profile is only listed once both files exist
+    with open(os.path.join(directory, profile_id + '.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    for old_id in profile_ids()[settings.PROFILING_MAX_PROFILES:]:
+        delete_profile(old_id)
+
+    return profile_id
+
+
+def profile_ids() -> list:
+    """
+    Ids of every saved profile, newest first
+    """
+
+    try:
+        names = os.listdir(settings.PROFILING_DIR)
+    except FileNotFoundError:
+        return []
+
+    return sorted((name[:-len('.json')] for name in names if name.endswith('.json')), reverse=True)
+
+
+def list_profiles() -> list:
+    """
+    Metadata of every saved profile, newest first
+    """
+
+    profiles = []
+    for profile_id in profile_ids():
+        try:
+            with open(profile_path(profile_id, '.json')) as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            # Removed or still being written by another process
+            continue
+
+    return profiles
+
+
+def profile_path(profile_id: str, extension: str) -> str:
+    # Ids come from the command line; keep them inside PROFILING_DIR
+    return os.path.join(settings.PROFILING_DIR, os.path.basename(profile_id) + extension)
+
+
+def delete_profile(profile_id: str) -> None:
+    for extension in ('.json', '.collapsed'):
+        try:
+            os.remove(profile_path(profile_id, extension))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,241 @@
+"""
+Publish/subscribe for mailbox events such as new mail.
+
+Publishers are ordinary Django code running in any process. Subscribers are
+event stream connections, each an asyncio queue on the event loop of the
+ASGI process that serves it. LocalBroker hands events straight to the
+subscribers of its own process, which is all tests and single process setups
+need. PostgresBroker sends events through NOTIFY so every process that
+LISTENs on the channel can pass them on to its own subscribers.
+"""
+import asyncio
+import json
+import logging
+import threading
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+try:
+    import psycopg2
+except ImportError:
+    # psycopg2 is only needed by PostgresBroker
+    psycopg2 = None
+
+logger = logging.getLogger(__name__)
+
+
+class LocalBroker:
+    """
+    Fans events out to the subscribers in this process. Thread safe: events
+    are published from request threads and delivered on the subscriber's
+    own event loop.
+    """
+
+    queue_size = 100
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    async def start(self) -> None:
+        """
+        Prepare to receive events from other processes, if the broker can
+        """
+
+    def subscribe(self, user_id: int) -> asyncio.Queue:
+        queue = asyncio.Queue(self.queue_size)
+        loop = asyncio.get_event_loop()
+
+        with self._lock:
+            self._subscribers.setdefault(user_id, {})[queue] = loop
+
+        return queue
+
+    def unsubscribe(self, user_id: int, queue: asyncio.Queue) -> None:
+        with self._lock:
+            queues = self._subscribers.get(user_id, {})
+            queues.pop(queue, None)
+
+            if not queues:
+                self._subscribers.pop(user_id, None)
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return sum(len(queues) for queues in self._subscribers.values())
+
+    def publish(self, user_ids: list, event: dict) -> None:
+        self.dispatch(user_ids, event)
+
+    def dispatch(self, user_ids: list, event: dict) -> None:
+        with self._lock:
+            targets = [
+                (queue, loop)
+                for user_id in user_ids
+                for queue, loop in self._subscribers.get(user_id, {}).items()
+            ]
+
+        for queue, loop in targets:
+            loop.call_soon_threadsafe(self._offer, queue, event)
+
+    @staticmethod
+    def _offer(queue: asyncio.Queue, event: dict) -> None:
+        # A client that is this far behind gets the newest events only;
+        # every event tells it to sync, so nothing is lost by dropping one
+        if queue.full():
+            queue.get_nowait()
+
+        queue.put_nowait(event)
+
+
+class PostgresBroker(LocalBroker):
+    """
+    Carries events between processes with Postgres LISTEN/NOTIFY. Publishing
+    uses Django's connection; each listening process keeps one extra
+    connection open, watched by its event loop rather than by a thread.
+    """
+
+    # NOTIFY payloads must stay under 8000 bytes
+    max_payload = 7000
+    reconnect_delay = 5
+
+    def __init__(self, channel: str = 'emails_events'):
+        super().__init__()
+
+        if psycopg2 is None:
+            raise ImportError("PostgresBroker requires psycopg2. Install it with 'pip install psycopg2'.")
+
+        self.channel = channel
+        self._listener = None
+        self._listen_lock = None
+        self._reconnecting = None
+
+    def publish(self, user_ids: list, event: dict) -> None:
+        with connection.cursor() as cursor:
+            for chunk in self.chunks(list(user_ids), event):
+                cursor.execute('SELECT pg_notify(%s, %s)', [self.channel, chunk])
+
+    def chunks(self, user_ids: list, event: dict):
+        """
+        Split one event for many users into payloads that fit NOTIFY
+        """
+
+        start = 0
+        size = len(user_ids)
+
+        while start < len(user_ids):
+            payload = json.dumps({'users': user_ids[start:start + size], 'event': event}, separators=(',', ':'))
+
+            if len(payload) > self.max_payload and size > 1:
+                size //= 2
+                continue
+
+            yield payload
+            start += size
+
+    async def start(self) -> None:
+        await self.listen()
+
+    async def listen(self) -> None:
+        """
+        Connect the listener unless it is connected already. Only one
+        connection attempt runs at a time, from start() or a reconnect.
+        """
+
+        if self._listen_lock is None:
+            self._listen_lock = asyncio.Lock()
+
+        async with self._listen_lock:
+            if self._listener is not None:
+                return
+
+            # Connecting blocks, so keep it off the event loop
+            loop = asyncio.get_event_loop()
+            listener = await loop.run_in_executor(None, self.connect)
+
+            loop.add_reader(listener.fileno(), self.receive)
+            self._listener = listener
+
+    def connect(self):
+        database = settings.DATABASES['default']
+        listener = psycopg2.connect(
+            dbname=database['NAME'],
+            user=database.get('USER') or None,
+            password=database.get('PASSWORD') or None,
+            host=database.get('HOST') or None,
+            port=database.get('PORT') or None,
+        )
+        listener.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+
+        with listener.cursor() as cursor:
+            cursor.execute('LISTEN {}'.format(self.channel))
+
+        return listener
+
+    def receive(self) -> None:
+        listener = self._listener
+
+        try:
+            listener.poll()
+        except psycopg2.Error:
+            logger.exception("Lost the event listener connection; reconnecting")
+            self.reconnect()
+            return
+
+        while listener.notifies:
+            notify = listener.notifies.pop(0)
+
+            try:
+                message = json.loads(notify.payload)
+            except ValueError:
+                continue
+
+            self.dispatch(message['users'], message['event'])
+
+    def reconnect(self) -> None:
+        loop = asyncio.get_event_loop()
+        listener, self._listener = self._listener, None
+
+        loop.remove_reader(listener.fileno())
+        listener.close()
+
+        if self._reconnecting is None:
+            self._reconnecting = loop.create_task(self.keep_reconnecting())
+
+    async def keep_reconnecting(self) -> None:
+        try:
+            while self._listener is None:
+                await asyncio.sleep(self.reconnect_delay)
+
+                try:
+                    await self.listen()
+                except psycopg2.Error:
+                    logger.exception("Could not reconnect the event listener")
+        finally:
+            self._reconnecting = None
+
+
+@lru_cache(maxsize=None)
+def get_broker() -> LocalBroker:
+    """
+    Return the process wide broker configured in settings
+    """
+
+    config = settings.MAILBOX_EVENTS
+    backend = import_string(config['BACKEND'])
+
+    return backend(**config.get('OPTIONS', {}))
+
+
+def publish(user_ids: list, event: dict) -> None:
+    """
+    Publish an event without letting a broker failure fail the caller.
+    Events are hints; clients that miss one still catch up on their next sync.
+    """
+
+    try:
+        get_broker().publish(user_ids, event)
+    except Exception:
+        logger.exception("Could not publish a mailbox event")
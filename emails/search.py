@@ -0,0 +1,264 @@
+"""
+Full text search over the subject and message of a user's mail.
+
+Postgres keeps a weighted `search_vector` tsvector column on emails_email,
+filled in by a trigger on every write and indexed with GIN. SQLite, used
+for local and test runs, keeps an external content FTS5 table in sync with
+triggers instead. Neither lives on the Email model; `install_index` creates
+them from a migration.
+
+Django rebuilds emails_email from scratch on SQLite for many schema changes,
+which drops its triggers. Migrations that alter Email must call
+`install_index` again afterwards.
+"""
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime, time
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import OuterRef, Q, Subquery
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from rest_framework.exceptions import ValidationError
+
+from emails.models import Attachment, Email, Mailbox, Recipient
+
+POSTGRES_INSTALL = [
+    "ALTER TABLE emails_email ADD COLUMN IF NOT EXISTS search_vector tsvector",
+    """
+    CREATE OR REPLACE FUNCTION emails_email_search_vector_update() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector :=
+            setweight(to_tsvector('english', coalesce(NEW.subject, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce(NEW.message, '')), 'B');
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS emails_email_search_vector_trigger ON emails_email",
+    """
+    CREATE TRIGGER emails_email_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF subject, message ON emails_email
+    FOR EACH ROW EXECUTE PROCEDURE emails_email_search_vector_update()
+    """,
+    """
+    UPDATE emails_email SET search_vector =
+        setweight(to_tsvector('english', coalesce(subject, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(message, '')), 'B')
+    """,
+    "CREATE INDEX IF NOT EXISTS emails_email_search_vector_idx ON emails_email USING GIN (search_vector)",
+]
+
+POSTGRES_UNINSTALL = [
+    "DROP TRIGGER IF EXISTS emails_email_search_vector_trigger ON emails_email",
+    "DROP FUNCTION IF EXISTS emails_email_search_vector_update()",
+    "ALTER TABLE emails_email DROP COLUMN IF EXISTS search_vector",
+]
+
+SQLITE_INSTALL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS emails_email_fts
+    USING fts5(subject, message, content='emails_email', content_rowid='id')
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS emails_email_fts_insert AFTER INSERT ON emails_email BEGIN
+        INSERT INTO emails_email_fts(rowid, subject, message) VALUES (new.id, new.subject, new.message);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS emails_email_fts_delete AFTER DELETE ON emails_email BEGIN
+        INSERT INTO emails_email_fts(emails_email_fts, rowid, subject, message)
+        VALUES ('delete', old.id, old.subject, old.message);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS emails_email_fts_update AFTER UPDATE OF subject, message ON emails_email BEGIN
+        INSERT INTO emails_email_fts(emails_email_fts, rowid, subject, message)
+        VALUES ('delete', old.id, old.subject, old.message);
+        INSERT INTO emails_email_fts(rowid, subject, message) VALUES (new.id, new.subject, new.message);
+    END
+    """,
+    "INSERT INTO emails_email_fts(emails_email_fts) VALUES ('rebuild')",
+]
+
+SQLITE_UNINSTALL = [
+    "DROP TRIGGER IF EXISTS emails_email_fts_insert",
+    "DROP TRIGGER IF EXISTS emails_email_fts_delete",
+    "DROP TRIGGER IF EXISTS emails_email_fts_update",
+    "DROP TABLE IF EXISTS emails_email_fts",
+]
+
+
+def install_index(schema_editor) -> None:
+    """
+    Create or refresh the search index for the current database
+    """
+
+    statements = {'postgresql': POSTGRES_INSTALL, 'sqlite': SQLITE_INSTALL}
+    for sql in statements.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(sql)
+
+
+def uninstall_index(schema_editor) -> None:
+    statements = {'postgresql': POSTGRES_UNINSTALL, 'sqlite': SQLITE_UNINSTALL}
+    for sql in statements.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(sql)
+
+
+class PostgresSearchBackend:
+    tables = []
+
+    def match(self, terms: list):
+        return "emails_email.search_vector @@ plainto_tsquery('english', %s)", [' '.join(terms)]
+
+    def rank(self, terms: list):
+        return "ts_rank_cd(emails_email.search_vector, plainto_tsquery('english', %s))", [' '.join(terms)]
+
+
+class SQLiteSearchBackend:
+    tables = ['emails_email_fts']
+
+    @staticmethod
+    def fts_query(terms: list) -> str:
+        # Quote every term so user input is never read as FTS5 syntax
+        return ' '.join('"{}"'.format(term.replace('"', '""')) for term in terms)
+
+    def match(self, terms: list):
+        return "emails_email_fts.rowid = emails_email.id AND emails_email_fts MATCH %s", [self.fts_query(terms)]
+
+    def rank(self, terms: list):
+        # bm25() is lower for better matches; subject counts double
+        return "-bm25(emails_email_fts, 2.0, 1.0)", []
+
+
+def get_backend():
+    backends = {'postgresql': PostgresSearchBackend, 'sqlite': SQLiteSearchBackend}
+
+    try:
+        return backends[connection.vendor]()
+    except KeyError:
+        raise ValidationError({'q': "Search is not available on this database."})
+
+
+def day_start(value: str, operator: str):
+    day = parse_date(value)
+
+    if day is None:
+        raise ValidationError({'q': "{}: expects a date like 2019-06-25.".format(operator)})
+
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def parse_query(text: str, user: User):
+    """
+    Split a query into free text terms and a Q object for the operators:
+    from:, to:, before:, after:, has:attachment and is:read / is:unread.
+    Read state is `user`'s own.
+    """
+
+    terms = []
+    filters = Q()
+
+    for token in text.split():
+        operator, _, value = token.partition(':')
+        operator = operator.lower()
+
+        if not value:
+            terms.append(token)
+        elif operator == 'from':
+            filters &= Q(sender__username=value) | Q(external_sender__iexact=value)
+        elif operator == 'to':
+            # Bcc recipients stay hidden from search
+            recipients = Recipient.objects\
+                .filter(user__username=value)\
+                .exclude(kind=Recipient.BCC)\
+                .values('email_id')
+            filters &= Q(id__in=recipients)
+        elif operator == 'before':
+            filters &= Q(created_at__lt=day_start(value, operator))
+        elif operator == 'after':
+            filters &= Q(created_at__gte=day_start(value, operator))
+        elif operator == 'has' and value.lower() == 'attachment':
+            filters &= Q(id__in=Attachment.objects.values('email_id'))
+        elif operator == 'is' and value.lower() in ('read', 'unread'):
+            rows = Mailbox.objects.filter(user=user, read=value.lower() == 'read')
+            filters &= Q(id__in=rows.values('email_id'))
+        else:
+            terms.append(token)
+
+    return terms, filters
+
+
+def mailbox_q(user: User) -> Q:
+    """
+    Filter for emails in any of the user's folders
+    """
+
+    return Q(id__in=Mailbox.objects.filter(user=user).values('email_id'))
+
+
+def encode_cursor(rank: float, pk: int) -> str:
+    return urlsafe_b64encode('{!r}|{}'.format(rank, pk).encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        rank, pk = urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return float(rank), int(pk)
+    except ValueError:
+        raise ValidationError({'cursor': 'Invalid cursor.'})
+
+
+def search_emails(user: User, text: str, cursor: str, limit: int):
+    """
+    Return (emails, next_cursor) for one page of results, best match first
+    """
+
+    terms, filters = parse_query(text, user)
+    row = Mailbox.objects.filter(user=user, email=OuterRef('pk'))
+    queryset = Email.objects\
+        .filter(mailbox_q(user))\
+        .filter(filters)\
+        .annotate(read=Subquery(row.values('read')[:1]), starred=Subquery(row.values('starred')[:1]))\
+        .select_related('sender', 'receiver')\
+        .defer('message')
+
+    where = []
+    params = []
+    tables = []
+
+    if terms:
+        backend = get_backend()
+        rank_sql, rank_params = backend.rank(terms)
+        match_sql, match_params = backend.match(terms)
+
+        tables = backend.tables
+        where.append(match_sql)
+        params.extend(match_params)
+    else:
+        # Without terms every email ranks the same and results are newest first
+        rank_sql, rank_params = '0', []
+
+    if cursor:
+        rank, pk = decode_cursor(cursor)
+        where.append("({0} < %s OR ({0} = %s AND emails_email.id < %s))".format(rank_sql))
+        params.extend(rank_params + [rank] + rank_params + [rank, pk])
+
+    queryset = queryset.extra(
+        select={'rank': rank_sql},
+        select_params=rank_params,
+        tables=tables,
+        where=where,
+        params=params,
+        order_by=['-rank', '-id'],
+    )
+
+    emails = list(queryset[:limit + 1])
+    next_cursor = None
+
+    if len(emails) > limit:
+        emails = emails[:limit]
+        next_cursor = encode_cursor(emails[-1].rank, emails[-1].id)
+
+    return emails, next_cursor
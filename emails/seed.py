@@ -0,0 +1,105 @@
+"""
+Synthetic mailboxes for benchmarks and query plan checks.
+"""
+import random
+
+from django.contrib.auth.models import User
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+
+from emails.counters import rebuild_counters
+from emails.models import Attachment, Blob, Email, Mailbox, Recipient, make_snippet
+
+WORDS = (
+    'budget meeting lunch report invoice travel launch review design notes '
+    'schedule offsite hiring quarterly release roadmap customer follow up '
+    'draft contract update summary agenda feedback'
+).split()
+
+
+class Rollback(Exception):
+    """
+    Raised inside an atomic block to throw seeded data away again
+    """
+
+
+def sentence(rng: random.Random, words: int) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def seed_mailboxes(users: int, emails: int, attachments: int = 0, password: str = 'benchmark',
+                   prefix: str = 'seed', seed: int = 0) -> list:
+    """
+    Create `users` users who each send `emails` emails to random other
+    users, with `attachments` attachments per email. Every recipient gets
+    the email in their inbox and a tenth of them are starred.
+    Returns the created users.
+    """
+
+    rng = random.Random(seed)
+    hashed = make_password(password)
+
+    with transaction.atomic():
+        User.objects.bulk_create([
+            User(username='{}{}'.format(prefix, i), password=hashed) for i in range(users)
+        ])
+        created = list(User.objects.filter(username__startswith=prefix).order_by('id'))
+
+        pairs = []
+        for sender in created:
+            for _ in range(emails):
+                receiver = rng.choice(created)
+                pairs.append((sender, receiver))
+
+        # bulk_create only hands ids back on some databases, so read them back
+        first = Email.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        rows = []
+        for sender, receiver in pairs:
+            subject = sentence(rng, 4)
+            message = sentence(rng, 60)
+            rows.append(Email(
+                subject=subject,
+                message=message,
+                snippet=make_snippet(message),
+                sender=sender,
+                receiver=receiver,
+            ))
+        Email.objects.bulk_create(rows)
+        email_ids = list(Email.objects.filter(id__gt=first).order_by('id').values_list('id', flat=True))
+
+        Recipient.objects.bulk_create([
+            Recipient(email_id=email_id, user=receiver, kind=Recipient.TO)
+            for email_id, (sender, receiver) in zip(email_ids, pairs)
+        ])
+        # An email sent to oneself only sits in the inbox
+        Mailbox.objects.bulk_create([
+            Mailbox(user=receiver, email_id=email_id, folder=Mailbox.INBOX, starred=rng.random() < 0.1)
+            for email_id, (sender, receiver) in zip(email_ids, pairs)
+        ] + [
+            Mailbox(user=sender, email_id=email_id, folder=Mailbox.SENT, read=True)
+            for email_id, (sender, receiver) in zip(email_ids, pairs)
+            if sender != receiver
+        ])
+        rebuild_counters([user.id for user in created])
+
+        if attachments:
+            blob, _ = Blob.objects.get_or_create(
+                sha256='0' * 64,
+                defaults={'object_name': '{}-blob'.format(prefix), 'size': 0, 'state': Blob.STORED},
+            )
+            Attachment.objects.bulk_create([
+                Attachment(
+                    name='file{}.txt'.format(i),
+                    object_name=blob.object_name,
+                    size=0,
+                    sha256=blob.sha256,
+                    state=Attachment.STORED,
+                    email_id=email_id,
+                    blob=blob,
+                )
+                for email_id in email_ids
+                for i in range(attachments)
+            ])
+            Blob.objects.filter(id=blob.id).update(refcount=len(email_ids) * attachments)
+
+    return created
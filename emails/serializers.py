@@ -1,9 +1,11 @@
+from django.conf import settings
 from django.contrib.auth.models import User
 
 from rest_framework import serializers
 from rest_framework_jwt.settings import api_settings
 
-from emails.models import Email, Attachment, SecurityAnswer
+from emails.delivery import send_email
+from emails.models import Attachment, Recipient, SecurityAnswer
 
 
 class UserSerializer(serializers.Serializer):
@@ -81,34 +83,97 @@ class AttachmentSerializer(serializers.Serializer):
         return Attachment.objects.create(**validated_data)
 
 
+class ReadStateSerializer(serializers.Serializer):
+    read = serializers.BooleanField(default=True)
+
+
 class EmailSerializer(serializers.Serializer):
     id = serializers.IntegerField(label='ID', read_only=True)
     subject = serializers.CharField(required=True, allow_blank=False, max_length=100)
     message = serializers.CharField(required=True, allow_blank=False)
-    read = serializers.BooleanField(required=False)
+    read = serializers.BooleanField(read_only=True)
+    starred = serializers.BooleanField(read_only=True)
     created_at = serializers.DateTimeField(required=False)
-    sender = UserSerializer()
-    receiver = UserSerializer()
+    sender = UserSerializer(read_only=True)
+    external_sender = serializers.CharField(read_only=True)
+    receiver = UserSerializer(read_only=True)
+    to = serializers.ListField(child=serializers.CharField(), required=False, write_only=True)
+    cc = serializers.ListField(child=serializers.CharField(), required=False, write_only=True)
+    bcc = serializers.ListField(child=serializers.CharField(), required=False, write_only=True)
+    forward_attachments = serializers.ListField(child=serializers.IntegerField(), required=False, write_only=True)
+
+    def validate(self, data: dict):
+        to = data.get('to', [])
+        cc = data.get('cc', [])
+        bcc = data.get('bcc', [])
+
+        # Older clients send a single `receiver` object instead of lists
+        receiver = self.initial_data.get('receiver')
+        if not to and isinstance(receiver, dict) and receiver.get('username'):
+            to = [receiver['username']]
+
+        # A user listed more than once only receives the most visible copy
+        kinds = {}
+        for kind, usernames in ((Recipient.TO, to), (Recipient.CC, cc), (Recipient.BCC, bcc)):
+            for username in usernames:
+                kinds.setdefault(username, kind)
+
+        if not kinds:
+            raise serializers.ValidationError({'to': "Add at least one recipient."})
+
+        if len(kinds) > settings.MAX_EMAIL_RECIPIENTS:
+            raise serializers.ValidationError(
+                {'to': "Too many recipients. The limit is {}.".format(settings.MAX_EMAIL_RECIPIENTS)}
+            )
+
+        users = {user.username: user for user in User.objects.filter(username__in=list(kinds))}
+        missing = sorted(set(kinds) - set(users))
+
+        if missing:
+            raise serializers.ValidationError(
+                {'receiver': "User does not exist: {}. Try another.".format(', '.join(missing))}
+            )
+
+        data['recipients'] = [(users[username], kind) for username, kind in kinds.items()]
+
+        return data
 
     def create(self, validated_data):
         """
-        Create and return a new `Email` instance, given the validated data
+        Create and return a new `Email` instance delivered to all recipients
 
         """
 
-        sender_data = validated_data.pop('sender')
-        receiver_data = validated_data.pop('receiver')
+        return send_email(
+            sender=self.context['sender'],
+            subject=validated_data['subject'],
+            message=validated_data['message'],
+            recipients=validated_data['recipients'],
+        )
 
-        sender = User.objects.get(username=sender_data['username'])
-        receiver = User.objects.get(username=receiver_data['username'])
 
-        validated_data['sender'] = sender
-        validated_data['receiver'] = receiver
+class EmailListSerializer(serializers.Serializer):
+    """
+    Folder listing projection: the snippet stands in for the message body
+    """
 
-        return Email.objects.create(**validated_data)
+    id = serializers.IntegerField(label='ID', read_only=True)
+    subject = serializers.CharField(read_only=True)
+    snippet = serializers.CharField(read_only=True)
+    read = serializers.BooleanField(read_only=True)
+    starred = serializers.BooleanField(read_only=True)
+    created_at = serializers.DateTimeField(read_only=True)
+    sender = UserSerializer(read_only=True)
+    external_sender = serializers.CharField(read_only=True)
+    receiver = UserSerializer(read_only=True)
+
+
+class AttachmentInfoSerializer(serializers.Serializer):
+    id = serializers.IntegerField(label='ID', read_only=True)
+    name = serializers.CharField(read_only=True)
+    size = serializers.IntegerField(read_only=True)
+    state = serializers.CharField(read_only=True)
 
-    def update(self, instance, validated_data):
-        instance.read = validated_data.get('read', instance.read)
-        instance.save()
 
-        return instance
+class EmailDetailSerializer(EmailSerializer):
+    attachments = AttachmentInfoSerializer(many=True, read_only=True)
@@ -0,0 +1,395 @@
+"""
+Inbound SMTP: mail from other servers to local users.
+
+The `smtpd` command serves SMTP with aiosmtpd on one event loop, so an idle
+or slow connection costs a coroutine rather than a thread. Recipients are
+accepted when their address is <username>@<one of SMTP_DOMAINS>. Accepted
+messages are parsed on the shared thread pool and handed to a
+MessageBatcher, which saves them SMTP_BATCH_SIZE at a time: one transaction
+creates the emails, queues their attachments for storage and delivers them
+to every recipient's inbox. A message is only acknowledged once its batch
+has committed, so a crash never loses mail the sender thinks was delivered.
+
+aiosmtpd holds each message in memory from DATA until it is answered, so
+senders are told to try again later, before they send anything, when
+SMTP_QUEUE_SIZE messages already wait to be saved or when receiving the
+message could take the data held at once past SMTP_MAX_DATA_BYTES. A message
+counts for its declared SIZE, which it may not exceed, or for
+SMTP_MAX_MESSAGE_SIZE. Attachments are decoded to temporary files as a
+message is parsed, so a message waiting for its batch holds little more
+than its raw content and text.
+
+Senders are not authenticated, so inbound emails have no local sender. The
+From address is kept as the email's external sender.
+"""
+import asyncio
+import logging
+import threading
+from email import policy
+from email.parser import BytesParser
+from email.utils import getaddresses
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.db import close_old_connections, connection, transaction
+from django.utils.html import strip_tags
+
+from emails.cache import LRUCache
+from emails.delivery import deliver_emails
+from emails.handlers import run_sync
+from emails.models import Email, Recipient, make_snippet
+from emails.uploads import discard_spooled, queue_attachments
+
+logger = logging.getLogger(__name__)
+
+SUBJECT_LENGTH = Email._meta.get_field('subject').max_length
+SENDER_LENGTH = Email._meta.get_field('external_sender').max_length
+
+MISSING = object()
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class MessageRejected(Exception):
+    """
+    Raised for a message that will never be accepted, with the SMTP reply
+    """
+
+
+class InboundMessage:
+    def __init__(self, sender: str, subject: str, message: str, recipients: list, attachments: list):
+        self.sender = sender
+        self.subject = subject
+        self.message = message
+        # (user_id, kind) pairs, one per user
+        self.recipients = recipients
+        # Temporary files, removed by close()
+        self.attachments = attachments
+
+    def close(self) -> None:
+        for attachment in self.attachments:
+            attachment.close()
+
+
+def local_username(address: str):
+    """
+    The username an address delivers to, or None if it is not ours
+    """
+
+    local, _, domain = address.rpartition('@')
+
+    if not local or domain.lower() not in settings.SMTP_DOMAINS:
+        return None
+
+    return local
+
+
+def get_recipient_cache() -> LRUCache:
+    global _cache
+
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = LRUCache(settings.SMTP_RECIPIENT_CACHE_SIZE)
+
+    return _cache
+
+
+def local_user_id(address: str):
+    """
+    Id of the active user an address delivers to, or None. Answers, including
+    unknown users, are cached for SMTP_RECIPIENT_CACHE_TTL seconds.
+    """
+
+    username = local_username(address)
+
+    if username is None:
+        return None
+
+    cache = get_recipient_cache()
+    user_id = cache.get(username, MISSING)
+
+    if user_id is MISSING:
+        try:
+            user_id = User.objects.filter(username=username, is_active=True).values_list('id', flat=True).first()
+        finally:
+            close_old_connections()
+
+        cache.set(username, user_id, ttl=settings.SMTP_RECIPIENT_CACHE_TTL)
+
+    return user_id
+
+
+def decode_text(part) -> str:
+    try:
+        return part.get_content()
+    except (LookupError, UnicodeDecodeError):
+        # An unknown or wrong charset; keep what reads as UTF-8
+        return (part.get_payload(decode=True) or b'').decode('utf-8', 'replace')
+
+
+def decode_attachment(part) -> TemporaryUploadedFile:
+    data = part.get_payload(decode=True) or b''
+
+    if len(data) > settings.ATTACHMENT_MAX_FILE_SIZE:
+        raise MessageRejected('552 5.3.4 Attachment too large')
+
+    file = TemporaryUploadedFile(part.get_filename() or 'attachment', part.get_content_type(), len(data), None)
+    file.write(data)
+    file.seek(0)
+
+    return file
+
+
+def parse_message(content: bytes, rcpt_users: dict, mail_from: str = '') -> InboundMessage:
+    """
+    Turn a received message into what is saved for it. `rcpt_users` maps each
+    accepted RCPT address to its user id. Recipients in the To and Cc headers
+    get those kinds; everyone else was a Bcc. The sender is the From address,
+    or the envelope's `mail_from` when there is none.
+    """
+
+    parsed = BytesParser(policy=policy.default).parsebytes(content)
+
+    headers = {
+        address.lower(): kind
+        for kind, name in ((Recipient.CC, 'cc'), (Recipient.TO, 'to'))
+        for _, address in getaddresses(parsed.get_all(name, []))
+    }
+
+    kinds = {}
+    for address, user_id in rcpt_users.items():
+        kinds.setdefault(user_id, headers.get(address.lower(), Recipient.BCC))
+
+    recipients = list(kinds.items())
+
+    body = parsed.get_body(preferencelist=('plain', 'html'))
+    message = ''
+    if body is not None:
+        message = decode_text(body)
+        if body.get_content_type() == 'text/html':
+            message = strip_tags(message)
+
+    senders = [address for _, address in getaddresses(parsed.get_all('from', [])) if address]
+    sender = senders[0] if senders else mail_from
+
+    subject = ' '.join(str(parsed.get('subject', '')).split())
+
+    attachments = []
+    try:
+        for part in parsed.iter_attachments():
+            attachments.append(decode_attachment(part))
+    except Exception:
+        for attachment in attachments:
+            attachment.close()
+        raise
+
+    return InboundMessage(sender[:SENDER_LENGTH], subject[:SUBJECT_LENGTH], message, recipients, attachments)
+
+
+def save_messages(messages: list, spooled: list) -> None:
+    emails = [
+        Email(
+            subject=message.subject,
+            message=message.message,
+            snippet=make_snippet(message.message),
+            external_sender=message.sender,
+            # Only a To recipient is shown as the receiver, never a Cc or Bcc
+            receiver_id=next((user_id for user_id, kind in message.recipients if kind == Recipient.TO), None),
+        )
+        for message in messages
+    ]
+
+    if connection.features.can_return_ids_from_bulk_insert:
+        Email.objects.bulk_create(emails)
+    else:
+        for email in emails:
+            email.save()
+
+    Recipient.objects.bulk_create([
+        Recipient(email=email, user_id=user_id, kind=kind)
+        for email, message in zip(emails, messages)
+        for user_id, kind in message.recipients
+    ])
+
+    for email, message in zip(emails, messages):
+        if message.attachments:
+            queue_attachments(email, message.attachments, spooled)
+
+    deliver_emails([email.id for email in emails])
+
+
+def store_messages(messages: list) -> list:
+    """
+    Save a batch of messages in one transaction. If that fails, save them
+    one by one so a single bad message does not fail the rest. Returns None
+    for each saved message and the exception for each one that was not.
+    """
+
+    try:
+        spooled = []
+        try:
+            with transaction.atomic():
+                save_messages(messages, spooled)
+
+            return [None] * len(messages)
+        except Exception:
+            logger.exception("Saving a batch of %d messages failed; saving them one by one", len(messages))
+            discard_spooled(spooled)
+
+        errors = []
+        for message in messages:
+            spooled = []
+            try:
+                with transaction.atomic():
+                    save_messages([message], spooled)
+            except Exception as e:
+                logger.exception("Saving an inbound message failed")
+                discard_spooled(spooled)
+                errors.append(e)
+            else:
+                errors.append(None)
+
+        return errors
+    finally:
+        for message in messages:
+            message.close()
+
+        close_old_connections()
+
+
+class MessageBatcher:
+    """
+    Collects messages from every connection and saves them in batches of up
+    to `batch_size`, waiting at most `window` seconds for a batch to fill.
+    At most `queue_size` messages wait to be saved.
+    """
+
+    def __init__(self, batch_size: int, window: float, queue_size: int = 0):
+        self.batch_size = batch_size
+        self.window = window
+        self.queue = asyncio.Queue(queue_size)
+
+    async def submit(self, message: InboundMessage) -> None:
+        """
+        Wait until the message is saved; raises if it could not be, and
+        asyncio.QueueFull without waiting if too many messages are waiting
+        """
+
+        future = asyncio.get_event_loop().create_future()
+        self.queue.put_nowait((message, future))
+        await future
+
+    async def run(self) -> None:
+        loop = asyncio.get_event_loop()
+
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window
+
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            errors = await run_sync(store_messages, [message for message, _ in batch])
+
+            for (_, future), error in zip(batch, errors):
+                if future.done():
+                    continue
+
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+
+            for _ in batch:
+                self.queue.task_done()
+
+    async def join(self) -> None:
+        """
+        Wait until every submitted message has been saved or failed
+        """
+
+        await self.queue.join()
+
+
+class InboundHandler:
+    """
+    aiosmtpd handler accepting mail for local users
+    """
+
+    def __init__(self, batcher: MessageBatcher, max_data_bytes: int):
+        self.batcher = batcher
+        self.max_data_bytes = max_data_bytes
+        # Bytes reserved by messages being received, parsed or saved
+        self.data_bytes = 0
+
+    def reserve_data(self, mail_options: list) -> int:
+        """
+        Reserve room for a message about to be received: its declared SIZE,
+        or the largest message allowed. Returns the bytes reserved, or 0 if
+        the message has to wait.
+        """
+
+        size = settings.SMTP_MAX_MESSAGE_SIZE
+        for option in mail_options:
+            name, _, value = option.partition('=')
+            if name.upper() == 'SIZE' and value.isdigit():
+                size = min(size, int(value))
+
+        size = max(size, 1)
+
+        if self.batcher.queue.full() or self.data_bytes + size > self.max_data_bytes:
+            return 0
+
+        self.data_bytes += size
+        return size
+
+    def release_data(self, size: int) -> None:
+        self.data_bytes -= size
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        # Turned away before the message is sent rather than after
+        if self.batcher.queue.full():
+            return '451 4.3.2 Too busy, try again later'
+
+        if len(envelope.rcpt_tos) >= settings.MAX_EMAIL_RECIPIENTS:
+            return '452 4.5.3 Too many recipients'
+
+        user_id = await run_sync(local_user_id, address)
+
+        if user_id is None:
+            return '550 5.1.1 No such user here'
+
+        envelope.rcpt_tos.append(address)
+        if not hasattr(envelope, 'rcpt_users'):
+            envelope.rcpt_users = {}
+        envelope.rcpt_users[address] = user_id
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        try:
+            message = await run_sync(parse_message, envelope.original_content, envelope.rcpt_users, envelope.mail_from)
+        except MessageRejected as e:
+            return str(e)
+        except Exception:
+            logger.exception("Could not parse an inbound message")
+            return '554 5.6.0 Message could not be parsed'
+
+        try:
+            await self.batcher.submit(message)
+        except asyncio.QueueFull:
+            message.close()
+            return '451 4.3.2 Too busy, try again later'
+        except Exception:
+            return '451 4.3.0 Could not store the message, try again later'
+
+        return '250 Message accepted for delivery'
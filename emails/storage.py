@@ -0,0 +1,382 @@
+"""
+Attachment storage backends.
+
+The backend is picked by the ATTACHMENT_STORAGE setting:
+
+    ATTACHMENT_STORAGE = {
+        'BACKEND': 'emails.storage.S3Storage',
+        'OPTIONS': {'bucket': 'reply-django-server'},
+    }
+
+Backends are built once per process and shared between threads, so the S3
+client (and its connection pool) is reused across requests.
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+from functools import lru_cache
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import ImproperlyConfigured
+from django.urls import reverse
+from django.utils.module_loading import import_string
+
+try:
+    import boto3
+    from botocore.config import Config
+    from botocore.exceptions import BotoCoreError, ClientError
+except ImportError:
+    # boto3 is only needed by S3Storage
+    boto3 = None
+
+
+class StorageError(Exception):
+    """
+    Raised when a backend fails to read, write or sign an object
+    """
+
+
+def content_disposition(filename: str) -> str:
+    """
+    Content-Disposition header value that downloads a file as `filename`
+    """
+
+    try:
+        filename.encode('ascii')
+    except UnicodeEncodeError:
+        return "attachment; filename*=utf-8''{}".format(quote(filename))
+
+    return 'attachment; filename="{}"'.format(filename.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+class AttachmentStorage:
+    """
+    Interface every attachment backend implements
+    """
+
+    def save(self, file, object_name: str) -> None:
+        raise NotImplementedError
+
+    def open(self, object_name: str):
+        raise NotImplementedError
+
+    def delete(self, object_name: str) -> None:
+        raise NotImplementedError
+
+    def url(self, object_name: str, expires: int = 300, filename: str = None) -> str:
+        """
+        Return a download link for `object_name`. With `filename` the file
+        downloads under that name.
+        """
+
+        raise NotImplementedError
+
+    def open_writer(self, object_name: str):
+        """
+        Return a writer that stores `object_name` from chunks passed to
+        `write`. `close` commits the object and `abort` throws it away.
+        """
+
+        return SpooledWriter(self, object_name)
+
+
+class SpooledWriter:
+    """
+    Fallback writer for backends that can only store whole files
+    """
+
+    def __init__(self, storage: AttachmentStorage, object_name: str):
+        self.storage = storage
+        self.object_name = object_name
+        self.file = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+
+    def write(self, data: bytes) -> None:
+        self.file.write(data)
+
+    def close(self) -> None:
+        try:
+            self.file.seek(0)
+            self.storage.save(self.file, self.object_name)
+        finally:
+            self.file.close()
+
+    def abort(self) -> None:
+        self.file.close()
+
+
+class S3MultipartWriter:
+    """
+    Stream an object to S3 as a multipart upload, holding at most one part
+    in memory. Objects smaller than one part are sent with a single PUT.
+    """
+
+    def __init__(self, storage: 'S3Storage', object_name: str):
+        self.client = storage.client
+        self.bucket = storage.bucket
+        self.object_name = object_name
+        self.part_size = storage.part_size
+
+        self.buffer = bytearray()
+        self.parts = []
+        self.upload_id = None
+
+    def write(self, data: bytes) -> None:
+        self.buffer += data
+
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+
+    def close(self) -> None:
+        try:
+            if self.upload_id is None:
+                self.client.put_object(Bucket=self.bucket, Key=self.object_name, Body=bytes(self.buffer))
+                return
+
+            if self.buffer:
+                self._upload_part(bytes(self.buffer))
+
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.object_name,
+                UploadId=self.upload_id,
+                MultipartUpload={'Parts': self.parts},
+            )
+        except (BotoCoreError, ClientError) as e:
+            self.abort()
+            raise StorageError(e)
+        finally:
+            self.buffer = bytearray()
+
+    def abort(self) -> None:
+        self.buffer = bytearray()
+
+        if self.upload_id is None:
+            return
+
+        try:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.object_name,
+                UploadId=self.upload_id,
+            )
+        except (BotoCoreError, ClientError) as e:
+            raise StorageError(e)
+        finally:
+            self.upload_id = None
+
+    def _upload_part(self, body: bytes) -> None:
+        try:
+            if self.upload_id is None:
+                self.upload_id = self.client.create_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=self.object_name,
+                )['UploadId']
+
+            number = len(self.parts) + 1
+            response = self.client.upload_part(
+                Bucket=self.bucket,
+                Key=self.object_name,
+                UploadId=self.upload_id,
+                PartNumber=number,
+                Body=body,
+            )
+        except (BotoCoreError, ClientError) as e:
+            raise StorageError(e)
+
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': number})
+
+
+class LocalWriter:
+    """
+    Stream an object to a partial file that is renamed into place on close
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.partial_path = path + '.part'
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.file = open(self.partial_path, 'wb')
+        except OSError as e:
+            raise StorageError(e)
+
+    def write(self, data: bytes) -> None:
+        try:
+            self.file.write(data)
+        except OSError as e:
+            raise StorageError(e)
+
+    def close(self) -> None:
+        try:
+            self.file.close()
+            os.replace(self.partial_path, self.path)
+        except OSError as e:
+            raise StorageError(e)
+
+    def abort(self) -> None:
+        self.file.close()
+
+        try:
+            os.remove(self.partial_path)
+        except FileNotFoundError:
+            pass
+
+
+class S3Storage(AttachmentStorage):
+    """
+    Store attachments in an S3 bucket through one shared, pooled client
+    """
+
+    def __init__(self, bucket: str, access_key: str = None, secret_key: str = None,
+                 region: str = None, max_pool_connections: int = 50, part_size: int = 8 * 1024 * 1024):
+        if boto3 is None:
+            raise ImproperlyConfigured("S3Storage requires boto3. Install it with 'pip install boto3'.")
+
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.max_pool_connections = max_pool_connections
+        # S3 rejects multipart parts under 5 MB, except for the last one
+        self.part_size = max(part_size, 5 * 1024 * 1024)
+
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        # boto3 clients are thread safe once built, but building one is not
+        # cheap, so only the first caller pays for it
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = boto3.session.Session().client(
+                        's3',
+                        aws_access_key_id=self.access_key,
+                        aws_secret_access_key=self.secret_key,
+                        region_name=self.region,
+                        config=Config(max_pool_connections=self.max_pool_connections),
+                    )
+
+        return self._client
+
+    def save(self, file, object_name: str) -> None:
+        try:
+            self.client.upload_fileobj(file, self.bucket, object_name)
+        except (BotoCoreError, ClientError) as e:
+            raise StorageError(e)
+
+    def open(self, object_name: str):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=object_name)['Body']
+        except (BotoCoreError, ClientError) as e:
+            raise StorageError(e)
+
+    def delete(self, object_name: str) -> None:
+        try:
+            self.client.delete_object(Bucket=self.bucket, Key=object_name)
+        except (BotoCoreError, ClientError) as e:
+            raise StorageError(e)
+
+    def url(self, object_name: str, expires: int = 300, filename: str = None) -> str:
+        params = {'Bucket': self.bucket, 'Key': object_name}
+
+        if filename:
+            params['ResponseContentDisposition'] = content_disposition(filename)
+
+        try:
+            return self.client.generate_presigned_url('get_object', Params=params, ExpiresIn=expires)
+        except (BotoCoreError, ClientError) as e:
+            raise StorageError(e)
+
+    def open_writer(self, object_name: str) -> S3MultipartWriter:
+        return S3MultipartWriter(self, object_name)
+
+
+class LocalStorage(AttachmentStorage):
+    """
+    Store attachments on the local disk. Download links are signed tokens
+    served by the `attachment-download` view.
+    """
+
+    salt = 'emails.storage.LocalStorage'
+
+    def __init__(self, location: str):
+        self.location = os.path.realpath(location)
+
+    def path(self, object_name: str) -> str:
+        path = os.path.realpath(os.path.join(self.location, object_name))
+
+        if os.path.commonpath([self.location, path]) != self.location:
+            raise StorageError("Object name escapes the storage location: {}".format(object_name))
+
+        return path
+
+    def save(self, file, object_name: str) -> None:
+        path = self.path(object_name)
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            with open(path, 'wb') as destination:
+                shutil.copyfileobj(file, destination)
+        except OSError as e:
+            raise StorageError(e)
+
+    def open(self, object_name: str):
+        try:
+            return open(self.path(object_name), 'rb')
+        except OSError as e:
+            raise StorageError(e)
+
+    def delete(self, object_name: str) -> None:
+        try:
+            os.remove(self.path(object_name))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            raise StorageError(e)
+
+    def open_writer(self, object_name: str) -> LocalWriter:
+        return LocalWriter(self.path(object_name))
+
+    def url(self, object_name: str, expires: int = 300, filename: str = None) -> str:
+        token = signing.dumps(
+            {'object_name': object_name, 'filename': filename, 'expires_at': time.time() + expires},
+            salt=self.salt,
+        )
+        return reverse('attachment-download', args=[token])
+
+    def unsign(self, token: str) -> tuple:
+        """
+        Return the object name and download name held by a token from `url`,
+        or raise StorageError
+        """
+
+        try:
+            data = signing.loads(token, salt=self.salt)
+        except signing.BadSignature as e:
+            raise StorageError(e)
+
+        if data['expires_at'] < time.time():
+            raise StorageError("Download link has expired")
+
+        return data['object_name'], data.get('filename')
+
+
+@lru_cache(maxsize=None)
+def get_storage() -> AttachmentStorage:
+    """
+    Return the process wide storage backend configured in settings
+    """
+
+    config = settings.ATTACHMENT_STORAGE
+    backend = import_string(config['BACKEND'])
+
+    return backend(**config.get('OPTIONS', {}))
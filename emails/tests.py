@@ -1,3 +1,1303 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import json
+import os
+import re
+import shutil
+import socket
+import tempfile
+import threading
+from datetime import timedelta
+from email.message import EmailMessage
+from types import SimpleNamespace
+from unittest import mock, skipIf
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core import signing
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from rest_framework.test import APIClient
+from rest_framework_jwt.settings import api_settings
+
+from emails import events, handlers, metrics, profiling, smtp, uploads
+from emails.authentication import get_user_cache
+from emails.blobs import collect_garbage
+from emails.changes import prune_changes
+from emails.counters import get_counters, rebuild_counters
+from emails.models import Attachment, Blob, DeliveryJob, Email, FolderCounter, Mailbox, MailboxChange
+from emails.presign import get_url_cache
+from emails.pubsub import PostgresBroker, get_broker, publish
+from emails.storage import get_storage
+from emails.upload_handlers import StoredUploadedFile
+from emails.versions import get_response_cache, get_version, mailbox_etag
+
+
+class MailTestMixin:
+    """
+    Starts every test with empty process caches, which are keyed by ids and
+    mailbox versions that repeat once a test's rows are gone, and with
+    attachments kept in a temporary directory
+    """
+
+    def setUp(self):
+        for cache in (get_response_cache(), get_user_cache(), get_url_cache()):
+            cache.clear()
+
+        self.storage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.storage_dir)
+
+        settings = override_settings(
+            ATTACHMENT_STORAGE={
+                'BACKEND': 'emails.storage.LocalStorage',
+                'OPTIONS': {'location': os.path.join(self.storage_dir, 'objects')},
+            },
+            ATTACHMENT_SPOOL_DIR=os.path.join(self.storage_dir, 'spool'),
+            ATTACHMENT_UPLOAD_WORKERS=0,
+            DELIVERY_QUEUE=False,
+            MAILBOX_EVENTS={'BACKEND': 'emails.pubsub.LocalBroker'},
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        # The storage backend, uploader and broker are built once per process
+        self.reset_storage()
+        self.addCleanup(self.reset_storage)
+
+        self.alice = User.objects.create_user('alice', password='password')
+        self.bob = User.objects.create_user('bob', password='password')
+        self.carol = User.objects.create_user('carol', password='password')
+
+    def reset_storage(self):
+        get_storage.cache_clear()
+        get_broker.cache_clear()
+        uploads._uploader = None
+
+    def stored_objects(self) -> list:
+        root = os.path.join(self.storage_dir, 'objects')
+        return sorted(
+            os.path.relpath(os.path.join(path, name), root)
+            for path, _, names in os.walk(root) for name in names
+        )
+
+    def client_for(self, user: User) -> APIClient:
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def send(self, sender: User, subject: str = 'Hello', files=(), **recipients) -> Email:
+        email = dict(subject=subject, message='Message body', **recipients)
+        response = self.client_for(sender).post(
+            '/emails/inbox/',
+            {'email': json.dumps(email), 'attachments': list(files)},
+            format='multipart',
+        )
+        self.assertEqual(response.status_code, 201, response.content)
+
+        return Email.objects.get(id=response.data['id'])
+
+
+class MailTestCase(MailTestMixin, TestCase):
+    pass
+
+
+class MailTransactionTestCase(MailTestMixin, TransactionTestCase):
+    """
+    For tests that need on_commit callbacks, like attachment uploads, to run
+    """
+
+
+class BccPrivacyTests(MailTestCase):
+    def test_bcc_only_email_has_no_receiver(self):
+        email = self.send(self.alice, bcc=['bob', 'carol'])
+        self.assertIsNone(email.receiver)
+
+        client = self.client_for(self.carol)
+        listing = client.get('/emails/inbox/')
+        detail = client.get('/emails/message/', {'email_id': email.id})
+
+        self.assertIsNone(listing.data['inbox'][0]['receiver'])
+        self.assertIsNone(detail.data['receiver'])
+        self.assertNotIn(b'bob', listing.content + detail.content)
+
+    def test_receiver_is_a_to_recipient(self):
+        email = self.send(self.alice, to=['carol'], cc=['bob'])
+        self.assertEqual(email.receiver, self.carol)
+
+        email = self.send(self.alice, cc=['bob'], bcc=['carol'])
+        self.assertIsNone(email.receiver)
+
+    def test_to_search_skips_bcc_recipients(self):
+        self.send(self.alice, to=['carol'], bcc=['bob'])
+
+        for user in (self.alice, self.bob, self.carol):
+            response = self.client_for(user).get('/emails/search/', {'q': 'to:bob'})
+            self.assertEqual(response.data['inbox'], [])
+
+        response = self.client_for(self.bob).get('/emails/search/', {'q': 'to:carol'})
+        self.assertEqual(len(response.data['inbox']), 1)
+
+
+class JwtUserCacheTests(MailTransactionTestCase):
+    def token_client(self, user: User) -> APIClient:
+        token = api_settings.JWT_ENCODE_HANDLER(api_settings.JWT_PAYLOAD_HANDLER(user))
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='{} {}'.format(api_settings.JWT_AUTH_HEADER_PREFIX, token))
+
+        return client
+
+    def user_queries(self, client: APIClient) -> tuple:
+        """
+        Fetch the current user; return the response and how many queries
+        read the user table
+        """
+
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get('/emails/current-user/')
+
+        return response, sum('"auth_user"' in query['sql'] for query in queries.captured_queries)
+
+    def test_user_is_looked_up_once(self):
+        client = self.token_client(self.alice)
+
+        self.assertEqual(self.user_queries(client)[1], 1)
+        response, lookups = self.user_queries(client)
+
+        self.assertEqual((response.status_code, lookups), (200, 0))
+        self.assertEqual(response.data['username'], 'alice')
+
+    def test_deactivated_user_is_rejected_at_once(self):
+        client = self.token_client(self.alice)
+        self.assertEqual(client.get('/emails/current-user/').status_code, 200)
+
+        self.alice.is_active = False
+        self.alice.save()
+
+        self.assertEqual(client.get('/emails/current-user/').status_code, 401)
+
+    def test_renamed_user_is_not_served_stale(self):
+        old_client = self.token_client(self.alice)
+        self.assertEqual(old_client.get('/emails/current-user/').status_code, 200)
+
+        self.alice.username = 'alicia'
+        self.alice.save()
+
+        response = self.token_client(self.alice).get('/emails/current-user/')
+        self.assertEqual((response.status_code, response.data['username']), (200, 'alicia'))
+
+        # The old token names a user that no longer exists, cached or not
+        self.assertEqual(old_client.get('/emails/current-user/').status_code, 401)
+
+    def test_stale_entry_is_refreshed_on_rename(self):
+        client = self.token_client(self.alice)
+        self.assertEqual(client.get('/emails/current-user/').status_code, 200)
+
+        # Renamed by another process: this one never hears of the save
+        User.objects.filter(id=self.alice.id).update(username='alicia')
+        self.alice.username = 'alicia'
+
+        response = self.token_client(self.alice).get('/emails/current-user/')
+        self.assertEqual((response.status_code, response.data['username']), (200, 'alicia'))
+
+
+class BlobClaimTests(MailTransactionTestCase):
+    content = b'attachment content'
+
+    def setUp(self):
+        super().setUp()
+        self.sha256 = hashlib.sha256(self.content).hexdigest()
+        self.email = Email.objects.create(subject='Hello', message='Message body', sender=self.alice)
+
+    def lost_blob(self, state: str, **fields) -> Blob:
+        """
+        A blob whose upload failed or never finished, with one attachment
+        """
+
+        blob = Blob.objects.create(
+            sha256=self.sha256, object_name='lost', size=len(self.content), state=state, refcount=1, **fields
+        )
+        Attachment.objects.create(
+            name='first.txt', object_name='lost', size=blob.size, sha256=self.sha256, state=state,
+            email=self.email, blob=blob,
+        )
+
+        return blob
+
+    def streamed(self, object_name: str = 'streamed') -> StoredUploadedFile:
+        get_storage().save(SimpleUploadedFile('x', self.content), object_name)
+        return StoredUploadedFile('second.txt', object_name, len(self.content), self.sha256, 'text/plain', True)
+
+    def assert_stored(self, blob: Blob):
+        blob.refresh_from_db()
+        self.assertEqual(blob.state, Blob.STORED)
+
+        for attachment in Attachment.objects.filter(blob=blob):
+            self.assertEqual((attachment.state, attachment.object_name), (Blob.STORED, blob.object_name))
+
+        with get_storage().open(blob.object_name) as file:
+            self.assertEqual(file.read(), self.content)
+
+    def test_streamed_upload_replaces_failed_blob(self):
+        blob = self.lost_blob(Blob.FAILED)
+
+        with transaction.atomic():
+            uploads.queue_attachments(self.email, [self.streamed()])
+
+        self.assert_stored(blob)
+        self.assertEqual(blob.object_name, 'streamed')
+        self.assertEqual(Attachment.objects.filter(blob=blob).count(), 2)
+
+    def test_streamed_upload_replaces_pending_blob(self):
+        blob = self.lost_blob(Blob.PENDING, upload_started_at=timezone.now())
+
+        with transaction.atomic():
+            uploads.queue_attachments(self.email, [self.streamed()])
+
+        self.assert_stored(blob)
+
+    def test_streamed_duplicate_of_stored_blob_is_discarded(self):
+        get_storage().save(SimpleUploadedFile('x', self.content), 'kept')
+        blob = Blob.objects.create(
+            sha256=self.sha256, object_name='kept', size=len(self.content), state=Blob.STORED, refcount=1
+        )
+
+        with transaction.atomic():
+            uploads.queue_attachments(self.email, [self.streamed()])
+
+        self.assert_stored(blob)
+        self.assertEqual(blob.object_name, 'kept')
+        self.assertFalse(os.path.exists(get_storage().path('streamed')))
+
+    def test_spooled_upload_takes_over_stale_pending_blob(self):
+        blob = self.lost_blob(Blob.PENDING, upload_started_at=timezone.now() - timedelta(days=1))
+
+        with transaction.atomic():
+            uploads.queue_attachments(self.email, [SimpleUploadedFile('second.txt', self.content)])
+
+        self.assert_stored(blob)
+
+    def test_spooled_upload_leaves_running_upload_alone(self):
+        blob = self.lost_blob(Blob.PENDING, upload_started_at=timezone.now())
+
+        with transaction.atomic():
+            uploads.queue_attachments(self.email, [SimpleUploadedFile('second.txt', self.content)])
+
+        blob.refresh_from_db()
+        self.assertEqual(blob.state, Blob.PENDING)
+        self.assertEqual(os.listdir(uploads.spool_dir()), [])
+
+    def test_retry_stale_uploads(self):
+        spooled = self.lost_blob(Blob.PENDING, upload_started_at=timezone.now() - timedelta(days=1))
+        path, _, _ = uploads.spool(SimpleUploadedFile('first.txt', self.content))
+
+        gone = Blob.objects.create(sha256='0' * 64, object_name='gone', size=1, state=Blob.PENDING, refcount=1)
+
+        self.assertEqual(uploads.retry_stale_uploads(timedelta(hours=1)), (1, 1))
+
+        self.assert_stored(spooled)
+        self.assertFalse(os.path.exists(path))
+        gone.refresh_from_db()
+        self.assertEqual(gone.state, Blob.FAILED)
+
+
+class AttachmentNameTests(MailTransactionTestCase):
+    content = b'shared content'
+
+    def download(self, user: User, email: Email):
+        links = self.client_for(user).get('/emails/attachments/', {'email_id': email.id}).data
+        [(name, url)] = links['attachments'][0].items()
+
+        return name, APIClient().get(url)
+
+    def test_shared_content_downloads_under_each_attachment_name(self):
+        first = self.send(self.alice, to=['bob'], files=[SimpleUploadedFile('a.txt', self.content)])
+        second = self.send(self.alice, to=['carol'], files=[SimpleUploadedFile('b.txt', self.content)])
+
+        self.assertEqual(Blob.objects.count(), 1)
+        self.assertNotIn('a.txt', Blob.objects.get().object_name)
+
+        for user, email, expected in ((self.bob, first, 'a.txt'), (self.carol, second, 'b.txt')):
+            name, response = self.download(user, email)
+
+            self.assertEqual(name, expected)
+            self.assertEqual(response['Content-Disposition'], 'attachment; filename="{}"'.format(expected))
+            self.assertEqual(b''.join(response.streaming_content), self.content)
+
+    def test_cached_links_keep_each_attachment_name(self):
+        first = self.send(self.alice, to=['bob'], files=[SimpleUploadedFile('a.txt', self.content)])
+        second = self.send(self.alice, to=['bob'], files=[SimpleUploadedFile('b.txt', self.content)])
+
+        for _ in range(2):
+            for email, expected in ((first, 'a.txt'), (second, 'b.txt')):
+                name, response = self.download(self.bob, email)
+
+                self.assertEqual(name, expected)
+                self.assertEqual(response['Content-Disposition'], 'attachment; filename="{}"'.format(expected))
+
+    def test_spooled_content_is_named_by_hash(self):
+        with override_settings(ATTACHMENT_STREAMING_UPLOADS=False):
+            self.send(self.alice, to=['bob'], files=[SimpleUploadedFile('a.txt', self.content)])
+
+        blob = Blob.objects.get()
+        self.assertEqual(blob.object_name, 'blobs/' + hashlib.sha256(self.content).hexdigest())
+
+
+@override_settings(ATTACHMENT_DEDUP_BUFFER_SIZE=16, ATTACHMENT_MAX_FILE_SIZE=300, ATTACHMENT_MAX_EMAIL_SIZE=500)
+class StreamingUploadTests(MailTransactionTestCase):
+    def post(self, *contents: bytes, email: str = None):
+        if email is None:
+            email = json.dumps({'subject': 'Hello', 'message': 'Message body', 'to': ['bob']})
+
+        files = [SimpleUploadedFile('{}.bin'.format(n), content) for n, content in enumerate(contents)]
+        return self.client_for(self.alice).post(
+            '/emails/inbox/', {'email': email, 'attachments': files}, format='multipart'
+        )
+
+    def test_attachments_are_streamed_into_storage(self):
+        first, second = os.urandom(200), os.urandom(10)
+        response = self.post(first, second, first)
+        self.assertEqual(response.status_code, 201, response.content)
+
+        # The repeated file was hashed as it arrived and shares the first blob
+        blobs = Blob.objects.order_by('size')
+        self.assertEqual([blob.sha256 for blob in blobs], [hashlib.sha256(c).hexdigest() for c in (second, first)])
+        self.assertTrue(all(blob.object_name.startswith('uploads/') for blob in blobs))
+        self.assertEqual(self.stored_objects(), sorted(blob.object_name for blob in blobs))
+
+        for blob, content in zip(blobs, (second, first)):
+            with get_storage().open(blob.object_name) as file:
+                self.assertEqual(file.read(), content)
+
+    def test_size_limits(self):
+        for contents in ((os.urandom(301),), (os.urandom(250), os.urandom(251))):
+            response = self.post(*contents)
+
+            self.assertEqual(response.status_code, 413, contents)
+            self.assertFalse(Email.objects.exists())
+            self.assertEqual(self.stored_objects(), [])
+
+    def test_oversized_body_is_rejected_before_reading(self):
+        with override_settings(ATTACHMENT_MAX_EMAIL_SIZE=0):
+            with mock.patch('emails.upload_handlers.StreamingUploadHandler.receive_data_chunk') as receive:
+                response = self.post(os.urandom(70 * 1024))
+
+        self.assertEqual(response.status_code, 413)
+        receive.assert_not_called()
+
+    def test_rejected_email_leaves_no_objects(self):
+        for email in ('not json', json.dumps({'subject': 'Hello', 'to': ['nobody']})):
+            response = self.post(os.urandom(200), email=email)
+
+            self.assertEqual(response.status_code, 400, email)
+            self.assertEqual(self.stored_objects(), [])
+
+    def test_failed_send_leaves_no_objects(self):
+        with mock.patch('emails.views.forward_attachments', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.post(os.urandom(200))
+
+        self.assertFalse(Email.objects.exists())
+        self.assertEqual(self.stored_objects(), [])
+
+
+class InboundMailTests(MailTransactionTestCase):
+    def build(self, **headers) -> bytes:
+        message = EmailMessage()
+        for name, value in headers.items():
+            message[name] = value
+        message.set_content('Message body')
+        message.add_attachment(b'attached', maintype='application', subtype='octet-stream', filename='a.bin')
+
+        return message.as_bytes()
+
+    def receive(self, content: bytes, mail_from: str = 'bounce@example.com') -> smtp.InboundMessage:
+        rcpt_users = {'bob@localhost': self.bob.id, 'carol@localhost': self.carol.id}
+        return smtp.parse_message(content, rcpt_users, mail_from)
+
+    def test_external_sender_and_receiver(self):
+        content = self.build(From='Dave <dave@example.com>', Cc='bob@localhost', Subject='Hi')
+        self.assertEqual(smtp.store_messages([self.receive(content)]), [None])
+
+        email = Email.objects.get()
+        self.assertEqual(email.external_sender, 'dave@example.com')
+        self.assertIsNone(email.receiver)
+
+        for path in ('/emails/inbox/', '/emails/search/?q=from:dave@example.com'):
+            [row] = self.client_for(self.carol).get(path).data['inbox']
+            self.assertEqual((row['external_sender'], row['receiver']), ('dave@example.com', None))
+
+    def test_envelope_sender_without_from_header(self):
+        message = self.receive(self.build(To='carol@localhost'), mail_from='bounce@example.com')
+        smtp.store_messages([message])
+
+        email = Email.objects.get()
+        self.assertEqual(email.external_sender, 'bounce@example.com')
+        self.assertEqual(email.receiver, self.carol)
+
+    def test_failed_batch_leaves_no_files(self):
+        messages = [self.receive(self.build(To='bob@localhost')) for _ in range(2)]
+        paths = [attachment.temporary_file_path() for message in messages for attachment in message.attachments]
+
+        with mock.patch('emails.smtp.deliver_emails', side_effect=RuntimeError), self.assertLogs('emails.smtp'):
+            errors = smtp.store_messages(messages)
+
+        self.assertTrue(all(isinstance(error, RuntimeError) for error in errors))
+        self.assertFalse(Email.objects.exists())
+        self.assertEqual(os.listdir(uploads.spool_dir()), [])
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+
+    def handler(self, queue_size: int = 10, max_data_bytes: int = 1000) -> smtp.InboundHandler:
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        asyncio.set_event_loop(loop)
+
+        return smtp.InboundHandler(smtp.MessageBatcher(batch_size=1, window=0, queue_size=queue_size), max_data_bytes)
+
+    def test_full_queue_turns_senders_away_before_data(self):
+        handler = self.handler(queue_size=1)
+        handler.batcher.queue.put_nowait(None)
+        envelope = SimpleNamespace(rcpt_tos=[])
+
+        reply = asyncio.get_event_loop().run_until_complete(
+            handler.handle_RCPT(None, None, envelope, 'bob@localhost', [])
+        )
+
+        self.assertTrue(reply.startswith('451'))
+        self.assertEqual(handler.reserve_data(['SIZE=10']), 0)
+
+    @override_settings(SMTP_MAX_MESSAGE_SIZE=500)
+    def test_data_in_memory_is_capped(self):
+        handler = self.handler(max_data_bytes=1000)
+
+        self.assertEqual(handler.reserve_data(['SIZE=600']), 500)
+        self.assertEqual(handler.reserve_data(['BODY=8BITMIME', 'SIZE=300']), 300)
+        self.assertEqual(handler.reserve_data([]), 0)
+
+        handler.release_data(500)
+        self.assertEqual(handler.reserve_data([]), 500)
+        self.assertEqual(handler.data_bytes, 800)
+
+    def test_unknown_charset(self):
+        content = (
+            b'From: dave@example.com\r\nTo: bob@localhost\r\nSubject: =?x-unknown?q?Hi?=\r\n'
+            b'Content-Type: text/plain; charset=x-unknown\r\n\r\nHello \xe9\r\n'
+        )
+
+        message = self.receive(content)
+        self.assertEqual(smtp.store_messages([message]), [None])
+
+        email = Email.objects.get()
+        self.assertEqual(email.message, 'Hello \ufffd\r\n')
+
+    def test_unparseable_message_is_refused(self):
+        handler = self.handler()
+        envelope = SimpleNamespace(original_content=b'', rcpt_users={}, mail_from='')
+
+        with mock.patch('emails.smtp.parse_message', side_effect=ValueError), self.assertLogs('emails.smtp'):
+            reply = asyncio.get_event_loop().run_until_complete(handler.handle_DATA(None, None, envelope))
+
+        self.assertTrue(reply.startswith('554'))
+
+
+class DeliveryQueueTests(MailTestCase):
+    def purge_sent(self, email: Email):
+        client = self.client_for(self.alice)
+
+        for folder in ('sent', 'trash'):
+            response = client.delete('/emails/{}/?email_id={}'.format(folder, email.id))
+            self.assertEqual(response.status_code, 200, response.content)
+
+    @override_settings(DELIVERY_QUEUE=True)
+    def test_purged_email_waits_for_its_delivery(self):
+        email = self.send(self.alice, to=['bob'])
+        self.purge_sent(email)
+
+        self.assertTrue(DeliveryJob.objects.filter(email=email).exists())
+
+    @override_settings(DELIVERY_QUEUE=True)
+    def test_purged_email_whose_delivery_failed_is_deleted(self):
+        email = self.send(self.alice, to=['bob'])
+        DeliveryJob.objects.filter(email=email).update(state=DeliveryJob.FAILED)
+        self.purge_sent(email)
+
+        self.assertFalse(Email.objects.filter(id=email.id).exists())
+
+
+class FolderCounterTests(MailTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = self.client_for(self.bob)
+        self.emails = [self.send(self.alice, subject=str(n), to=['bob']).id for n in range(3)]
+
+    def assert_counters(self, **expected):
+        """
+        Compare bob's counters with a recount, and with `expected` folder
+        (total, unread) pairs
+        """
+
+        self.assertEqual(rebuild_counters([self.bob.id], fix=False), [])
+
+        counters = self.client.get('/emails/counters/').data
+        self.assertEqual(counters, get_counters(self.bob))
+
+        for folder, (total, unread) in expected.items():
+            self.assertEqual(counters[folder], {'total': total, 'unread': unread}, folder)
+
+    def act(self, method: str, path: str, *indexes, **data):
+        query = ','.join(str(self.emails[index]) for index in indexes)
+        response = getattr(self.client, method)('{}?email_id={}'.format(path, query), data)
+        self.assertLess(response.status_code, 300, response.content)
+
+    def test_read_toggles(self):
+        self.assert_counters(inbox=(3, 3))
+
+        self.act('put', '/emails/inbox/', 0, read=True)
+        self.act('put', '/emails/inbox/', 0, read=True)
+        self.assert_counters(inbox=(3, 2))
+
+        self.act('patch', '/emails/read/', 0, 1, 2, read=True)
+        self.assert_counters(inbox=(3, 0))
+
+        self.act('patch', '/emails/read/', 1, 2, read=False)
+        self.assert_counters(inbox=(3, 2))
+
+    def test_star_and_move(self):
+        self.act('post', '/emails/starred/', 0, 1)
+        self.act('put', '/emails/inbox/', 1, read=True)
+        self.assert_counters(inbox=(3, 2), starred=(2, 1), trash=(0, 0))
+
+        self.act('delete', '/emails/inbox/', 0, 1)
+        self.assert_counters(inbox=(1, 1), starred=(2, 1), trash=(2, 1))
+
+        self.act('patch', '/emails/trash/', 1)
+        self.assert_counters(inbox=(2, 1), starred=(2, 1), trash=(1, 1))
+
+        self.act('post', '/emails/starred/', 0)
+        self.assert_counters(inbox=(2, 1), starred=(1, 0), trash=(1, 1))
+
+    def test_purge(self):
+        self.act('post', '/emails/starred/', 0)
+        self.act('delete', '/emails/inbox/', 0, 1)
+        self.act('delete', '/emails/trash/', 0, 1)
+        self.assert_counters(inbox=(1, 1), starred=(0, 0), trash=(0, 0))
+
+        # Purging what is already gone changes nothing
+        self.act('delete', '/emails/trash/', 0)
+        self.assert_counters(inbox=(1, 1), trash=(0, 0))
+
+    def test_rebuild_fixes_drift(self):
+        FolderCounter.objects.filter(user=self.bob, folder=Mailbox.INBOX).update(total=7, unread=0)
+
+        drift = rebuild_counters([self.bob.id])
+
+        self.assertEqual(drift, [(self.bob.id, Mailbox.INBOX, (7, 0), (3, 3))])
+        self.assert_counters(inbox=(3, 3))
+
+    def read_states(self, email_id: int) -> dict:
+        return dict(Mailbox.objects.filter(email_id=email_id).values_list('user__username', 'read'))
+
+    def test_read_state_is_per_recipient(self):
+        self.emails.append(self.send(self.alice, to=['bob'], cc=['carol']).id)
+
+        self.act('patch', '/emails/read/', 3, read=True)
+        self.assertEqual(self.read_states(self.emails[3]), {'alice': True, 'bob': True, 'carol': False})
+        self.assert_counters(inbox=(4, 3))
+        self.assertEqual(get_counters(self.carol)['inbox'], {'total': 1, 'unread': 1})
+
+        # The sender's copy is their own too
+        response = self.client_for(self.alice).patch(
+            '/emails/read/?folder=sent&email_id={}'.format(self.emails[3]), {'read': False}
+        )
+        self.assertEqual(response.data, {'updated': 1})
+        self.assertEqual(self.read_states(self.emails[3]), {'alice': False, 'bob': True, 'carol': False})
+
+    def test_read_from_cursor_on(self):
+        self.emails.append(self.send(self.alice, to=['carol']).id)
+
+        # The first page holds the newest email; mark everything after it
+        cursor = self.client.get('/emails/inbox/', {'limit': 1}).data['next']
+        response = self.client.patch('/emails/read/?folder=inbox&before={}'.format(cursor), {'read': True})
+
+        self.assertEqual(response.data, {'updated': 2})
+        self.assertEqual([self.read_states(email_id)['bob'] for email_id in self.emails[:3]], [True, True, False])
+        self.assertEqual(self.read_states(self.emails[3]), {'alice': True, 'carol': False})
+        self.assert_counters(inbox=(3, 1))
+
+        response = self.client.patch('/emails/read/?folder=inbox&before=bad', {'read': True})
+        self.assertEqual(response.status_code, 400)
+
+
+class MailboxSyncTests(MailTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = self.client_for(self.bob)
+
+    def sync(self, since=None, **params) -> dict:
+        if since is not None:
+            params['since'] = since
+
+        response = self.client.get('/emails/sync/', params)
+        self.assertEqual(response.status_code, 200, response.content)
+
+        return response.data
+
+    def test_first_sync_asks_for_resync(self):
+        self.send(self.alice, to=['bob'])
+
+        data = self.sync()
+
+        self.assertTrue(data['resync'])
+        self.assertEqual(self.sync(data['cursor']), {'changes': [], 'emails': [], 'cursor': data['cursor'], 'more': False})
+
+    def test_changes_since_cursor(self):
+        cursor = self.sync()['cursor']
+
+        first = self.send(self.alice, subject='First', to=['bob'])
+        second = self.send(self.alice, subject='Second', cc=['bob'])
+        self.client.put('/emails/inbox/?email_id={}'.format(first.id), {'read': True})
+        self.client.delete('/emails/inbox/?email_id={}'.format(second.id))
+
+        data = self.sync(cursor)
+
+        # One entry per email with its latest state, new mail last
+        self.assertEqual(data['changes'], [
+            [first.id, MailboxChange.READ, Mailbox.INBOX, False, True],
+            [second.id, MailboxChange.MOVE, Mailbox.TRASH, False, False],
+        ])
+        self.assertEqual([row['subject'] for row in data['emails']], ['Second', 'First'])
+        self.assertFalse(data['more'])
+
+        self.assertEqual(self.sync(data['cursor'])['changes'], [])
+
+        self.client.delete('/emails/trash/?email_id={}'.format(second.id))
+        data = self.sync(data['cursor'])
+
+        self.assertEqual(data['changes'], [[second.id, MailboxChange.PURGE, None, False, False]])
+        self.assertEqual(data['emails'], [])
+
+    def test_changes_come_in_pages(self):
+        cursor = self.sync()['cursor']
+        emails = [self.send(self.alice, to=['bob']).id for _ in range(3)]
+
+        seen = []
+        more = True
+        while more:
+            data = self.sync(cursor, limit=2)
+            seen += [change[0] for change in data['changes']]
+            cursor, more = data['cursor'], data['more']
+
+        self.assertEqual(seen, emails)
+
+    def test_pruned_cursor_asks_for_resync(self):
+        cursor = self.sync()['cursor']
+        for _ in range(3):
+            self.send(self.alice, to=['bob'])
+
+        self.assertTrue(prune_changes(timedelta(0)))
+
+        data = self.sync(cursor)
+
+        self.assertTrue(data['resync'])
+        self.assertEqual(self.sync(data['cursor'])['changes'], [])
+
+    def test_other_users_changes_are_hidden(self):
+        cursor = self.sync()['cursor']
+        self.send(self.alice, to=['carol'], bcc=['bob'])
+        self.send(self.alice, to=['carol'])
+
+        self.assertEqual(len(self.sync(cursor)['changes']), 1)
+
+
+class BlobLifecycleTests(MailTransactionTestCase):
+    content = b'shared content'
+
+    def purge(self, email: Email):
+        """
+        Remove the email from alice's sent folder and bob's inbox and trash
+        """
+
+        self.client_for(self.alice).delete('/emails/sent/?email_id={}'.format(email.id))
+
+        client = self.client_for(self.bob)
+        client.delete('/emails/inbox/?email_id={}'.format(email.id))
+        client.delete('/emails/trash/?email_id={}'.format(email.id))
+
+    def refcount(self) -> int:
+        return Blob.objects.get().refcount
+
+    def stored(self, object_name: str) -> bool:
+        return os.path.exists(get_storage().path(object_name))
+
+    def test_references_are_released_with_the_last_email(self):
+        first = self.send(self.alice, to=['bob'], files=[SimpleUploadedFile('a.txt', self.content)])
+        second = self.send(self.alice, to=['bob'], files=[SimpleUploadedFile('b.txt', self.content)])
+        attachment = Attachment.objects.get(email=first)
+        third = self.send(self.alice, to=['bob'], forward_attachments=[attachment.id])
+        self.assertEqual(self.refcount(), 3)
+
+        self.purge(first)
+        self.assertEqual(self.refcount(), 2)
+
+        # Still in bob's folders
+        self.client_for(self.alice).delete('/emails/sent/?email_id={}'.format(second.id))
+        self.assertEqual(self.refcount(), 2)
+
+        self.purge(second)
+        self.purge(third)
+        self.assertEqual(self.refcount(), 0)
+        self.assertFalse(Attachment.objects.exists())
+
+    def test_garbage_collection(self):
+        email = self.send(self.alice, to=['bob'], files=[SimpleUploadedFile('a.txt', self.content)])
+        object_name = Blob.objects.get().object_name
+        self.purge(email)
+
+        # Within the grace period the blob can still be claimed
+        self.assertEqual(collect_garbage(timedelta(hours=1)), 0)
+        self.send(self.alice, to=['bob'], files=[SimpleUploadedFile('b.txt', self.content)])
+        self.assertEqual(self.refcount(), 1)
+        self.assertEqual(collect_garbage(timedelta(0)), 0)
+
+        self.purge(Email.objects.get())
+        self.assertEqual(collect_garbage(timedelta(0)), 1)
+
+        self.assertFalse(Blob.objects.exists())
+        self.assertFalse(self.stored(object_name))
+
+    def test_collected_content_can_be_sent_again(self):
+        with override_settings(ATTACHMENT_STREAMING_UPLOADS=False):
+            email = self.send(self.alice, to=['bob'], files=[SimpleUploadedFile('a.txt', self.content)])
+            self.purge(email)
+            collect_garbage(timedelta(0))
+
+            self.send(self.alice, to=['bob'], files=[SimpleUploadedFile('b.txt', self.content)])
+
+        blob = Blob.objects.get()
+        self.assertEqual((blob.refcount, blob.state), (1, Blob.STORED))
+        self.assertTrue(self.stored(blob.object_name))
+
+    def test_attachment_without_blob_loses_its_object(self):
+        email = Email.objects.create(subject='Hello', message='Message body', sender=self.alice)
+        get_storage().save(SimpleUploadedFile('x', self.content), 'legacy')
+        Attachment.objects.create(name='old.txt', object_name='legacy', size=len(self.content), email=email)
+        Mailbox.objects.create(user=self.alice, email=email, folder=Mailbox.SENT, read=True)
+
+        self.client_for(self.alice).delete('/emails/sent/?email_id={}'.format(email.id))
+
+        self.assertFalse(Email.objects.exists())
+        self.assertFalse(self.stored('legacy'))
+
+
+class KeysetPaginationTests(MailTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = self.client_for(self.bob)
+
+    def receive(self, count: int) -> list:
+        return [self.send(self.alice, subject=str(n), to=['bob']).id for n in range(count)]
+
+    def pages(self, limit: int) -> list:
+        """
+        Every page of bob's inbox, as lists of email ids
+        """
+
+        pages = []
+        params = {'limit': limit}
+
+        while True:
+            response = self.client.get('/emails/inbox/', params)
+            self.assertEqual(response.status_code, 200, response.content)
+            pages.append([row['id'] for row in response.data['inbox']])
+
+            if response.data['next'] is None:
+                return pages
+
+            params['cursor'] = response.data['next']
+
+    def test_full_last_page_has_no_cursor(self):
+        emails = self.receive(4)
+
+        self.assertEqual(self.pages(2), [emails[:1:-1], emails[1::-1]])
+        self.assertEqual(self.pages(4), [emails[::-1]])
+
+    def test_one_row_past_the_page(self):
+        emails = self.receive(3)
+
+        self.assertEqual(self.pages(2), [emails[:0:-1], emails[:1]])
+
+    def test_rows_with_the_same_time_are_not_skipped(self):
+        emails = self.receive(5)
+        Mailbox.objects.filter(user=self.bob).update(created_at=timezone.now())
+
+        self.assertEqual(self.pages(2), [emails[:2:-1], emails[2:0:-1], emails[:1]])
+
+    def test_empty_folder(self):
+        self.assertEqual(self.pages(2), [[]])
+
+    def test_limit_is_clamped(self):
+        emails = self.receive(2)
+
+        self.assertEqual(self.pages(0), [[emails[1]], [emails[0]]])
+
+    def test_invalid_cursor(self):
+        for cursor in ('garbage', 'bm90IGEgZGF0ZXwx'):
+            response = self.client.get('/emails/inbox/', {'cursor': cursor})
+            self.assertEqual(response.status_code, 400, cursor)
+
+
+@skipIf(metrics.prometheus_client is None, "prometheus_client is not installed")
+class MetricsAccessTests(TestCase):
+    def scrape(self, address: str, **headers):
+        return self.client.get('/metrics', REMOTE_ADDR=address, **headers).status_code
+
+    def test_allowed_addresses(self):
+        self.assertEqual(self.scrape('127.0.0.1'), 200)
+        self.assertEqual(self.scrape('203.0.113.5'), 403)
+
+        with override_settings(METRICS_ALLOWED_IPS=['203.0.113.0/24']):
+            self.assertEqual(self.scrape('203.0.113.5'), 200)
+            self.assertEqual(self.scrape('127.0.0.1'), 403)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_token(self):
+        self.assertEqual(self.scrape('203.0.113.5', HTTP_AUTHORIZATION='Bearer secret'), 200)
+        self.assertEqual(self.scrape('203.0.113.5', HTTP_AUTHORIZATION='Bearer wrong'), 403)
+        self.assertEqual(self.scrape('203.0.113.5', HTTP_AUTHORIZATION='secret'), 403)
+
+    def test_queue_gauges_are_cached(self):
+        collector = metrics.DeliveryQueueCollector(ttl=60)
+
+        with CaptureQueriesContext(connection) as queries:
+            collector.collect()
+            counted = len(queries)
+            collector.collect()
+
+        self.assertGreater(counted, 0)
+        self.assertEqual(len(queries), counted)
+
+
+class ProfilingTests(MailTestCase):
+    def setUp(self):
+        super().setUp()
+        self.profiles_dir = os.path.join(self.storage_dir, 'profiles')
+
+        settings = override_settings(PROFILING_DIR=self.profiles_dir, PROFILING_SAMPLE_RATE=0)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.client = self.client_for(self.bob)
+
+    def get_inbox(self, token: str = None):
+        headers = {profiling.TOKEN_HEADER: token} if token else {}
+        response = self.client.get('/emails/inbox/', **headers)
+        self.assertEqual(response.status_code, 200)
+
+    def test_requests_without_a_valid_token_are_not_profiled(self):
+        self.get_inbox()
+        self.get_inbox('nonsense')
+        self.get_inbox(signing.dumps({'profile': True}, salt='another.salt'))
+
+        with override_settings(PROFILING_TOKEN_MAX_AGE=-1):
+            self.get_inbox(profiling.make_token())
+
+        self.assertEqual(profiling.profile_ids(), [])
+
+    def test_profile_has_the_request_its_sql_and_stacks(self):
+        self.send(self.alice, to=['bob'])
+        self.get_inbox(profiling.make_token())
+
+        [meta] = profiling.list_profiles()
+
+        self.assertEqual(
+            {key: meta[key] for key in ('method', 'path', 'user_id', 'status')},
+            {'method': 'GET', 'path': '/emails/inbox/', 'user_id': self.bob.id, 'status': 200},
+        )
+        self.assertGreater(meta['queries'], 0)
+        self.assertEqual(len(meta['sql']), meta['queries'])
+        self.assertEqual(set(meta['sql'][0]), {'sql', 'ms', 'many'})
+
+        with open(profiling.profile_path(meta['id'], '.collapsed')) as f:
+            lines = f.read().splitlines()
+
+        # Root first, one "function (file:line)" per frame, then the count
+        stacks = [line.rsplit(' ', 1) for line in lines]
+        self.assertEqual(sum(int(count) for _, count in stacks), meta['samples'])
+        self.assertGreater(meta['samples'], 0)
+
+        for stack, _ in stacks:
+            self.assertIn('__call__ (emails/profiling.py:', stack)
+            self.assertTrue(all(re.fullmatch(r'\S+ \(.+:\d+\)', frame) for frame in stack.split(';')), stack)
+
+    def test_sampled_requests_keep_the_newest_profiles(self):
+        with override_settings(PROFILING_SAMPLE_RATE=1, PROFILING_MAX_PROFILES=2):
+            for _ in range(3):
+                self.get_inbox()
+
+        self.assertEqual(len(profiling.profile_ids()), 2)
+        self.assertEqual(sorted(os.listdir(self.profiles_dir))[0].split('.')[0], profiling.profile_ids()[1])
+
+
+class ConditionalListingTests(MailTestCase):
+    def test_change_within_the_same_second_is_not_missed(self):
+        client = self.client_for(self.bob)
+        self.send(self.alice, to=['bob'])
+
+        first = client.get('/emails/inbox/')
+        self.assertEqual(client.get('/emails/inbox/', HTTP_IF_NONE_MATCH=first['ETag']).status_code, 304)
+
+        self.send(self.alice, to=['bob'])
+        # Pretend both changes happened within one second
+        headers = {'HTTP_IF_MODIFIED_SINCE': 'Fri, 01 Jan 2100 00:00:00 GMT'}
+
+        response = client.get('/emails/inbox/', **headers)
+        self.assertEqual((response.status_code, len(response.data['inbox'])), (200, 2))
+
+        response = client.get('/emails/inbox/', HTTP_IF_NONE_MATCH=first['ETag'], **headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], first['ETag'])
+        self.assertIn('Last-Modified', response)
+
+    def test_etag_is_not_shared_between_listings(self):
+        client = self.client_for(self.bob)
+        self.send(self.alice, to=['bob'])
+        self.send(self.alice, to=['bob'])
+
+        first = client.get('/emails/inbox/', {'limit': 1})
+        etag = first['ETag']
+
+        for path in ('/emails/inbox/', '/emails/sent/', '/emails/inbox/?limit=1&cursor=' + first.data['next']):
+            response = client.get(path, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200, path)
+            self.assertNotEqual(response['ETag'], etag)
+
+        self.assertEqual(client.get('/emails/inbox/', {'limit': 1}, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_malformed_cursor_is_rejected_before_etag(self):
+        client = self.client_for(self.bob)
+        self.send(self.alice, to=['bob'])
+
+        path = '/emails/inbox/?cursor=bad'
+        version, _ = get_version(self.bob)
+        response = client.get(path, HTTP_IF_NONE_MATCH=mailbox_etag(self.bob, version, path))
+        self.assertEqual(response.status_code, 400)
+
+
+class AsgiTestMixin:
+    """
+    Drives ASGI applications on a private event loop, as alice
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        asyncio.set_event_loop(self.loop)
+
+        token = api_settings.JWT_ENCODE_HANDLER(api_settings.JWT_PAYLOAD_HANDLER(self.alice))
+        self.auth = (b'authorization', '{} {}'.format(api_settings.JWT_AUTH_HEADER_PREFIX, token).encode())
+
+    def scope(self, method: str, path: str, headers=(), query: bytes = b'') -> dict:
+        return {
+            'type': 'http', 'method': method, 'path': path, 'query_string': query, 'headers': list(headers),
+            'http_version': '1.1', 'scheme': 'http', 'server': ('testserver', 80), 'client': ('127.0.0.1', 5000),
+        }
+
+    def run_async(self, coroutine, timeout: float = 10):
+        return self.loop.run_until_complete(asyncio.wait_for(coroutine, timeout))
+
+
+@override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=1024, ASGI_MAX_BODY_SIZE=64 * 1024)
+class DjangoAsgiTests(AsgiTestMixin, MailTransactionTestCase):
+    def call(self, method: str, path: str, headers=(), chunks=(b'',), more_body: bool = False) -> list:
+        """
+        Send a request whose body comes in `chunks`, then a disconnect once
+        those run out. Returns the messages sent back.
+        """
+
+        self.unread = [
+            {'type': 'http.request', 'body': chunk, 'more_body': more_body or n < len(chunks) - 1}
+            for n, chunk in enumerate(chunks)
+        ]
+        sent = []
+
+        async def receive():
+            return self.unread.pop(0) if self.unread else {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+
+        self.run_async(handlers.django_application(self.scope(method, path, headers), receive, send))
+
+        return sent
+
+    def post_attachment(self, content: bytes, chunk_size: int = 500, length: bool = True, sent_chunks: int = None) -> list:
+        """
+        Post an email with one attachment. With `sent_chunks`, the client
+        goes away after sending that many chunks.
+        """
+
+        email = json.dumps({'subject': 'Hello', 'message': 'Message body', 'to': ['bob']}).encode()
+        body = (
+            b'--B\r\nContent-Disposition: form-data; name="email"\r\n\r\n' + email + b'\r\n'
+            b'--B\r\nContent-Disposition: form-data; name="attachments"; filename="a.bin"\r\n'
+            b'Content-Type: application/octet-stream\r\n\r\n' + content + b'\r\n--B--\r\n'
+        )
+        headers = [self.auth, (b'content-type', b'multipart/form-data; boundary=B')]
+        if length:
+            headers.append((b'content-length', str(len(body)).encode()))
+
+        chunks = [body[start:start + chunk_size] for start in range(0, len(body), chunk_size)]
+        if sent_chunks is None:
+            return self.call('POST', '/emails/inbox/', headers, chunks)
+
+        return self.call('POST', '/emails/inbox/', headers, chunks[:sent_chunks], more_body=True)
+
+    def test_small_body_is_received_before_the_view_runs(self):
+        unread = []
+        start_request = handlers.start_request
+
+        def started(environ):
+            unread.append(len(self.unread))
+            return start_request(environ)
+
+        with mock.patch('emails.handlers.start_request', side_effect=started):
+            sent = self.call('GET', '/emails/inbox/', [self.auth])
+
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertEqual(json.loads(sent[1]['body']), {'inbox': [], 'next': None})
+        self.assertEqual(unread, [0])
+
+    def test_large_upload_streams_into_the_view(self):
+        content = os.urandom(20000)
+        unread = []
+        start_request = handlers.start_request
+
+        def started(environ):
+            unread.append(len(self.unread))
+            return start_request(environ)
+
+        with mock.patch('emails.handlers.start_request', side_effect=started):
+            sent = self.post_attachment(content)
+
+        self.assertEqual(sent[0]['status'], 201, sent)
+        self.assertGreater(unread[0], 30)
+
+        blob = Blob.objects.get()
+        self.assertTrue(blob.object_name.startswith('uploads/'))
+        with get_storage().open(blob.object_name) as file:
+            self.assertEqual(file.read(), content)
+
+    def test_chunked_upload_without_length_is_spooled(self):
+        content = os.urandom(5000)
+        sent = self.post_attachment(content, length=False)
+
+        self.assertEqual(sent[0]['status'], 201, sent)
+        self.assertEqual(Attachment.objects.get().size, len(content))
+
+    def test_body_limits(self):
+        headers = [self.auth, (b'content-length', str(64 * 1024 + 1).encode())]
+        sent = self.call('POST', '/emails/inbox/', headers, [b'x'])
+        self.assertEqual(sent[0]['status'], 413)
+        # Refused on the header, before any of the body was read
+        self.assertEqual(len(self.unread), 1)
+
+        sent = self.call('POST', '/emails/inbox/', [self.auth], [b'x' * 1000] * 66)
+        self.assertEqual(sent[0]['status'], 413)
+
+    def test_disconnect_before_the_view_runs(self):
+        self.assertEqual(self.call('POST', '/emails/inbox/', [self.auth], [b'x' * 100], more_body=True), [])
+
+    @override_settings(ATTACHMENT_DEDUP_BUFFER_SIZE=16)
+    def test_disconnect_while_streaming(self):
+        # Small reads, so part of the attachment is in storage when the client goes
+        with mock.patch('emails.upload_handlers.StreamingUploadHandler.chunk_size', 1024):
+            sent = self.post_attachment(os.urandom(20000), sent_chunks=20)
+
+        self.assertEqual(sent, [])
+        self.assertFalse(Email.objects.exists())
+        self.assertEqual(self.stored_objects(), [])
+
+
+class EventStreamTests(AsgiTestMixin, MailTransactionTestCase):
+    def respond(self, method: str = 'GET', headers=(), query: bytes = b'') -> list:
+        sent = []
+
+        async def receive():
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+
+        self.run_async(events.application(self.scope(method, events.EVENTS_PATH, headers, query), receive, send))
+
+        return sent
+
+    def test_rejects_missing_or_invalid_tokens(self):
+        self.assertEqual(self.respond()[0]['status'], 401)
+        self.assertEqual(self.respond(headers=[(b'authorization', b'Bearer nonsense')])[0]['status'], 401)
+        self.assertEqual(self.respond(query=b'token=nonsense')[0]['status'], 401)
+
+        self.alice.is_active = False
+        self.alice.save()
+        self.assertEqual(self.respond(headers=[self.auth])[0]['status'], 401)
+
+    def test_rejects_other_methods(self):
+        self.assertEqual(self.respond('POST', headers=[self.auth])[0]['status'], 405)
+
+    def test_streams_events_until_disconnect(self):
+        sent = []
+        incoming = asyncio.Queue()
+
+        async def send(message):
+            sent.append(message)
+
+        async def wait_for(count: int):
+            while len(sent) < count:
+                await asyncio.sleep(0.01)
+
+        async def scenario():
+            scope = self.scope('GET', events.EVENTS_PATH, [self.auth])
+            stream = asyncio.ensure_future(events.application(scope, incoming.get, send))
+
+            await wait_for(2)
+            publish([self.bob.id], {'event': 'new'})
+            publish([self.alice.id], {'event': 'new', 'email_id': 1})
+            await wait_for(3)
+
+            await incoming.put({'type': 'http.disconnect'})
+            await stream
+
+        self.run_async(scenario())
+
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertEqual(dict(sent[0]['headers'])[b'content-type'], b'text/event-stream')
+        self.assertEqual(sent[2]['body'], b'event: new\ndata: {"event":"new","email_id":1}\n\n')
+        self.assertEqual(len(sent), 3)
+        self.assertEqual(get_broker().subscriber_count(), 0)
+
+
+class PubSubTests(MailTransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        asyncio.set_event_loop(self.loop)
+
+    def drain(self, queue: asyncio.Queue) -> list:
+        # Deliveries are scheduled on the loop from the publishing thread
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        return [queue.get_nowait() for _ in range(queue.qsize())]
+
+    def test_delivery_fans_out_to_each_subscriber(self):
+        broker = get_broker()
+        bob_queues = [broker.subscribe(self.bob.id), broker.subscribe(self.bob.id)]
+        carol_queue = broker.subscribe(self.carol.id)
+
+        email = self.send(self.alice, to=['bob'], subject='First')
+        self.send(self.alice, to=['carol'], subject='Second')
+
+        for queue in bob_queues:
+            self.assertEqual(self.drain(queue), [{'event': 'mail', 'email': email.id}])
+        self.assertEqual(len(self.drain(carol_queue)), 1)
+
+        broker.unsubscribe(self.bob.id, bob_queues[0])
+        self.assertEqual(broker.subscriber_count(), 2)
+
+    def test_slow_subscriber_keeps_the_newest_events(self):
+        broker = get_broker()
+
+        with mock.patch.object(broker, 'queue_size', 2):
+            queue = broker.subscribe(self.bob.id)
+
+        for n in range(3):
+            publish([self.bob.id], {'event': 'mail', 'email': n})
+
+        self.assertEqual([event['email'] for event in self.drain(queue)], [1, 2])
+
+    def test_broker_failure_does_not_fail_delivery(self):
+        with mock.patch.object(get_broker(), 'publish', side_effect=RuntimeError):
+            with self.assertLogs('emails.pubsub', 'ERROR'):
+                email = self.send(self.alice, to=['bob'])
+
+        self.assertTrue(Mailbox.objects.filter(user=self.bob, email=email).exists())
+
+
+class PostgresBrokerTests(TestCase):
+    """
+    Reconnection, against a stand-in for psycopg2
+    """
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        asyncio.set_event_loop(self.loop)
+
+        self.psycopg2 = mock.MagicMock()
+        self.psycopg2.Error = type('Error', (Exception,), {})
+        patcher = mock.patch('emails.pubsub.psycopg2', self.psycopg2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.connect_threads = []
+        self.psycopg2.connect.side_effect = self.connect
+
+        self.broker = PostgresBroker()
+        self.broker.reconnect_delay = 0.05
+
+    def connect(self, **kwargs):
+        self.connect_threads.append(threading.get_ident())
+
+        # A real descriptor for the event loop to watch
+        ours, theirs = socket.socketpair()
+        self.addCleanup(ours.close)
+        self.addCleanup(theirs.close)
+
+        return mock.MagicMock(fileno=ours.fileno)
+
+    def lose_connection(self) -> None:
+        self.broker._listener.poll.side_effect = self.psycopg2.Error
+        self.broker.receive()
+
+    def test_connects_off_the_event_loop(self):
+        self.loop.run_until_complete(self.broker.start())
+        self.loop.run_until_complete(self.broker.start())
+
+        self.assertEqual(len(self.connect_threads), 1)
+        self.assertNotEqual(self.connect_threads[0], threading.get_ident())
+
+    def test_reconnect_does_not_race_start(self):
+        async def scenario():
+            await self.broker.start()
+
+            with self.assertLogs('emails.pubsub', 'ERROR'):
+                self.lose_connection()
+
+            # A new subscriber connects while the retry is waiting
+            await self.broker.start()
+            await asyncio.sleep(self.broker.reconnect_delay * 3)
+
+        self.loop.run_until_complete(scenario())
+
+        self.assertEqual(len(self.connect_threads), 2)
+        self.assertIsNone(self.broker._reconnecting)
+
+    def test_reconnect_retries_until_it_connects(self):
+        async def scenario():
+            await self.broker.start()
+            self.psycopg2.connect.side_effect = [self.psycopg2.Error(), self.psycopg2.Error(), self.connect()]
+
+            with self.assertLogs('emails.pubsub', 'ERROR') as logs:
+                self.lose_connection()
+                await asyncio.sleep(self.broker.reconnect_delay * 5)
+
+            return logs
+
+        logs = self.loop.run_until_complete(scenario())
+
+        self.assertEqual(len(logs.records), 3)
+        self.assertEqual(self.psycopg2.connect.call_count, 4)
+        self.assertIsNotNone(self.broker._listener)
+        self.assertIsNone(self.broker._reconnecting)
@@ -0,0 +1,205 @@
+"""
+Upload handler that streams attachments straight into attachment storage.
+
+Each chunk Django reads off the socket is hashed, counted and handed to the
+storage backend's writer, so a file never lands in memory or on local disk
+as a whole. Size limits are checked as the bytes arrive.
+
+The first ATTACHMENT_DEDUP_BUFFER_SIZE bytes are held back before anything
+is written. A file that fits in that buffer and matches a stored blob is
+never written at all; a larger duplicate has its partial upload aborted
+instead of completed.
+"""
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from emails.blobs import find_stored_blob
+from emails.metrics import observe_storage
+from emails.storage import StorageError, get_storage
+
+
+class AttachmentTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = "Attachments are too large."
+    default_code = 'attachment_too_large'
+
+
+class AttachmentStorageUnavailable(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Attachments could not be stored. Try again later."
+    default_code = 'attachment_storage_unavailable'
+
+
+class StoredUploadedFile(UploadedFile):
+    """
+    An attachment that is already in storage as `object_name`. `written` is
+    False when the content matched a stored blob and nothing was written.
+    """
+
+    def __init__(self, name: str, object_name: str, size: int, sha256: str, content_type: str, written: bool):
+        super().__init__(file=None, name=name, content_type=content_type, size=size)
+        self.object_name = object_name
+        self.sha256 = sha256
+        self.written = written
+
+    def open(self, mode=None):
+        return get_storage().open(self.object_name)
+
+
+class StreamingUploadHandler(FileUploadHandler):
+    """
+    Stream files posted under `field_name` to storage as they are received.
+    Other files fall through to the next handler.
+    """
+
+    chunk_size = 256 * 1024
+    field_name = 'attachments'
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.max_file_size = settings.ATTACHMENT_MAX_FILE_SIZE
+        self.max_total_size = settings.ATTACHMENT_MAX_EMAIL_SIZE
+        self.buffer_size = settings.ATTACHMENT_DEDUP_BUFFER_SIZE
+
+        self.total_size = 0
+        self.active = False
+        self.writer = None
+        self.stored = []
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        # The body also holds the form fields and boundaries, so leave a
+        # little headroom before rejecting on Content-Length alone
+        if content_length and content_length > self.max_total_size + 64 * 1024:
+            raise AttachmentTooLarge()
+
+    def new_file(self, field_name, file_name, content_type, content_length, charset=None, content_type_extra=None):
+        super().new_file(field_name, file_name, content_type, content_length, charset, content_type_extra)
+
+        self.active = field_name == self.field_name
+
+        if not self.active:
+            return
+
+        # The content hash that names blobs is only known once the file is in
+        self.object_name = 'uploads/' + uuid.uuid4().hex
+        self.size = 0
+        self.hash = hashlib.sha256()
+        self.head = bytearray()
+
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if not self.active:
+            return raw_data
+
+        self.size += len(raw_data)
+        self.total_size += len(raw_data)
+
+        if self.size > self.max_file_size or self.total_size > self.max_total_size:
+            self.discard()
+            raise AttachmentTooLarge()
+
+        self.hash.update(raw_data)
+
+        if self.writer is None:
+            self.head += raw_data
+
+            if len(self.head) < self.buffer_size:
+                return None
+
+            raw_data = bytes(self.head)
+            self.head = bytearray()
+
+        self.write(raw_data)
+
+    def file_complete(self, file_size):
+        if not self.active:
+            return None
+
+        self.active = False
+        sha256 = self.hash.hexdigest()
+        blob = find_stored_blob(sha256)
+
+        if blob is not None:
+            # Same content is stored already; drop whatever was sent so far
+            object_name = blob.object_name
+            self.abort()
+        else:
+            object_name = self.object_name
+
+            if self.writer is None:
+                self.write(bytes(self.head))
+
+            try:
+                with observe_storage('stream_complete'):
+                    self.writer.close()
+            except StorageError:
+                self.writer = None
+                self.discard()
+                raise AttachmentStorageUnavailable()
+
+            self.writer = None
+
+        self.head = bytearray()
+
+        file = StoredUploadedFile(
+            name=self.file_name,
+            object_name=object_name,
+            size=self.size,
+            sha256=sha256,
+            content_type=self.content_type,
+            written=blob is None,
+        )
+
+        # Only objects this request wrote are ours to clean up
+        if file.written:
+            self.stored.append(file)
+
+        return file
+
+    def upload_interrupted(self):
+        self.discard()
+
+    def write(self, data: bytes) -> None:
+        try:
+            if self.writer is None:
+                self.writer = get_storage().open_writer(self.object_name)
+
+            with observe_storage('stream_write'):
+                self.writer.write(data)
+        except StorageError:
+            self.discard()
+            raise AttachmentStorageUnavailable()
+
+    def abort(self) -> None:
+        if self.writer is not None:
+            try:
+                self.writer.abort()
+            except StorageError:
+                pass
+
+            self.writer = None
+
+    def discard(self):
+        """
+        Throw away the file being written and everything stored so far
+        """
+
+        storage = get_storage()
+        self.abort()
+        self.active = False
+
+        for file in self.stored:
+            try:
+                storage.delete(file.object_name)
+            except StorageError:
+                pass
+
+        self.stored = []
@@ -0,0 +1,355 @@
+"""
+Background attachment uploads.
+
+Files are copied to a local spool while the request is still open, then
+pushed to the storage backend by a bounded pool of worker threads once the
+email has been committed. Content that is already stored is never uploaded
+again. Each blob and its Attachment rows move from `pending` to `stored`, or
+to `failed` after the last retry.
+
+A blob still pending ATTACHMENT_UPLOAD_STALE_AFTER seconds after its upload
+was queued lost its uploader with the process running it. The next upload of
+the same content takes it over, and `retry_stale_uploads` (the
+`retry_uploads` command) queues it again from its spool file if that is
+still there, or marks it failed.
+"""
+import glob
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from emails.blobs import adopt_object, blob_object_name, claim_blob, delete_objects
+from emails.folders import participant_q
+from emails.metrics import observe_storage
+from emails.models import Attachment, Blob, Email
+from emails.storage import StorageError, get_storage
+from emails.upload_handlers import StoredUploadedFile
+
+logger = logging.getLogger(__name__)
+
+
+class AttachmentUploader:
+    """
+    Upload spooled files on a fixed number of threads. At most `queue_size`
+    uploads wait at a time; callers block on `submit` beyond that.
+    """
+
+    def __init__(self, workers: int, attempts: int, retry_delay: float, queue_size: int):
+        self.workers = workers
+        self.attempts = attempts
+        self.retry_delay = retry_delay
+
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.workers,
+                        thread_name_prefix='attachment-upload',
+                    )
+
+        return self._executor
+
+    def submit(self, blob_id: int, object_name: str, path: str) -> None:
+        # With no workers configured uploads run inline, which keeps tests
+        # and management commands deterministic
+        if self.workers <= 0:
+            self.upload(blob_id, object_name, path)
+            return
+
+        self._slots.acquire()
+        future = self.executor.submit(self.upload, blob_id, object_name, path)
+        future.add_done_callback(lambda _: self._slots.release())
+
+    def upload(self, blob_id: int, object_name: str, path: str) -> None:
+        state = Blob.FAILED
+
+        try:
+            for attempt in range(1, self.attempts + 1):
+                try:
+                    with open(path, 'rb') as file, observe_storage('upload'):
+                        get_storage().save(file, object_name)
+                except StorageError as e:
+                    logger.warning("Upload of %s failed (attempt %d/%d): %s",
+                                   object_name, attempt, self.attempts, e)
+
+                    if attempt < self.attempts:
+                        time.sleep(self.retry_delay * 2 ** (attempt - 1))
+                else:
+                    state = Blob.STORED
+                    break
+
+            updated = Blob.objects.filter(id=blob_id, object_name=object_name).update(state=state)
+
+            if updated:
+                Attachment.objects.filter(blob_id=blob_id).update(state=state)
+            elif state == Blob.STORED:
+                # Another upload of the content was stored for the blob meanwhile
+                delete_objects([object_name])
+        except Exception:
+            logger.exception("Upload of %s crashed", object_name)
+        finally:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+            close_old_connections()
+
+
+_uploader = None
+_uploader_lock = threading.Lock()
+
+
+def get_uploader() -> AttachmentUploader:
+    """
+    Return the process wide uploader configured in settings
+    """
+
+    global _uploader
+
+    if _uploader is None:
+        with _uploader_lock:
+            if _uploader is None:
+                _uploader = AttachmentUploader(
+                    workers=settings.ATTACHMENT_UPLOAD_WORKERS,
+                    attempts=settings.ATTACHMENT_UPLOAD_ATTEMPTS,
+                    retry_delay=settings.ATTACHMENT_UPLOAD_RETRY_DELAY,
+                    queue_size=settings.ATTACHMENT_UPLOAD_QUEUE_SIZE,
+                )
+
+    return _uploader
+
+
+def spool_dir() -> str:
+    directory = settings.ATTACHMENT_SPOOL_DIR or tempfile.gettempdir()
+    os.makedirs(directory, exist_ok=True)
+
+    return directory
+
+
+def spool(file):
+    """
+    Copy an uploaded file somewhere that outlives the request.
+    Returns the spool path, the size and the sha256 of the content.
+    """
+
+    size = 0
+    digest = hashlib.sha256()
+
+    with tempfile.NamedTemporaryFile(dir=spool_dir(), prefix='attachment-', suffix='.part', delete=False) as destination:
+        for chunk in file.chunks():
+            size += len(chunk)
+            digest.update(chunk)
+            destination.write(chunk)
+
+    # Named after the content, so a blob whose uploader died can find it again
+    sha256 = digest.hexdigest()
+    path = os.path.join(spool_dir(), 'attachment-{}-{}'.format(sha256, uuid.uuid4().hex[:8]))
+    os.replace(destination.name, path)
+
+    return path, size, sha256
+
+
+def find_spooled(sha256: str):
+    """
+    Path of a spooled copy of the content, if one is left
+    """
+
+    paths = glob.glob(os.path.join(spool_dir(), 'attachment-{}-*'.format(sha256)))
+
+    return paths[0] if paths else None
+
+
+def needs_upload(blob: Blob, stale_before) -> bool:
+    """
+    Whether a claimed blob has to be uploaded again: its upload failed, or it
+    has been pending since before `stale_before`
+    """
+
+    if blob.state == Blob.FAILED:
+        return True
+
+    return blob.state == Blob.PENDING and (blob.upload_started_at is None or blob.upload_started_at < stale_before)
+
+
+def queue_attachments(email: Email, files: list, spooled: list = None) -> list:
+    """
+    Create Attachment rows for `files`, sharing a blob with any earlier file
+    that has the same content. Files streamed to storage by
+    StreamingUploadHandler are stored already; new content from other files
+    is uploaded once the surrounding transaction commits. The spool path of
+    each of those uploads is appended to `spooled`, for the caller to pass to
+    `discard_spooled` if the transaction rolls back.
+    """
+
+    attachments = []
+    jobs = []
+    duplicates = []
+    now = timezone.now()
+    stale_before = now - timedelta(seconds=settings.ATTACHMENT_UPLOAD_STALE_AFTER)
+
+    for file in files:
+        if isinstance(file, StoredUploadedFile):
+            blob, created = claim_blob(file.sha256, file.object_name, file.size, Blob.STORED)
+
+            # A blob that never got stored takes this complete copy instead.
+            # Otherwise this lost a race with an identical upload; keep theirs.
+            if blob.object_name != file.object_name:
+                if blob.state == Blob.STORED or not adopt_object(blob, file.object_name):
+                    duplicates.append(file.object_name)
+        else:
+            path, size, sha256 = spool(file)
+            blob, created = claim_blob(sha256, blob_object_name(sha256), size, Blob.PENDING, upload_started_at=now)
+
+            if created or needs_upload(blob, stale_before):
+                if not created:
+                    Blob.objects.filter(id=blob.id).update(state=Blob.PENDING, upload_started_at=now)
+                    blob.state = Blob.PENDING
+
+                jobs.append((blob.id, blob.object_name, path))
+
+                if spooled is not None:
+                    spooled.append(path)
+            else:
+                os.remove(path)
+
+        attachments.append(Attachment.objects.create(
+            name=file.name,
+            object_name=blob.object_name,
+            size=blob.size,
+            sha256=blob.sha256,
+            state=blob.state,
+            email=email,
+            blob=blob,
+        ))
+
+    def submit_all():
+        uploader = get_uploader()
+
+        for job in jobs:
+            uploader.submit(*job)
+
+    transaction.on_commit(submit_all)
+
+    if duplicates:
+        transaction.on_commit(lambda: delete_objects(duplicates))
+
+    return attachments
+
+
+def retry_stale_uploads(stale_after: timedelta) -> tuple:
+    """
+    Upload blobs that have been pending for longer than `stale_after` again,
+    from a spooled copy of their content. Blobs without one are marked failed,
+    so the next upload of the content stores it. Returns the number retried
+    and the number marked failed.
+    """
+
+    now = timezone.now()
+    jobs = []
+    lost = []
+
+    with transaction.atomic():
+        blobs = Blob.objects\
+            .select_for_update(skip_locked=True)\
+            .filter(state=Blob.PENDING)\
+            .filter(Q(upload_started_at__isnull=True) | Q(upload_started_at__lt=now - stale_after))
+
+        for blob in blobs:
+            path = find_spooled(blob.sha256)
+
+            if path is None:
+                lost.append(blob.id)
+            else:
+                jobs.append((blob.id, blob.object_name, path))
+
+        Blob.objects.filter(id__in=[blob_id for blob_id, _, _ in jobs]).update(upload_started_at=now)
+        Blob.objects.filter(id__in=lost).update(state=Blob.FAILED)
+        Attachment.objects.filter(blob_id__in=lost).update(state=Blob.FAILED)
+
+    uploader = get_uploader()
+    for job in jobs:
+        uploader.upload(*job)
+
+    return len(jobs), len(lost)
+
+
+def forward_attachments(email: Email, user: User, attachment_ids: list) -> list:
+    """
+    Attach existing attachments the user can see to `email` without copying
+    any data. Returns the ids that could not be forwarded.
+    """
+
+    originals = list(
+        Attachment.objects
+        .filter(id__in=attachment_ids, blob__isnull=False)
+        .filter(participant_q(user, prefix='email__'))
+        .select_related('blob')
+        .distinct()
+    )
+
+    for original in originals:
+        claim_blob(original.blob.sha256, original.object_name, original.size, original.blob.state)
+
+    Attachment.objects.bulk_create([
+        Attachment(
+            name=original.name,
+            object_name=original.object_name,
+            size=original.size,
+            sha256=original.sha256,
+            state=original.blob.state,
+            email=email,
+            blob=original.blob,
+        )
+        for original in originals
+    ])
+
+    found = {original.id for original in originals}
+
+    return [attachment_id for attachment_id in attachment_ids if attachment_id not in found]
+
+
+def discard_uploads(files: list) -> None:
+    """
+    Delete files that were streamed to storage for an email that was never sent
+    """
+
+    storage = get_storage()
+
+    for file in files:
+        if isinstance(file, StoredUploadedFile) and file.written:
+            try:
+                storage.delete(file.object_name)
+            except StorageError as e:
+                logger.warning("Could not delete %s: %s", file.object_name, e)
+
+
+def discard_spooled(paths: list) -> None:
+    """
+    Remove spooled copies whose uploads were never queued because the
+    transaction that queued them rolled back
+    """
+
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -1,7 +1,9 @@
 from django.urls import path, re_path
 from django.contrib import admin
 from rest_framework_jwt.views import obtain_jwt_token, verify_jwt_token
-from emails.views import current_user, UserRegistration, UserInbox, UserSent, EmailAttachment, UserStarred, UserTrash
+from emails.views import current_user, UserRegistration, UserInbox, UserSent, EmailAttachment, EmailAttachmentBatch, \
+    AttachmentURLCacheStats, AttachmentDownload, UserStarred, UserTrash, EmailSearch, MailboxReadState, \
+    FolderCounters, EmailDetail, MailboxSync, DeliveryQueueStats
 
 urlpatterns = [
     # Authentication related paths
@@ -15,6 +17,15 @@ urlpatterns = [
     path('inbox/', UserInbox.as_view()),
     path('sent/', UserSent.as_view()),
     path('attachments/', EmailAttachment.as_view()),
+    path('attachments/batch/', EmailAttachmentBatch.as_view()),
+    path('attachments/cache-stats/', AttachmentURLCacheStats.as_view()),
+    path('attachments/download/<str:token>/', AttachmentDownload.as_view(), name='attachment-download'),
     path('starred/', UserStarred.as_view()),
     path('trash/', UserTrash.as_view()),
+    path('message/', EmailDetail.as_view()),
+    path('read/', MailboxReadState.as_view()),
+    path('counters/', FolderCounters.as_view()),
+    path('search/', EmailSearch.as_view()),
+    path('sync/', MailboxSync.as_view()),
+    path('delivery/stats/', DeliveryQueueStats.as_view()),
 ]
\ No newline at end of file
@@ -0,0 +1,73 @@
+"""
+Per user mailbox versions for conditional GETs on folder listings.
+
+Every change to a user's Mailbox rows bumps their version in the same
+transaction (see emails.counters.update_counters). A listing is labelled
+with the version read before its query, so a response is never tagged newer
+than its contents. Rendered listings are cached per process under the
+version they were built for and are never invalidated, only outlived.
+"""
+import hashlib
+import threading
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models import F
+from django.utils import timezone
+
+from emails.cache import LRUCache
+from emails.models import MailboxState
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> LRUCache:
+    global _cache
+
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = LRUCache(settings.MAILBOX_RESPONSE_CACHE_SIZE)
+
+    return _cache
+
+
+def bump_versions(user_ids) -> None:
+    """
+    Mark the mailboxes of `user_ids` as changed
+    """
+
+    user_ids = sorted(set(user_ids))
+
+    if not user_ids:
+        return
+
+    MailboxState.objects.bulk_create(
+        [MailboxState(user_id=user_id) for user_id in user_ids],
+        ignore_conflicts=True,
+    )
+    MailboxState.objects\
+        .filter(user_id__in=user_ids)\
+        .update(version=F('version') + 1, modified_at=timezone.now())
+
+
+def get_version(user: User):
+    """
+    Return (version, modified_at) for the user's mailbox. A user whose
+    mailbox never changed is at version 0 with no modification time.
+    """
+
+    state = MailboxState.objects.filter(user=user).values_list('version', 'modified_at').first()
+    return state or (0, None)
+
+
+def mailbox_etag(user: User, version: int, path: str) -> str:
+    """
+    Tag the listing at `path` (folder, cursor and page size included) of the
+    user's mailbox at `version`, so a tag from one listing never matches
+    another
+    """
+
+    digest = hashlib.sha1(path.encode()).hexdigest()[:16]
+    return '"{}.{}.{}"'.format(user.id, version, digest)
@@ -1,23 +1,39 @@
+from django.conf import settings
+from django.db import transaction
 from django.db.models import QuerySet
 from django.contrib.auth.models import User
+from django.http import FileResponse, Http404
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
 
 from rest_framework.decorators import api_view
+from rest_framework.exceptions import ValidationError
 from rest_framework.views import APIView
 from rest_framework.response import Response
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework.request import Request
 from rest_framework import status, permissions
 
 from json import loads
-import logging
-import uuid
-
-import boto3
-from botocore.exceptions import ClientError
-
-from emails.models import Attachment, Email, Starred, Inbox, Trash, Sent
-from reply.secret import AWS_ACCESS, AWS_SECRET
-
-from emails.serializers import UserSerializer, UserSerializerWithToken, EmailSerializer
+import os
+
+from emails.changes import changes_since
+from emails.counters import get_counters
+from emails.delivery import queue_stats
+from emails.folders import STARRED, folder_rows, parse_email_ids, participant_q, mark_read, move_emails, purge_emails, \
+    toggle_starred
+from emails.listing import LIST_VALUES, FastJSONRenderer, list_rows, row_position
+from emails.models import Attachment, Email, Mailbox
+from emails.pagination import KeysetPagination
+from emails.presign import get_url_cache, presigned_url
+from emails.search import search_emails
+from emails.storage import LocalStorage, StorageError, get_storage
+from emails.upload_handlers import StreamingUploadHandler
+from emails.uploads import discard_spooled, discard_uploads, forward_attachments, queue_attachments
+from emails.versions import get_response_cache, get_version, mailbox_etag
+
+from emails.serializers import UserSerializer, UserSerializerWithToken, EmailSerializer, EmailListSerializer, \
+    EmailDetailSerializer, ReadStateSerializer
 
 
 @api_view(['GET'])
@@ -27,7 +43,7 @@ def current_user(request: Request):
     """
 
     serializer = UserSerializer(request.user)
-    return Response(serializer.data)
+    return Response(dict(serializer.data, counters=get_counters(request.user)))
 
 
 class UserRegistration(APIView):
@@ -47,72 +63,134 @@ class UserRegistration(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class UserInbox(APIView):
+class FolderListMixin:
+    """
+    Paginated listing of the emails in one of the user's folders
+    """
+
+    pagination_class = KeysetPagination
+    renderer_classes = (FastJSONRenderer, BrowsableAPIRenderer)
+
+    def list_folder(self, request: Request, memberships: QuerySet):
+        user: User = request.user
+        pagination = self.pagination_class()
+        # A malformed cursor is rejected before the ETag could answer 304
+        pagination.validate(request)
+
+        version, modified_at = get_version(user)
+        etag = mailbox_etag(user, version, request.get_full_path())
+        last_modified = int(modified_at.timestamp()) if modified_at else None
+
+        # An unchanged mailbox is answered without touching the email tables.
+        # Only the ETag decides: Last-Modified has one second resolution, so a
+        # change within the second of a client's copy would be missed.
+        response = get_conditional_response(request, etag=etag)
+
+        if response is None:
+            cache = get_response_cache()
+            key = (user.id, version, request.get_full_path())
+            data = cache.get(key)
+
+            if data is None:
+                # One query joining the email and both users, read as plain
+                # tuples and mapped straight to EmailListSerializer's output
+                memberships = memberships\
+                    .filter(email__isnull=False)\
+                    .values_list(*LIST_VALUES)
+
+                rows, next_cursor = pagination.paginate_queryset(memberships, request, position=row_position)
+                data = {'inbox': list_rows(rows), 'next': next_cursor}
+                cache.set(key, data, ttl=settings.MAILBOX_RESPONSE_CACHE_TTL)
+
+            response = Response(data, status=status.HTTP_200_OK)
+
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        patch_vary_headers(response, ('Authorization',))
+
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+
+        return response
+
+
+class UserInbox(FolderListMixin, APIView):
     permission_classes = (permissions.IsAuthenticated,)
 
+    def initialize_request(self, request, *args, **kwargs):
+        self.upload_handler = None
+
+        # Stream attachments to storage while the body is being read
+        if request.method == 'POST' and settings.ATTACHMENT_STREAMING_UPLOADS:
+            self.upload_handler = StreamingUploadHandler(request)
+            request.upload_handlers.insert(0, self.upload_handler)
+
+        return super().initialize_request(request, *args, **kwargs)
 
     """
     Receiver 'GET' request for user's inbox
     """
     def get(self, request: Request, format=None):
-        emails = []
-
-        # Get QuerySet for
-        query = request.user.inbox
-
-        for email_query in query.iterator():
-            email = Email.objects.filter(id=email_query.email_id)
-
-            if email.exists():
-                serializer = EmailSerializer(email[0])
-                emails.append(serializer.data)
-
-        return Response({'inbox': emails}, status=status.HTTP_200_OK)
+        return self.list_folder(request, folder_rows(request.user, Mailbox.INBOX))
 
     """
     Receive 'POST' request to send message to another user's inbox
     """
     def post(self, request: Request, format=None):
         user: User = request.user
-        files = request.FILES.getlist('attachments')
-        email_data = loads(request.data['email'])
 
-        email_data['sender'] = {'username': user.username}
-
-        serializer = EmailSerializer(data=email_data)
+        # Reading the body streams the attachments into storage. Whatever was
+        # stored must be deleted again on every path that does not send.
+        try:
+            files = request.FILES.getlist('attachments')
+        except Exception:
+            if self.upload_handler is not None:
+                self.upload_handler.discard()
+            raise
 
-        if serializer.is_valid():
-            email = serializer.save()
+        try:
+            email_data = loads(request.data['email'])
+        except (KeyError, TypeError, ValueError):
+            discard_uploads(files)
+            raise ValidationError({'email': 'Must be the email as JSON.'})
 
-            for file in files:
-                object_name = str(uuid.uuid4()) + '_' + file.name
+        serializer = EmailSerializer(data=email_data, context={'sender': user})
 
-                attachment_data = {
-                    'name': file.name,
-                    'object_name': object_name,
-                    'email': email,
-                }
+        if not serializer.is_valid():
+            discard_uploads(files)
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-                Attachment.objects.create(**attachment_data)
-                self.upload_file(file, "reply-django-server", object_name)
+        # Uploads start once the email and its attachment rows are committed
+        spooled = []
+        try:
+            with transaction.atomic():
+                email = serializer.save()
+                queue_attachments(email, files, spooled)
+                missing = forward_attachments(email, user, serializer.validated_data.get('forward_attachments', []))
+        except Exception:
+            discard_spooled(spooled)
+            discard_uploads(files)
+            raise
 
-            receiver = User.objects.get(username=email_data['receiver']['username'])
-            Inbox.objects.create(user=receiver, email=email)
-            Sent.objects.create(user=user, email=email)
+        data = serializer.data
 
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
+        if missing:
+            data['missing_attachments'] = missing
 
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        return Response(data, status=status.HTTP_201_CREATED)
 
     """
-    Receive 'PUT' request to update email status
+    Receive 'PUT' request to update the user's read state of an email
     """
     def put(self, request: Request):
-        email = Email.objects.get(id=request.query_params.get('email_id'))
-        serializer = EmailSerializer(email, data=request.data)
+        email_ids = parse_email_ids(request)
+        serializer = ReadStateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
 
-        if serializer.is_valid():
-            serializer.save()
+        updated = mark_read(request.user, serializer.validated_data['read'], email_ids=email_ids[:1])
+
+        if not updated and not Mailbox.objects.filter(user=request.user, email_id=email_ids[0]).exists():
+            raise Http404
 
         return Response({'email': 'read'}, status=status.HTTP_200_OK)
 
@@ -120,184 +198,283 @@ class UserInbox(APIView):
     Receive 'DELETE' request to remove email from user's inbox and move to trash
     """
     def delete(self, request, format=None):
-        user = request.user
-        email_ids = request.query_params.get('email_id').split(',')
+        email_ids = parse_email_ids(request)
+        missing = move_emails(request.user, email_ids, Mailbox.INBOX, Mailbox.TRASH)
 
-        for email_id in email_ids:
-            email = Email.objects.get(id=email_id)
-            Inbox.objects.get(user=user, email=email).delete()
-            Trash.objects.create(**{'user': user, 'email': email})
+        return Response({'missing': missing}, status=status.HTTP_200_OK)
 
-        return Response(status=status.HTTP_200_OK)
+
+class UserSent(FolderListMixin, APIView):
+    permission_classes = (permissions.IsAuthenticated,)
 
     """
-    Method to upload file to AWS S3 
+    Receiver 'GET' request for user's sent emails
     """
-    def upload_file(self, file, bucket, object_name=None):
-        if object_name is None:
-            object_name = file.name
-
-        # Upload the file
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=AWS_ACCESS,
-            aws_secret_access_key=AWS_SECRET
-        )
+    def get(self, request: Request, format=None):
+        return self.list_folder(request, folder_rows(request.user, Mailbox.SENT))
 
-        try:
-            s3_client.upload_fileobj(file, bucket, object_name)
-        except ClientError as e:
-            logging.error(e)
-            return False
+    def delete(self, request: Request):
+        """
+        Delete email from user sent forever
+        """
+        email_ids = parse_email_ids(request)
+        missing = purge_emails(request.user, email_ids, Mailbox.SENT)
 
-        return True
+        return Response({'missing': missing}, status=status.HTTP_200_OK)
 
 
-class UserSent(APIView):
+class UserStarred(FolderListMixin, APIView):
     permission_classes = (permissions.IsAuthenticated,)
 
     """
-    Receiver 'GET' request for user's sent emails
+    Receiver of requests for user's starred emails
     """
+
     def get(self, request: Request, format=None):
-        emails = []
+        return self.list_folder(request, folder_rows(request.user, STARRED))
 
-        # Get QuerySet for all emails user sent
-        query = request.user.sent_email
+    def post(self, request: Request, format=None):
+        email_ids = parse_email_ids(request)
+        missing = toggle_starred(request.user, email_ids)
+
+        return Response({'missing': missing}, status=status.HTTP_201_CREATED)
+
+
+class UserTrash(FolderListMixin, APIView):
+    permission_classes = (permissions.IsAuthenticated,)
+
+    """
+    Receiver of requests for user's trash emails
+    """
 
-        for email_query in query.iterator():
-            email = Email.objects.filter(id=email_query.email_id)
+    def get(self, request: Request, format=None):
+        return self.list_folder(request, folder_rows(request.user, Mailbox.TRASH))
 
-            if email.exists():
-                serializer = EmailSerializer(email[0])
-                emails.append(serializer.data)
+    def patch(self, request: Request):
+        email_ids = parse_email_ids(request)
+        missing = move_emails(request.user, email_ids, Mailbox.TRASH, Mailbox.INBOX)
 
-        return Response({'inbox': emails}, status=status.HTTP_200_OK)
+        return Response({'missing': missing}, status=status.HTTP_200_OK)
 
     def delete(self, request: Request):
         """
-        Delete email from user sent forever
+        Delete email from user Trash forever
         """
-        user = request.user
-        email_ids = request.query_params.get('email_id').split(',')
-
-        for email_id in email_ids:
-            email = Email.objects.get(id=email_id)
-            Sent.objects.get(user=user, email=email).delete()
+        email_ids = parse_email_ids(request)
+        missing = purge_emails(request.user, email_ids, Mailbox.TRASH)
 
-        return Response(status=status.HTTP_200_OK)
+        return Response({'missing': missing}, status=status.HTTP_200_OK)
 
 
-class UserStarred(APIView):
+class MailboxReadState(APIView):
     permission_classes = (permissions.IsAuthenticated,)
 
     """
-    Receiver of requests for user's starred emails
+    Receive 'PATCH' request to mark emails read or unread, either the ids in
+    `email_id` or everything in `folder` from the listing cursor `before` on
     """
+    def patch(self, request: Request):
+        serializer = ReadStateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        email_ids = parse_email_ids(request) if 'email_id' in request.query_params else None
+        updated = mark_read(
+            request.user,
+            serializer.validated_data['read'],
+            email_ids=email_ids,
+            folder=request.query_params.get('folder', Mailbox.INBOX),
+            before=request.query_params.get('before'),
+        )
 
-    def get(self, request: Request, format=None):
-        emails = []
+        return Response({'updated': updated}, status=status.HTTP_200_OK)
 
-        starred_query: QuerySet = request.user.starred.all()
 
-        for user_starred in starred_query.iterator():
-            email = user_starred.email
-            serializer = EmailSerializer(email)
-            emails.append(serializer.data)
+class FolderCounters(APIView):
+    permission_classes = (permissions.IsAuthenticated,)
 
-        return Response({'inbox': emails}, status=status.HTTP_200_OK)
+    """
+    Receive 'GET' request for the total and unread count of every folder
+    """
+    def get(self, request: Request):
+        return Response(get_counters(request.user), status=status.HTTP_200_OK)
 
-    def post(self, request: Request, format=None):
-        user = request.user
-        email_ids = request.query_params.get('email_id').split(',')
 
-        for email_id in email_ids:
-            email = Email.objects.get(id=email_id)
+class EmailDetail(APIView):
+    permission_classes = (permissions.IsAuthenticated,)
 
-            if Starred.objects.filter(user=user, email=email).exists():
-                Starred.objects.filter(user=user, email=email).delete()
-            else:
-                Starred.objects.create(**{'user': user, 'email': email})
+    """
+    Receive 'GET' request for the full message and attachment details of
+    an email in one of the user's folders
+    """
+    def get(self, request: Request):
+        email_ids = parse_email_ids(request)
+        row = Mailbox.objects\
+            .filter(user=request.user, email_id=email_ids[0])\
+            .select_related('email__sender', 'email__receiver')\
+            .prefetch_related('email__attachments')\
+            .first()
+
+        if row is None:
+            raise Http404
+
+        row.email.read = row.read
+        row.email.starred = row.starred
+        serializer = EmailDetailSerializer(row.email)
 
-        return Response(status=status.HTTP_201_CREATED)
+        return Response(serializer.data, status=status.HTTP_200_OK)
 
 
-class UserTrash(APIView):
+class MailboxSync(APIView):
     permission_classes = (permissions.IsAuthenticated,)
+    renderer_classes = (FastJSONRenderer, BrowsableAPIRenderer)
 
     """
-    Receiver of requests for user's trash emails
+    Receive 'GET' request for the user's mailbox changes after the `since`
+    cursor. Each change is [email_id, kind, folder, starred, read] with the
+    email's latest state; `emails` holds the listing rows of new mail. Without
+    a cursor, or with one older than the change log, the answer is
+    {'resync': true, 'cursor': ...}: list the folders again and sync from
+    that cursor.
     """
+    def get(self, request: Request):
+        since = request.query_params.get('since')
 
-    def get(self, request: Request, format=None):
-        emails = []
+        try:
+            since = int(since) if since is not None else None
+        except ValueError:
+            raise ValidationError({'since': 'Must be an integer.'})
 
-        trash_query: QuerySet = request.user.trash.all()
+        limit = KeysetPagination().get_page_size(request)
 
-        for user_trash in trash_query.iterator():
-            email = user_trash.email
-            serializer = EmailSerializer(email)
-            emails.append(serializer.data)
+        return Response(changes_since(request.user, since, limit), status=status.HTTP_200_OK)
 
-        return Response({'inbox': emails}, status=status.HTTP_200_OK)
 
-    def patch(self, request: Request):
-        user = request.user
-        email_ids = request.query_params.get('email_id').split(',')
+class EmailSearch(APIView):
+    permission_classes = (permissions.IsAuthenticated,)
 
-        for email_id in email_ids:
-            email = Email.objects.get(id=email_id)
+    """
+    Receive 'GET' request to search the user's mail, best match first
+    """
+    def get(self, request: Request):
+        limit = KeysetPagination().get_page_size(request)
+        emails, next_cursor = search_emails(
+            request.user,
+            request.query_params.get('q', ''),
+            request.query_params.get('cursor'),
+            limit,
+        )
+        serializer = EmailListSerializer(emails, many=True)
 
-            if Trash.objects.filter(user=user, email=email).exists():
-                Trash.objects.filter(user=user, email=email).delete()
-                Inbox.objects.create(**{'user': user, 'email': email})
+        return Response({'inbox': serializer.data, 'next': next_cursor}, status=status.HTTP_200_OK)
 
-        return Response(status=status.HTTP_200_OK)
 
-    def delete(self, request: Request):
+class AttachmentLinksMixin:
+    """
+    Download links for the attachments of emails the user took part in
+    """
+
+    def attachment_links(self, user: User, email_ids: list) -> dict:
         """
-        Delete email from user Trash forever
+        Map each visible email id to its attachment links and pending files.
+        Emails the user cannot see are left out.
         """
-        user = request.user
-        email_ids = request.query_params.get('email_id').split(',')
 
-        for email_id in email_ids:
-            email = Email.objects.get(id=email_id)
-            Trash.objects.get(user=user, email=email).delete()
+        visible = set(
+            Email.objects
+            .filter(participant_q(user), id__in=email_ids)
+            .values_list('id', flat=True)
+            .distinct()
+        )
+
+        links = {email_id: {'attachments': [], 'pending': []} for email_id in email_ids if email_id in visible}
+        attachment_query: QuerySet = Attachment.objects.filter(email_id__in=visible).order_by('id')
+
+        for attachment in attachment_query.iterator():
+            file_name = attachment.name
+            email_links = links[attachment.email_id]
 
-        return Response(status=status.HTTP_200_OK)
+            if attachment.state != Attachment.STORED:
+                email_links['pending'].append({file_name: attachment.state})
+                continue
 
+            # Presigned url for client side to download resource
+            email_links['attachments'].append({file_name: presigned_url(attachment.object_name, file_name, user.id)})
 
-class EmailAttachment(APIView):
+        return links
+
+
+class EmailAttachment(AttachmentLinksMixin, APIView):
     permission_classes = (permissions.IsAuthenticated,)
 
     def get(self, request: Request):
-        expiration = 300
-        attachments = []
-        email_id = request.query_params.get('email_id')
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=AWS_ACCESS,
-            aws_secret_access_key=AWS_SECRET
-        )
+        email_ids = parse_email_ids(request)
+        links = self.attachment_links(request.user, email_ids[:1])
 
-        email: Email = Email.objects.get(id=email_id)
+        if not links:
+            raise Http404
 
-        attachment_query: QuerySet = email.attachments.all()
+        return Response(links[email_ids[0]], status=status.HTTP_200_OK)
 
-        for attachment in attachment_query.iterator():
-            file_name = attachment.name
-            object_name = attachment.object_name
 
-            # Generate presigned url for client side to download resource
-            presigned_url = s3_client\
-                .generate_presigned_url('get_object',
-                                        Params={'Bucket': 'reply-django-server',
-                                                'Key': object_name},
-                                        ExpiresIn=expiration)
-            attachments.append({file_name: presigned_url})
+class EmailAttachmentBatch(AttachmentLinksMixin, APIView):
+    permission_classes = (permissions.IsAuthenticated,)
+
+    """
+    Receive 'GET' request for the attachments of several emails at once
+    """
+    def get(self, request: Request):
+        email_ids = parse_email_ids(request)
+        links = self.attachment_links(request.user, email_ids)
+        missing = [email_id for email_id in email_ids if email_id not in links]
+
+        return Response({'emails': links, 'missing': missing}, status=status.HTTP_200_OK)
+
+
+class AttachmentURLCacheStats(APIView):
+    permission_classes = (permissions.IsAdminUser,)
+
+    """
+    Receive 'GET' request for the download link cache counters
+    """
+    def get(self, request: Request):
+        return Response(get_url_cache().stats(), status=status.HTTP_200_OK)
+
+
+class DeliveryQueueStats(APIView):
+    permission_classes = (permissions.IsAdminUser,)
+
+    """
+    Receive 'GET' request for the depth and lag of the delivery queue
+    """
+    def get(self, request: Request):
+        return Response(queue_stats(), status=status.HTTP_200_OK)
+
 
-        return Response({'attachments': attachments}, status=status.HTTP_200_OK)
+class AttachmentDownload(APIView):
+    """
+    Serve a file kept by LocalStorage. The signed token stands in for an S3
+    presigned url, so no login is needed.
+    """
+
+    permission_classes = (permissions.AllowAny,)
+    authentication_classes = ()
+
+    def get(self, request: Request, token: str):
+        storage = get_storage()
+
+        if not isinstance(storage, LocalStorage):
+            raise Http404
+
+        try:
+            object_name, filename = storage.unsign(token)
+            file = storage.open(object_name)
+        except StorageError:
+            raise Http404
+
+        # Objects are shared by every attachment with the same content, so the
+        # name comes from the link. Links from before names were signed fall
+        # back to the object's.
+        return FileResponse(file, as_attachment=True, filename=filename or os.path.basename(object_name))
 
 
 
@@ -0,0 +1,14 @@
+"""
+gunicorn settings, used with `gunicorn -c gunicorn.conf.py reply.wsgi`.
+"""
+try:
+    from prometheus_client import multiprocess
+except ImportError:
+    # Metrics are off without prometheus_client
+    multiprocess = None
+
+
+def child_exit(server, worker):
+    # Keep a dead worker's counters in /metrics but drop its live gauges
+    if multiprocess is not None:
+        multiprocess.mark_process_dead(worker.pid)
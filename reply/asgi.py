@@ -0,0 +1,23 @@
+"""
+ASGI config for reply project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Run it with an ASGI server, for example `uvicorn reply.asgi:application`.
+"""
+
+import os
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'reply.settings')
+django.setup()
+
+from emails.events import EVENTS_PATH, application as events_application  # noqa: E402
+from emails.handlers import django_application  # noqa: E402
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'http' and scope['path'] == EVENTS_PATH:
+        await events_application(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
@@ -12,7 +12,7 @@ https://docs.djangoproject.com/en/2.2/ref/settings/
 
 import os
 import datetime
-from reply.secret import SECRET
+from reply.secret import SECRET, AWS_ACCESS, AWS_SECRET
 
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -48,6 +48,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'emails.metrics.MetricsMiddleware',
+    'emails.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -63,7 +65,7 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticated',
     ),
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_jwt.authentication.JSONWebTokenAuthentication',
+        'emails.authentication.CachedJSONWebTokenAuthentication',
         'rest_framework.authentication.SessionAuthentication',
         'rest_framework.authentication.BasicAuthentication',
     ),
@@ -99,6 +101,138 @@ JWT_AUTH = {
     'JWT_AUTH_COOKIE': None,
 }
 
+# Where attachments are kept. Use 'emails.storage.LocalStorage' with a
+# 'location' option to keep them on local disk instead of S3.
+ATTACHMENT_STORAGE = {
+    'BACKEND': 'emails.storage.S3Storage',
+    'OPTIONS': {
+        'bucket': 'reply-django-server',
+        'access_key': AWS_ACCESS,
+        'secret_key': AWS_SECRET,
+        'max_pool_connections': 50,
+    },
+}
+
+# Download links last ATTACHMENT_URL_EXPIRY seconds and are reused from a
+# per-process cache while they have ATTACHMENT_URL_MIN_LIFETIME seconds left
+ATTACHMENT_URL_EXPIRY = 300
+ATTACHMENT_URL_MIN_LIFETIME = 60
+ATTACHMENT_URL_CACHE_SIZE = 10000
+
+# Attachments are uploaded to storage by a pool of background threads.
+# Set ATTACHMENT_UPLOAD_WORKERS to 0 to upload inline instead.
+ATTACHMENT_UPLOAD_WORKERS = 8
+ATTACHMENT_UPLOAD_QUEUE_SIZE = 64
+ATTACHMENT_UPLOAD_ATTEMPTS = 3
+ATTACHMENT_UPLOAD_RETRY_DELAY = 1.0
+# Files wait for their upload in ATTACHMENT_SPOOL_DIR, the system temporary
+# directory if None. An upload still pending ATTACHMENT_UPLOAD_STALE_AFTER
+# seconds after it was queued was lost; see `manage.py retry_uploads`.
+ATTACHMENT_SPOOL_DIR = None
+ATTACHMENT_UPLOAD_STALE_AFTER = 900
+
+# Stream attachments into storage as the request body is read, rather than
+# buffering them through Django's default upload handlers
+ATTACHMENT_STREAMING_UPLOADS = True
+ATTACHMENT_MAX_FILE_SIZE = 25 * 1024 * 1024
+ATTACHMENT_MAX_EMAIL_SIZE = 50 * 1024 * 1024
+# Bytes of each attachment held back before writing, so small duplicates
+# of stored content are never written at all
+ATTACHMENT_DEDUP_BUFFER_SIZE = 5 * 1024 * 1024
+
+# Upper bound on to + cc + bcc for a single email
+MAX_EMAIL_RECIPIENTS = 500
+
+# Folder listings are cached per process, keyed on the user's mailbox
+# version, so a write never has to clear them
+MAILBOX_RESPONSE_CACHE_SIZE = 1000
+MAILBOX_RESPONSE_CACHE_TTL = 300
+
+# Incremental sync keeps this many days of mailbox changes; clients whose
+# cursor is older are told to resync in full
+MAILBOX_CHANGE_RETENTION_DAYS = 30
+
+# New-mail events reach the event stream through Postgres LISTEN/NOTIFY, so
+# any process can publish them. 'emails.pubsub.LocalBroker' only reaches
+# streams served by the publishing process itself.
+MAILBOX_EVENTS = {
+    'BACKEND': 'emails.pubsub.PostgresBroker',
+    'OPTIONS': {
+        'channel': 'emails_events',
+    },
+}
+# Seconds between keepalive comments on an idle stream, and before a
+# disconnected client reconnects
+MAILBOX_EVENTS_HEARTBEAT = 15
+MAILBOX_EVENTS_RETRY = 3
+
+# Users behind JWTs are cached per process for JWT_USER_CACHE_TTL seconds.
+# A deactivated user or changed password takes effect in other processes
+# within that time.
+JWT_USER_CACHE_SIZE = 10000
+JWT_USER_CACHE_TTL = 60
+
+# Sent emails are delivered to their recipients' inboxes while the send
+# request is handled. With DELIVERY_QUEUE on they go through a queue
+# instead, and nothing is delivered unless `manage.py deliver_worker` runs.
+# Failed deliveries are retried after DELIVERY_RETRY_DELAY seconds, doubling
+# up to DELIVERY_MAX_RETRY_DELAY.
+DELIVERY_QUEUE = False
+DELIVERY_BATCH_SIZE = 100
+DELIVERY_POLL_INTERVAL = 1
+DELIVERY_RETRY_DELAY = 5
+DELIVERY_MAX_RETRY_DELAY = 3600
+DELIVERY_MAX_ATTEMPTS = 8
+
+# /metrics answers clients whose address is in METRICS_ALLOWED_IPS (addresses
+# or networks such as '10.0.0.0/8') and clients sending METRICS_TOKEN as
+# "Authorization: Bearer <token>". Behind a proxy every client has the proxy's
+# address, so use the token there. The delivery queue gauges are recounted at
+# most every METRICS_QUEUE_CACHE_TTL seconds.
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+METRICS_TOKEN = None
+METRICS_QUEUE_CACHE_TTL = 15
+
+# Requests carrying a token from `manage.py profiles token`, plus a random
+# PROFILING_SAMPLE_RATE share of all requests, are profiled into PROFILING_DIR.
+# Set PROFILING_DIR to None to turn profiling off.
+PROFILING_DIR = os.path.join(BASE_DIR, 'profiles')
+PROFILING_SAMPLE_RATE = 0
+PROFILING_INTERVAL = 0.002
+PROFILING_TOKEN_MAX_AGE = 3600
+PROFILING_MAX_PROFILES = 200
+PROFILING_MAX_QUERIES = 1000
+
+# Under ASGI (reply/asgi.py) views run on a pool of ASGI_THREADS threads,
+# after the first FILE_UPLOAD_MAX_MEMORY_SIZE bytes of the request body have
+# been received; the view reads the rest as it arrives, and gives up when
+# none comes for ASGI_BODY_TIMEOUT seconds. Bodies larger than
+# ASGI_MAX_BODY_SIZE are refused.
+ASGI_THREADS = 32
+ASGI_MAX_BODY_SIZE = ATTACHMENT_MAX_EMAIL_SIZE + 1024 * 1024
+ASGI_BODY_TIMEOUT = 60
+
+# `manage.py smtpd` accepts mail for <username>@<domain> for each domain in
+# SMTP_DOMAINS. Messages are saved SMTP_BATCH_SIZE at a time, waiting up to
+# SMTP_BATCH_WINDOW seconds for a batch to fill, by SMTP_BATCH_WRITERS
+# concurrent writers. Attachments are base64 encoded, hence the larger limit.
+# Senders are told to try again later while SMTP_QUEUE_SIZE messages wait to
+# be saved, or while receiving another message could take the message data
+# held in memory past SMTP_MAX_DATA_BYTES. Whether an address belongs to an
+# active user is cached for SMTP_RECIPIENT_CACHE_TTL seconds.
+SMTP_DOMAINS = ['localhost']
+SMTP_HOST = '127.0.0.1'
+SMTP_PORT = 8025
+SMTP_MAX_MESSAGE_SIZE = ATTACHMENT_MAX_EMAIL_SIZE * 4 // 3 + 1024 * 1024
+SMTP_TIMEOUT = 300
+SMTP_BATCH_SIZE = 100
+SMTP_BATCH_WINDOW = 0.05
+SMTP_BATCH_WRITERS = 4
+SMTP_QUEUE_SIZE = 1000
+SMTP_MAX_DATA_BYTES = 1024 * 1024 * 1024
+SMTP_RECIPIENT_CACHE_SIZE = 10000
+SMTP_RECIPIENT_CACHE_TTL = 60
+
 CORS_ORIGIN_ALLOW_ALL = True
 
 CORS_ORIGIN_WHITELIST = [
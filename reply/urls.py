@@ -18,7 +18,9 @@ from django.contrib import admin
 from django.urls import path, include
 from rest_framework_jwt.views import obtain_jwt_token
 from emails import views
+from emails.metrics import metrics_view
 
 urlpatterns = [
-    path('emails/', include('emails.urls'))
+    path('emails/', include('emails.urls')),
+    path('metrics', metrics_view),
 ]